@@ -1,7 +1,7 @@
 from flask import Flask, render_template, url_for, current_app
 from flask.ext.wtf import Form
 from flask.ext.moment import Moment
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask.ext.sqlalchemy import SQLAlchemy, models_committed
 from flask_app.config import config, Config
 from flask.ext.login import LoginManager
 from flask import Blueprint
@@ -31,12 +31,14 @@ from .models import Book
 
 
 
-def create_app(config_name):
+def create_app(config_name, **settings):
     app = Flask(__name__)
     print config
     print db
 
     app.config.from_object(config[config_name])
+    ## Keyword settings override the config class, e.g. RECOMMENDER_WARM_UP=False in manage.py
+    app.config.update(settings)
     config[config_name].init_app(app)
     
     s3.init_app(app)
@@ -58,7 +60,32 @@ def create_app(config_name):
     from .recommender import recommender as recommender_blueprint
     app.register_blueprint(recommender_blueprint )
 
+    ## Fork the recommendation job pool while this process has no other thread yet
+    ## (manage.py passes RECOMMENDER_JOBS=False so that commands never start it)
+    if app.config.get('RECOMMENDER_JOBS', False):
+        from .recommender.views import get_job_queue
+        with app.app_context():
+            get_job_queue().start()
 
+    ## Load the recommender models (see /healthz/ready) and build the typeahead index
+    ## without blocking startup
+    from .recommender import model_holder
+    from .typeahead import typeahead
+    if app.config.get('RECOMMENDER_WARM_UP', True):
+        model_holder.start()
+        typeahead.start(app, rebuild_interval=app.config.get('TYPEAHEAD_REBUILD_INTERVAL', 600))
+
+    ## Per-stage and query timings for /metrics; workers share them through RECOMMENDER_METRICS_DIR
+    if app.config.get('RECOMMENDER_METRICS', True):
+        from .recommender.metrics import registry, install_query_timing
+        registry.configure(directory=app.config.get('RECOMMENDER_METRICS_DIR'),
+                           flush_interval=app.config.get('RECOMMENDER_METRICS_FLUSH', 5.))
+        install_query_timing(registry)
+
+
+
+    ## Keep the typeahead index up to date with committed books
+    models_committed.connect(typeahead.books_committed, sender=app)
 
     return app
 
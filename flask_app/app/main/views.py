@@ -3,6 +3,9 @@ from flask import render_template, session, redirect, url_for, g, request, jsoni
 from . import main
 from .. import db
 from ..models import User, Book, Read
+from ..reads import user_reads, user_ratings
+from ..ratings import upsert_ratings, write_ratings
+from ..typeahead import typeahead
 from ..auth.forms import LoginForm, RegistrationForm, SearchForm
 from .. import auth
 from flask.ext.login import login_required, current_user
@@ -41,14 +44,19 @@ def search():
 @login_required
 def search_results(query):
     results = Book.query.whoosh_search(query, Config.MAX_SEARCH_RESULTS).all()
-    for book in results:
-        if book in current_user.books_read:
-            print True
     return render_template('search_results.html',
                            query=query,
                            results=results,
-                           db=db,
-                           Read=Read)
+                           ratings=user_ratings(current_user.id, [book.id for book in results]))
+
+# Search-as-you-type over titles and authors, from the in-process index
+@main.route('/typeahead', methods=['GET'])
+@login_required
+def typeahead_search():
+    query = request.args.get('q', '')
+    n = min(request.args.get('n', 10, type=int), 50)
+    return jsonify({"query": query, "results": typeahead.get().search(query, n)})
+
 
 @main.route('/rating', methods=['GET', 'POST'])
 @login_required
@@ -57,27 +65,37 @@ def rating():
     rating = data['rating'][1]
     web_id = data['rating'][0]
 
-    book = db.session.query(Book).filter(Book.web_id==data['rating'][0]).first()
-    read_record = db.session.query(Read).filter_by(book=book, user=g.user).first()
-    ## Fix in the future, this is bad:
-    #if read_record != None:
-        #db.session.delete(read_record)
-        #db.session.commit()
-    book_read = Read(user=g.user, book=book, rating=rating)
-    print 'book read add'
-    print book_read
-    db.session.add(book_read)
+    book = db.session.query(Book.id, Book.title).filter(Book.web_id==web_id).first()
+    if book is None:
+        response = jsonify({"error": "unknown book"})
+        response.status_code = 404
+        return response
+    ## Rating a book again updates its read instead of inserting a second one
+    upsert_ratings(db.session, [(g.user.id, book.id, rating)])
     db.session.commit()
-    print 'book {} added'.format(book.title)
     book_rating = {"book rated": [book.title]}
     return jsonify(book_rating)
 
+# Several ratings in one request, e.g. a whole shelf: {"ratings": [[web_id, rating], ...]}.
+# They are written with one upsert before the response; posting a batch again is harmless.
+@main.route('/ratings', methods=['POST'])
+@login_required
+def ratings():
+    data = request.json or {}
+    try:
+        batch = [(int(web_id), int(rating)) for web_id, rating in data['ratings']]
+    except (KeyError, TypeError, ValueError):
+        response = jsonify({"error": "expected {\"ratings\": [[web_id, rating], ...]}"})
+        response.status_code = 400
+        return response
+    written = write_ratings(db.session, g.user.id, batch)
+    return jsonify({"received": len(batch), "written": written})
+
 
 @main.route('/library', methods=['GET', 'POST'])
 @login_required
 def library():
-    print g.user.books_read
-    return render_template('library.html', current_user = g.user, db=db, Book=Book)
+    return render_template('library.html', current_user = g.user, reads=user_reads(g.user.id))
 
 
 @main.route('/delete_read', methods=['GET', 'POST'])
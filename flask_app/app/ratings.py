@@ -0,0 +1,84 @@
+"""
+Batched writes of users' ratings.
+
+A batch keeps only the latest rating of each (user, book) pair and is written before
+the request returns, with one upsert statement: INSERT ... ON CONFLICT DO UPDATE on
+PostgreSQL, INSERT OR REPLACE on SQLite. Writing the same ratings again leaves the
+same rows, so a client can safely retry a batch.
+"""
+from .models import Book, Read
+
+
+## SQLite binds at most 999 parameters per statement; a row takes three
+MAX_STATEMENT_ROWS = 300
+
+UPSERTS = {
+    'postgresql': ('INSERT INTO {table} (user_id, book_id, rating) VALUES {values} '
+                   'ON CONFLICT (user_id, book_id) DO UPDATE SET rating = EXCLUDED.rating'),
+    'sqlite': 'INSERT OR REPLACE INTO {table} (user_id, book_id, rating) VALUES {values}',
+    'mysql': ('INSERT INTO {table} (user_id, book_id, rating) VALUES {values} '
+              'ON DUPLICATE KEY UPDATE rating = VALUES(rating)'),
+}
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def upsert_ratings(session, rows):
+    """
+    Insert or update the reads of rows in one statement (per MAX_STATEMENT_ROWS rows).
+    The caller commits.
+
+    Args:
+    rows: (user_id, book_id, rating) tuples; the last rating of a pair wins
+
+    Returns:
+    n_rows (int): Number of distinct (user_id, book_id) pairs written
+    """
+    ## PostgreSQL refuses to update the same row twice in one statement
+    latest = dict(((user_id, book_id), rating) for user_id, book_id, rating in rows)
+    template = UPSERTS.get(session.get_bind().dialect.name)
+    if template is None:
+        raise ValueError('no rating upsert for the {} dialect'.format(session.get_bind().dialect.name))
+    for batch in chunks(sorted(latest.items()), MAX_STATEMENT_ROWS):
+        values = ', '.join('(:user_id_{0}, :book_id_{0}, :rating_{0})'.format(i) for i in range(len(batch)))
+        params = {}
+        for i, ((user_id, book_id), rating) in enumerate(batch):
+            params['user_id_{}'.format(i)] = user_id
+            params['book_id_{}'.format(i)] = book_id
+            params['rating_{}'.format(i)] = rating
+        session.execute(template.format(table=Read.__tablename__, values=values), params)
+    return len(latest)
+
+
+def book_ids_for(session, web_ids):
+    """
+    Return web_id:Book.id for the web ids that are in the books table.
+    """
+    book_ids = {}
+    for batch in chunks(sorted(web_ids), 3 * MAX_STATEMENT_ROWS):
+        book_ids.update(session.query(Book.web_id, Book.id).filter(Book.web_id.in_(batch)).all())
+    return book_ids
+
+
+def write_ratings(session, user_id, ratings):
+    """
+    Write a user's ratings with one select of the books and one upsert, and commit.
+    Ratings of books that are not in the books table are dropped.
+
+    Args:
+    ratings: (web_id, rating) pairs; the last rating of a book wins
+
+    Returns:
+    n_rows (int): Number of reads written
+    """
+    latest = dict(ratings)
+    if not latest:
+        return 0
+    book_ids = book_ids_for(session, latest)
+    n_rows = upsert_ratings(session, [(user_id, book_ids[web_id], rating) for web_id, rating in latest.items()
+                                      if web_id in book_ids])
+    session.commit()
+    return n_rows
@@ -0,0 +1,54 @@
+"""
+Data access for the books a user has read.
+
+Each function loads what a page needs in one query and returns plain view models, so
+templates iterate over ready values instead of querying per row.
+"""
+from sqlalchemy.orm import joinedload
+
+from . import db
+from .models import Read
+
+
+class ReadView(object):
+    """
+    One book in a user's library, as the templates show it.
+    """
+    __slots__ = ('book_id', 'web_id', 'title', 'author', 'rating')
+
+    def __init__(self, book_id, web_id, title, author, rating):
+        self.book_id = book_id
+        self.web_id = web_id
+        self.title = title
+        self.author = author
+        self.rating = rating
+
+
+def user_reads(user_id):
+    """
+    Return the user's reads with their books, loaded in one joined query.
+
+    Returns:
+    reads (list of ReadView)
+    """
+    reads = (db.session.query(Read)
+             .options(joinedload(Read.book))
+             .filter(Read.user_id == user_id)
+             .all())
+    return [ReadView(book_id=read.book.id, web_id=read.book.web_id, title=read.book.title,
+                     author=read.book.author, rating=read.rating) for read in reads]
+
+
+def user_ratings(user_id, book_ids):
+    """
+    Return the user's rating of each of book_ids they have read, in one query.
+
+    Returns:
+    ratings (dict): Book.id:rating
+    """
+    if not book_ids:
+        return {}
+    rows = (db.session.query(Read.book_id, Read.rating)
+            .filter(Read.user_id == user_id, Read.book_id.in_(book_ids))
+            .all())
+    return dict(rows)
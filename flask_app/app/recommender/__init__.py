@@ -1,5 +1,10 @@
 from flask import Blueprint
+from model_holder import ModelHolder
+import recommender_data
 
 recommender = Blueprint('recommender', __name__)
 
+## Loads the recommender models in the background; started by create_app
+model_holder = ModelHolder(recommender_data.load_models, steps=recommender_data.load_steps)
+
 from . import views
\ No newline at end of file
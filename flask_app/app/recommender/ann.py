@@ -0,0 +1,197 @@
+import time
+
+import numpy as np
+
+
+def normalize_rows(vectors):
+    """
+    Scale every row to unit length (rows of zeros are left as zeros).
+    """
+    norms = np.sqrt((vectors * vectors).sum(axis=1))
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, np.newaxis]
+
+
+def item_vectors_from_components(components):
+    """
+    Turn IPCA components (n_components x n_books) into unit-length item vectors
+    (n_books x n_components), one row per dict vectorizer column.
+    """
+    return normalize_rows(np.asarray(components, dtype=np.float32).T)
+
+
+def exact_search(item_vectors, query, n, exclude=()):
+    """
+    Brute-force cosine search over every item vector; the reference for ItemIndex.
+
+    Returns:
+    columns: The n columns most similar to query, most similar first.
+    similarities: Their cosine similarities.
+    """
+    similarities = np.dot(item_vectors, query)
+    similarities[list(exclude)] = -np.inf
+    n = min(n, len(similarities))
+    top = np.argpartition(-similarities, n - 1)[:n]
+    top = top[np.argsort(-similarities[top], kind='mergesort')]
+    return top, similarities[top]
+
+
+class ExactIndex(object):
+    """
+    Brute-force search with the interface of ItemIndex, for when no index has been built.
+    The item vectors are computed once, by load_models, rather than on every query.
+    """
+    def __init__(self, item_vectors):
+        self.vectors = item_vectors
+
+    @classmethod
+    def from_components(cls, components):
+        return cls(item_vectors_from_components(components))
+
+    def vectors_for(self, columns):
+        return self.vectors[columns]
+
+    def search(self, query, n, exclude=(), n_probe=None):
+        return exact_search(self.vectors, query, n, exclude=exclude)
+
+
+class ItemIndex(object):
+    """
+    Approximate nearest-neighbour index over the book latent vectors of the IPCA model,
+    using an inverted file: books are clustered with spherical k-means, and a query only
+    scans the n_probe clusters whose centroids are closest to it.
+
+    Vectors are stored grouped by cluster, so each probed cluster is one contiguous slice.
+    """
+    def __init__(self, centroids, offsets, columns, vectors, n_probe=8):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.columns = columns
+        self.vectors = vectors
+        self.n_probe = n_probe
+        ## Where each column's vector sits in the cluster-ordered layout
+        self.positions = np.empty(len(columns), dtype=np.int64)
+        self.positions[columns] = np.arange(len(columns))
+
+    def vectors_for(self, columns):
+        """
+        Return the item vectors of the given columns.
+        """
+        return self.vectors[self.positions[columns]]
+
+    @classmethod
+    def build(cls, item_vectors, n_lists=None, n_iter=10, n_probe=8, random_state=0):
+        """
+        Cluster the item vectors and lay them out by cluster.
+
+        Args:
+        item_vectors: Unit-length item vectors, one row per column (see item_vectors_from_components).
+        n_lists: Number of clusters; defaults to about sqrt(n_items).
+        n_iter: Number of k-means iterations.
+        """
+        rng = np.random.RandomState(random_state)
+        n_items = len(item_vectors)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n_items)))
+        n_lists = min(n_lists, n_items)
+        centroids = item_vectors[rng.choice(n_items, n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = np.argmax(np.dot(item_vectors, centroids.T), axis=1)
+            for cluster in range(n_lists):
+                members = item_vectors[assignments == cluster]
+                if len(members):
+                    centroids[cluster] = members.sum(axis=0)
+                else:
+                    ## Reseed empty clusters on a random item
+                    centroids[cluster] = item_vectors[rng.randint(n_items)]
+            centroids = normalize_rows(centroids)
+        assignments = np.argmax(np.dot(item_vectors, centroids.T), axis=1)
+
+        order = np.argsort(assignments, kind='mergesort')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return cls(centroids=centroids.astype(np.float32), offsets=offsets.astype(np.int64),
+                   columns=order.astype(np.int32), vectors=np.ascontiguousarray(item_vectors[order], dtype=np.float32),
+                   n_probe=n_probe)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, columns=self.columns,
+                 vectors=self.vectors, n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path):
+        index_file = np.load(path)
+        return cls(centroids=index_file['centroids'], offsets=index_file['offsets'], columns=index_file['columns'],
+                   vectors=index_file['vectors'], n_probe=int(index_file['n_probe']))
+
+    def matches(self, components, n_samples=16):
+        """
+        Whether the index was built from these IPCA components: the same number of books
+        and dimensions, and the same vectors for a spread of sampled columns.
+        """
+        n_components, n_columns = components.shape
+        if len(self.columns) != n_columns or self.vectors.shape[1] != n_components:
+            return False
+        sample = np.linspace(0, n_columns - 1, min(n_samples, n_columns)).astype(np.intp)
+        return np.allclose(self.vectors_for(sample), item_vectors_from_components(components[:, sample]), atol=1e-4)
+
+    def search(self, query, n, exclude=(), n_probe=None):
+        """
+        Return the (approximately) n columns most similar to the unit-length query vector.
+
+        Returns:
+        columns: Up to n columns, most similar first.
+        similarities: Their cosine similarities.
+        """
+        if n_probe is None:
+            n_probe = self.n_probe
+        n_probe = min(n_probe, len(self.centroids))
+        probed = np.argpartition(-np.dot(self.centroids, query), n_probe - 1)[:n_probe]
+        candidates = np.concatenate([np.arange(self.offsets[cluster], self.offsets[cluster + 1]) for cluster in probed])
+        similarities = np.dot(self.vectors[candidates], query)
+        columns = self.columns[candidates]
+        if len(exclude):
+            keep = ~np.in1d(columns, list(exclude))
+            columns, similarities = columns[keep], similarities[keep]
+        n = min(n, len(similarities))
+        if n == 0:
+            return columns[:0], similarities[:0]
+        top = np.argpartition(-similarities, n - 1)[:n]
+        top = top[np.argsort(-similarities[top], kind='mergesort')]
+        return columns[top], similarities[top]
+
+
+def set_query(vectors):
+    """
+    Query vector for "books like this set": the normalised mean of their item vectors.
+    """
+    return normalize_rows(vectors.mean(axis=0)[np.newaxis, :])[0]
+
+
+def benchmark_recall(item_index, item_vectors, n=10, n_queries=200, n_probe_values=(1, 2, 4, 8, 16, 32), random_state=0):
+    """
+    Compare ItemIndex.search with exact_search on random single-book queries.
+
+    Returns:
+    report (list of dicts): For each n_probe, the mean recall@n and milliseconds per query,
+    with the exact search timing under n_probe None.
+    """
+    rng = np.random.RandomState(random_state)
+    queries = rng.choice(len(item_vectors), n_queries, replace=False)
+
+    exact_results = []
+    start = time.time()
+    for column in queries:
+        exact_results.append(set(exact_search(item_vectors, item_vectors[column], n, exclude=[column])[0]))
+    report = [{'n_probe': None, 'recall': 1.0, 'ms_per_query': 1000 * (time.time() - start) / n_queries}]
+
+    for n_probe in n_probe_values:
+        hits = 0
+        start = time.time()
+        approximate_results = [item_index.search(item_vectors[column], n, exclude=[column], n_probe=n_probe)[0]
+                               for column in queries]
+        elapsed = time.time() - start
+        for exact, approximate in zip(exact_results, approximate_results):
+            hits += len(exact.intersection(approximate))
+        report.append({'n_probe': n_probe, 'recall': hits / float(n * n_queries),
+                       'ms_per_query': 1000 * elapsed / n_queries})
+    return report
@@ -0,0 +1,8 @@
+"""
+Offline benchmark of the recommender: recall and hit rate on held-out reads, and
+per-stage latency, written as a JSON report that can be compared with an earlier run
+(see `manage.py benchmark`).
+"""
+from flask_app.app.recommender.benchmark.evaluation import HeldOutUser, evaluate, sample_users
+from flask_app.app.recommender.benchmark.report import (build_report, compare_reports, load_report,
+                                                        settings_differences, write_report)
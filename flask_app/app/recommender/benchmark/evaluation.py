@@ -0,0 +1,137 @@
+"""
+Held-out evaluation of Recommend.recommend_books.
+
+For each sample user, part of their reads is hidden; the rest are submitted as the
+selected books, and the held-out books found in the first collaborative window and in
+the final six recommendations are counted. Every stage is timed with a StageTimer.
+"""
+import random
+import time
+
+from flask_app.app.recommender.recommend import Recommend
+from flask_app.app.recommender.timing import StageTimer
+
+
+class HeldOutUser(object):
+    """
+    One sample user: the books submitted as selected and the books hidden from them.
+    """
+    def __init__(self, user, books_selected, held_out):
+        self.user = user
+        self.books_selected = books_selected
+        self.held_out = held_out
+
+
+def sample_users(db, User, Read, Book, book_store, vocabulary, n_users, held_out_fraction=0.2,
+                 max_selected=10, min_reads=5, seed=0):
+    """
+    Pick sample users and split their reads into selected and held-out books.
+
+    Only books both in the book store and among the model's columns count, since
+    others can be neither submitted nor recommended.
+
+    Args:
+    vocabulary: The dict vectorizer's book_id:column dict
+    n_users: Number of users to sample
+    held_out_fraction: Share of each user's usable reads to hide (at least one book)
+    max_selected: Submit at most this many of the remaining reads
+    min_reads: Only sample users with at least this many usable reads
+    seed: Seed of the sampling and of the splits, so runs are comparable
+
+    Returns:
+    held_out_users (list of HeldOutUser)
+    """
+    rng = random.Random(seed)
+    user_ids = [user_id for user_id, in
+                db.session.query(Read.user_id)
+                .group_by(Read.user_id)
+                .having(db.func.count(Read.book_id) >= min_reads)
+                .order_by(Read.user_id)
+                .all()]
+    rng.shuffle(user_ids)
+
+    held_out_users = []
+    for user_id in user_ids:
+        if len(held_out_users) == n_users:
+            break
+        web_ids = [str(web_id) for web_id, in
+                   db.session.query(Book.web_id)
+                   .join(Read, Read.book_id == Book.id)
+                   .filter(Read.user_id == user_id)
+                   .order_by(Book.web_id)
+                   .all()]
+        usable = [book_id for book_id in web_ids if book_id in book_store and book_id in vocabulary]
+        if len(usable) < max(min_reads, 2):
+            continue
+        rng.shuffle(usable)
+        n_held_out = max(1, int(round(len(usable) * held_out_fraction)))
+        held_out_users.append(HeldOutUser(user=db.session.query(User).get(user_id),
+                                          books_selected=usable[n_held_out:][:max_selected],
+                                          held_out=set(usable[:n_held_out])))
+    return held_out_users
+
+
+def evaluate(held_out_users, models, db, Read, Book, n_collab_returned=100, warmup=3):
+    """
+    Run recommend_books for every held-out user and score the results.
+
+    Args:
+    held_out_users: From sample_users
+    models: RecommenderModels to evaluate
+    n_collab_returned: Size of the collaborative window, as in the results view
+    warmup: Requests run untimed first, so one-off costs (page faults, query plans) are left out
+
+    Returns:
+    quality (dict): users evaluated, recall and hit rate of the final recommendations,
+    recall of the first collaborative window, and users who got no recommendations
+    timer (StageTimer): Seconds of each stage, plus 'total' for each request
+    """
+    timer = StageTimer()
+    for held_out_user in held_out_users[:warmup]:
+        recommend(held_out_user, models, db, Read, Book, n_collab_returned, timer=None)
+
+    recall = []
+    collab_recall = []
+    hits = 0
+    no_recommendations = 0
+    for held_out_user in held_out_users:
+        start = time.time()
+        recommended_books, collab_filter_results = recommend(held_out_user, models, db, Read, Book,
+                                                             n_collab_returned, timer=timer)
+        timer.record('total', time.time() - start)
+        if recommended_books is None:
+            no_recommendations += 1
+            recommended_books = []
+        found = held_out_user.held_out.intersection(recommended_books)
+        recall.append(len(found) / float(len(held_out_user.held_out)))
+        hits += bool(found)
+        collab_found = held_out_user.held_out.intersection(collab_filter_results or [])
+        collab_recall.append(len(collab_found) / float(len(held_out_user.held_out)))
+
+    n_users = len(held_out_users)
+    quality = {'users': n_users,
+               'recall@6': sum(recall) / max(n_users, 1),
+               'hit_rate@6': hits / float(max(n_users, 1)),
+               'collab_recall@{}'.format(n_collab_returned): sum(collab_recall) / max(n_users, 1),
+               'no_recommendations': no_recommendations}
+    return quality, timer
+
+
+def recommend(held_out_user, models, db, Read, Book, n_collab_returned, timer):
+    """
+    Recommend for one held-out user the way the results view does, without caches.
+
+    Returns:
+    recommended_books, collab_filter_results
+    """
+    recommender = Recommend(user=held_out_user.user, db=db, Read=Read, Book=Book,
+                            book_store=models.book_store, ipca_model=models.ipca_model,
+                            dict_vectorizer_fit=models.dict_vectorizer_fit, collab_start_point=0,
+                            fold_in=models.fold_in, column_catalog=models.column_catalog,
+                            keyword_matrix=models.keyword_matrix, feature_index=models.feature_index,
+                            item_index=models.item_index, timer=timer)
+    books_selected = list(held_out_user.books_selected)
+    recommended_books = recommender.recommend_books(books_selected=books_selected, features_list=[],
+                                                    books_returned=list(books_selected), up_votes=None,
+                                                    down_votes=None, n_collab_returned=n_collab_returned)
+    return recommended_books, recommender.collab_filter_results
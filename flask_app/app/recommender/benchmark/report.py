@@ -0,0 +1,87 @@
+"""
+JSON benchmark reports and their comparison between runs.
+"""
+import json
+import time
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+
+
+def latency_summary(timer):
+    """
+    Summarise the seconds of each stage of a StageTimer in milliseconds.
+
+    Returns:
+    latency_ms (dict): stage -> {'count', 'mean', 'p50', 'p95', 'p99'}
+    """
+    latency_ms = {}
+    for stage, seconds in timer.seconds.items():
+        milliseconds = np.asarray(seconds) * 1000.
+        p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+        latency_ms[stage] = {'count': len(milliseconds), 'mean': float(milliseconds.mean()),
+                             'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+    return latency_ms
+
+
+def build_report(quality, timer, settings):
+    """
+    Args:
+    quality: The quality dict returned by evaluate
+    timer: The StageTimer returned by evaluate
+    settings: What was run (users, seed, windows, artifacts, database...), so reports
+    made with different settings are not compared blindly
+    """
+    return {'format': FORMAT_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'settings': settings,
+            'quality': quality,
+            'latency_ms': latency_summary(timer)}
+
+
+def write_report(report, path):
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+def load_report(path):
+    with open(path) as report_file:
+        return json.load(report_file)
+
+
+def compare_reports(baseline, current, latency_tolerance=0.1, quality_tolerance=0.01):
+    """
+    Compare the metrics of two reports.
+
+    A stage is a regression when its p50, p95 or p99 grew by more than latency_tolerance
+    (a fraction of the baseline); a quality metric is one when it fell by more than
+    quality_tolerance (an absolute difference).
+
+    Returns:
+    rows (list of dicts): metric, baseline, current, change and whether it regressed
+    """
+    rows = []
+    for metric in sorted(set(baseline['quality']) & set(current['quality'])):
+        if metric in ('users', 'no_recommendations'):
+            continue
+        before, after = baseline['quality'][metric], current['quality'][metric]
+        rows.append({'metric': metric, 'baseline': before, 'current': after, 'change': after - before,
+                     'regressed': after < before - quality_tolerance})
+    for stage in sorted(set(baseline['latency_ms']) & set(current['latency_ms'])):
+        for percentile in ('p50', 'p95', 'p99'):
+            before = baseline['latency_ms'][stage][percentile]
+            after = current['latency_ms'][stage][percentile]
+            change = (after - before) / before if before else 0.
+            rows.append({'metric': '{} {} ms'.format(stage, percentile), 'baseline': before, 'current': after,
+                         'change': change, 'regressed': change > latency_tolerance})
+    return rows
+
+
+def settings_differences(baseline, current):
+    """
+    Return the names of the settings that differ between two reports.
+    """
+    names = set(baseline['settings']) | set(current['settings'])
+    return sorted(name for name in names if baseline['settings'].get(name) != current['settings'].get(name))
@@ -0,0 +1,264 @@
+import os
+import sys
+
+import numpy as np
+
+
+def encode_text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class StringTable(object):
+    """
+    Read-only list of strings stored as one utf-8 blob plus the offset of each string,
+    so a table of 50k strings is two arrays rather than 50k Python objects.
+    """
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [encode_text(string) for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        return cls(np.frombuffer(''.join(encoded), dtype=np.uint8), offsets)
+
+    def save(self, directory, name):
+        np.save(os.path.join(directory, name + '.npy'), self.blob)
+        np.save(os.path.join(directory, name + '_offsets.npy'), self.offsets)
+
+    @classmethod
+    def load(cls, directory, name, mmap_mode='r'):
+        return cls(np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, name + '_offsets.npy'), mmap_mode=mmap_mode))
+
+    @property
+    def nbytes(self):
+        return self.blob.nbytes + self.offsets.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tostring().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class BookRecord(object):
+    """
+    View of one row of a BookStore; nothing is copied until a field is read.
+    """
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def book_id(self):
+        return self.store.book_ids[self.row]
+
+    @property
+    def title(self):
+        return self.store.titles[self.row]
+
+    @property
+    def author(self):
+        return self.store.author(self.row)
+
+    @property
+    def description(self):
+        return self.store.descriptions[self.row]
+
+    @property
+    def keywords(self):
+        return self.store.keywords(self.row)
+
+
+class BookStore(object):
+    """
+    The book metadata (title, author, description and keyword rankings), stored
+    column-wise in flat arrays indexed by row, with a book_id:row index.
+
+    Authors are interned: author_ids holds the code of each row's author (-1 for none)
+    and authors the name of each code. Keyword rankings are kept in CSR form over
+    keyword_vocabulary; keywords_present marks the rows that had a keyword dict.
+
+    The arrays can be memory-mapped from an artifacts version (see save and load), in
+    which case forked workers share them instead of each touching 50k dicts.
+    """
+    array_names = ['author_ids', 'keywords_present', 'keyword_indptr', 'keyword_indices', 'keyword_ranks']
+    table_names = ['book_ids', 'titles', 'descriptions', 'authors', 'keyword_vocabulary']
+
+    def __init__(self, book_ids, titles, descriptions, author_ids, authors,
+                 keyword_vocabulary, keywords_present, keyword_indptr, keyword_indices, keyword_ranks):
+        self.book_ids = book_ids
+        self.titles = titles
+        self.descriptions = descriptions
+        self.author_ids = author_ids
+        self.authors = authors
+        self.keyword_vocabulary = keyword_vocabulary
+        self.keywords_present = keywords_present
+        self.keyword_indptr = keyword_indptr
+        self.keyword_indices = keyword_indices
+        self.keyword_ranks = keyword_ranks
+        self.rows = dict((str(book_id), row) for row, book_id in enumerate(book_ids))
+        self.author_names = list(authors)
+        self.author_codes = dict((author, code) for code, author in enumerate(self.author_names))
+        self.keyword_names = list(keyword_vocabulary)
+
+    @classmethod
+    def from_book_data(cls, book_data):
+        """
+        Build the store from the book_data dict of dicts.
+        """
+        book_ids = sorted(book_data)
+        author_codes = {}
+        author_ids = np.empty(len(book_ids), dtype=np.int32)
+        author_ids.fill(-1)
+        vocabulary = {}
+        keywords_present = np.zeros(len(book_ids), dtype=bool)
+        keyword_indptr = np.zeros(len(book_ids) + 1, dtype=np.int64)
+        keyword_indices = []
+        keyword_ranks = []
+        for row, book_id in enumerate(book_ids):
+            book = book_data[book_id]
+            if 'author' in book:
+                author_ids[row] = author_codes.setdefault(book['author'], len(author_codes))
+            if 'keywords' in book:
+                keywords_present[row] = True
+                for keyword, rank in book['keywords'].items():
+                    keyword_indices.append(vocabulary.setdefault(keyword, len(vocabulary)))
+                    keyword_ranks.append(rank)
+            keyword_indptr[row + 1] = len(keyword_indices)
+        return cls(book_ids=StringTable.from_strings(book_ids),
+                   titles=StringTable.from_strings([book_data[book_id].get('title', '') for book_id in book_ids]),
+                   descriptions=StringTable.from_strings([book_data[book_id].get('description', '') for book_id in book_ids]),
+                   author_ids=author_ids,
+                   authors=StringTable.from_strings(sorted(author_codes, key=author_codes.get)),
+                   keyword_vocabulary=StringTable.from_strings(sorted(vocabulary, key=vocabulary.get)),
+                   keywords_present=keywords_present, keyword_indptr=keyword_indptr,
+                   keyword_indices=np.array(keyword_indices, dtype=np.int32),
+                   keyword_ranks=np.array(keyword_ranks, dtype=np.int32))
+
+    def save(self, directory):
+        for name in self.array_names:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        for name in self.table_names:
+            getattr(self, name).save(directory, name)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        arrays = dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode))
+                      for name in cls.array_names)
+        arrays.update((name, StringTable.load(directory, name, mmap_mode)) for name in cls.table_names)
+        return cls(**arrays)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, book_id):
+        return book_id in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, book_id):
+        return BookRecord(self, self.rows[book_id])
+
+    def get(self, book_id):
+        """
+        Return the BookRecord of book_id, or None if the book is not in the store.
+        """
+        row = self.rows.get(book_id)
+        if row is None:
+            return None
+        return BookRecord(self, row)
+
+    def rows_for(self, book_ids):
+        """
+        Return the row of each book id as an array, with -1 for books not in the store.
+        """
+        return np.array([self.rows.get(book_id, -1) for book_id in book_ids], dtype=np.int64)
+
+    def author(self, row):
+        code = self.author_ids[row]
+        if code < 0:
+            return None
+        return self.author_names[code]
+
+    def keywords(self, row):
+        """
+        Return a new keyword:rank dict for the row, or None if the book had no keywords.
+        """
+        if not self.keywords_present[row]:
+            return None
+        start, stop = self.keyword_indptr[row], self.keyword_indptr[row + 1]
+        return dict((self.keyword_names[index], int(rank)) for index, rank
+                    in zip(self.keyword_indices[start:stop], self.keyword_ranks[start:stop]))
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held by the arrays and string tables (mapped or not).
+        """
+        return (sum(getattr(self, name).nbytes for name in self.array_names) +
+                sum(getattr(self, name).nbytes for name in self.table_names))
+
+
+def deep_getsizeof(value, seen=None):
+    """
+    Approximate bytes held by a nest of dicts, lists and strings, counting shared objects once.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_getsizeof(key, seen) + deep_getsizeof(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(deep_getsizeof(item, seen) for item in value)
+    return size
+
+
+def memory_report(book_store, book_data=None):
+    """
+    Compare the memory held by a BookStore with the book_data dict it replaces.
+
+    Returns:
+    report (dict): Bytes held by the store's arrays, by its Python-object indexes
+    (rows, author and keyword names), their total, the number of Python objects those
+    indexes hold, and, when book_data is given, the dict's bytes and object count.
+    """
+    index_bytes = (deep_getsizeof(book_store.rows) + deep_getsizeof(book_store.author_codes) +
+                   deep_getsizeof(book_store.keyword_names))
+    report = {'books': len(book_store),
+              'store_array_bytes': book_store.nbytes,
+              'store_index_bytes': index_bytes,
+              'store_total_bytes': book_store.nbytes + index_bytes,
+              'store_objects': 2 * len(book_store.rows) + 2 * len(book_store.author_codes) + len(book_store.keyword_names)}
+    if book_data is not None:
+        report['book_data_bytes'] = deep_getsizeof(book_data)
+        report['book_data_objects'] = count_objects(book_data)
+    return report
+
+
+def count_objects(value):
+    """
+    Number of Python objects reachable through dicts and lists, i.e. the refcounts a
+    forked worker may write to (and so copy the pages of) when it walks them.
+    """
+    count = 1
+    if isinstance(value, dict):
+        count += sum(count_objects(key) + count_objects(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        count += sum(count_objects(item) for item in value)
+    return count
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """
+    Bounded LRU cache with a time-to-live per entry and a cap on the memory held.
+
+    Values report their own size through the nbytes passed to set(). Entries are
+    evicted least recently used first whenever max_entries or max_bytes would be
+    exceeded, and dropped on lookup once older than ttl seconds.
+    """
+    def __init__(self, max_entries=512, max_bytes=64 * 1024 * 1024, ttl=600, clock=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, nbytes, value = entry
+            if expires < self.clock():
+                self.nbytes -= nbytes
+                self.expirations += 1
+                self.misses += 1
+                return None
+            ## Re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, nbytes):
+        """
+        Cache value under key. Values larger than max_bytes are not cached.
+        """
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.nbytes -= old_entry[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.entries and (len(self.entries) >= self.max_entries or self.nbytes + nbytes > self.max_bytes):
+                evicted_key, (expires, evicted_nbytes, evicted_value) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+            self.entries[key] = (self.clock() + self.ttl, nbytes, value)
+            self.nbytes += nbytes
+
+    def stats(self):
+        """
+        Return the counters and current size of the cache.
+        """
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.nbytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations}
+
+
+def ranking_key(user_id, books_selected, up_votes, down_votes, features_list, ratings=()):
+    """
+    Normalised cache key for a collaborative ranking: it depends on the user and on
+    which books, votes and features were sent, not on their order, and on the ratings
+    of the selection when those are used (see Recommend.ratings_key).
+    """
+    return (user_id, tuple(sorted(books_selected or [])), tuple(sorted(up_votes or [])),
+            tuple(sorted(down_votes or [])), tuple(sorted(features_list or [])), ratings)
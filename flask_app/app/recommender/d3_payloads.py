@@ -0,0 +1,86 @@
+"""
+The D3 keyword payload of each book, serialised once and served as bytes.
+
+A book's payload (its title, author, description and the keyword tree the circle pack
+draws) only changes with the book data, so it is serialised a single time, either by
+export_artifacts into two string tables mapped with the rest of the artifacts, or the
+first time it is asked for, and kept with a strong ETag. Later requests for the book
+are answered from those bytes, or with a 304, without building any dicts or lists.
+"""
+import hashlib
+import json
+
+from book_store import StringTable
+from recommend import format_keywords_for_d3, get_book_info
+
+
+def d3_payload(book_store, book_id):
+    """
+    Return the JSON bytes of a book's D3 payload, as keywords_to_d3 has always sent it.
+    """
+    keywords = format_keywords_for_d3(book_store[book_id].keywords or {})
+    payload = {"book_info": get_book_info(book_id, book_store),
+               "d3_info": {'name': 'flare', "children": [{'name': 'cluster', 'children': keywords}]}}
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def payload_etag(body):
+    ## Strong validator: equal tags mean byte-identical bodies
+    return '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+
+
+class D3Payloads(object):
+    """
+    book_id -> (etag, body) for every book of a BookStore.
+
+    With tables from the artifacts (see build_tables) the bytes are sliced from the
+    mapped blobs; otherwise each payload is built on its first request and kept for the
+    life of the process.
+    """
+    def __init__(self, book_store, payloads=None, etags=None):
+        self.book_store = book_store
+        self.payloads = payloads
+        self.etags = etags
+        self.built = {}
+        if payloads is not None:
+            ## Slicing a buffer over the mapped blob gives the bytes directly, without the
+            ## array views (and copies) that slicing the memmap would make
+            self.payload_buffer = buffer(payloads.blob)
+            self.etag_buffer = buffer(etags.blob)
+
+    @staticmethod
+    def build_tables(book_store):
+        """
+        Serialise the payload of every book, in BookStore row order.
+
+        Returns:
+        payloads (StringTable): JSON body of each row
+        etags (StringTable): ETag of each row
+        """
+        book_ids = [None] * len(book_store)
+        for book_id, row in book_store.rows.items():
+            book_ids[row] = book_id
+        bodies = [d3_payload(book_store, book_id) for book_id in book_ids]
+        return StringTable.from_strings(bodies), StringTable.from_strings([payload_etag(body) for body in bodies])
+
+    def get(self, book_id):
+        """
+        Return (etag, body) for book_id, or None if the book is not in the store.
+        """
+        row = self.book_store.rows.get(book_id)
+        if row is None:
+            return None
+        if self.payloads is not None:
+            etag = self.etag_buffer[self.etags.offsets.item(row):self.etags.offsets.item(row + 1)]
+            return etag, self.payload_buffer[self.payloads.offsets.item(row):self.payloads.offsets.item(row + 1)]
+        entry = self.built.get(row)
+        if entry is None:
+            body = d3_payload(self.book_store, book_id)
+            entry = self.built[row] = (payload_etag(body), body)
+        return entry
+
+    @property
+    def nbytes(self):
+        if self.payloads is not None:
+            return self.payloads.nbytes + self.etags.nbytes
+        return sum(len(etag) + len(body) for etag, body in self.built.values())
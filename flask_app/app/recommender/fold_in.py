@@ -0,0 +1,161 @@
+import numpy as np
+from scipy import sparse
+
+
+class FoldIn(object):
+    """
+    Sparse fold-in of an end-user rating vector into a fitted IPCA model.
+
+    The IPCA transform is (x - mean) . components.T, which for a user who rated a
+    handful of books only needs the rated columns of components plus the projection
+    of the mean (computed once here). Scores are then rebuilt with a single
+    latent . components product, matching ipca_model.inverse_transform(ipca_model.transform(x)).
+    """
+    def __init__(self, components, mean, explained_variance=None, whiten=False):
+        self.components = components
+        self.mean = mean
+        self.n_components, self.n_columns = components.shape
+        if whiten:
+            self.scale = np.sqrt(explained_variance)
+        else:
+            self.scale = None
+        ## Projection of the mean offset, shared by every fold-in
+        self.mean_projection = np.dot(components, mean)
+
+    @classmethod
+    def from_model(cls, ipca_model):
+        """
+        Build the fold-in engine from a fitted IncrementalPCA model.
+        """
+        return cls(components=ipca_model.components_, mean=ipca_model.mean_,
+                   explained_variance=getattr(ipca_model, 'explained_variance_', None),
+                   whiten=getattr(ipca_model, 'whiten', False))
+
+    def rated_columns(self, enduser_vector):
+        """
+        Return the column indices and values of the non-zero ratings in a single
+        end-user vector, as produced by the dict vectorizer (sparse or dense).
+        """
+        if sparse.issparse(enduser_vector):
+            row = enduser_vector.tocsr()
+            columns = row.indices[row.indptr[0]:row.indptr[1]]
+            values = row.data[row.indptr[0]:row.indptr[1]]
+        else:
+            row = np.asarray(enduser_vector).ravel()
+            columns = np.flatnonzero(row)
+            values = row[columns]
+        return columns, values.astype(np.float64)
+
+    def project(self, columns, values):
+        """
+        Project a user's ratings onto the latent components using only the rated columns.
+
+        Args:
+        columns: The column indices of the rated books.
+        values: The ratings, in the same order as columns.
+
+        Returns:
+        latent: The user's latent vector (n_components,).
+        """
+        latent = np.dot(self.components[:, columns], values) - self.mean_projection
+        if self.scale is not None:
+            latent /= self.scale
+        return latent
+
+    def project_batch(self, enduser_matrix):
+        """
+        Project many users at once. enduser_matrix holds one user per row, ideally
+        as a scipy sparse matrix, so the whole batch is one sparse-dense product.
+
+        Returns:
+        latent: Array of latent vectors (n_users, n_components).
+        """
+        if sparse.issparse(enduser_matrix):
+            latent = sparse.csr_matrix(enduser_matrix).dot(self.components.T)
+        else:
+            latent = np.dot(enduser_matrix, self.components.T)
+        latent -= self.mean_projection
+        if self.scale is not None:
+            latent /= self.scale
+        return latent
+
+    def reconstruct(self, latent):
+        """
+        Turn a latent user vector (or one per row) back into predicted ratings for every column.
+        """
+        if self.scale is not None:
+            latent = latent * self.scale
+        return np.dot(latent, self.components) + self.mean
+
+    def fold_in(self, enduser_vector):
+        """
+        Predict the filled-in ratings for a single end-user vector.
+        """
+        columns, values = self.rated_columns(enduser_vector)
+        return self.reconstruct(self.project(columns, values))
+
+    def fold_in_batch(self, enduser_matrix):
+        """
+        Predict the filled-in ratings for every user (row) of enduser_matrix.
+        """
+        return self.reconstruct(self.project_batch(enduser_matrix))
+
+    def update(self, latent, columns, deltas):
+        """
+        Return latent after changing the ratings in `columns` by `deltas`. The projection is
+        linear in the ratings, so each changed rating is a rank-one update with its column
+        of components; no other column is touched.
+        """
+        step = np.dot(self.components[:, columns], deltas)
+        if self.scale is not None:
+            step /= self.scale
+        return latent + step
+
+
+class LatentState(object):
+    """
+    An end-user's latent vector together with the ratings (by dict vectorizer column)
+    it was projected from. Kept between requests so a vote only moves the latent
+    vector by the changed columns instead of re-projecting every rating.
+
+    base_ratings are the ratings of the selected books, before any votes.
+    """
+    def __init__(self, fold_in, base_ratings, ratings, latent):
+        self.fold_in = fold_in
+        self.base_ratings = base_ratings
+        self.ratings = ratings
+        self.latent = latent
+
+    @classmethod
+    def from_ratings(cls, fold_in, vocabulary, ratings_dict):
+        """
+        Project a book_id:rating dict from scratch. Books unknown to the vocabulary are dropped.
+        """
+        base_ratings = dict((vocabulary[book_id], rating) for book_id, rating in ratings_dict.items()
+                            if book_id in vocabulary)
+        columns = np.array(list(base_ratings), dtype=np.intp)
+        values = np.array([base_ratings[column] for column in columns], dtype=np.float64)
+        return cls(fold_in, base_ratings, dict(base_ratings), fold_in.project(columns, values))
+
+    @property
+    def nbytes(self):
+        return self.latent.nbytes + 64 * len(self.ratings)
+
+    def with_ratings(self, ratings):
+        """
+        Return a new state for `ratings` (column:rating), updated from this one.
+        """
+        changed = [column for column in set(ratings) | set(self.ratings)
+                   if ratings.get(column, 0) != self.ratings.get(column, 0)]
+        latent = self.latent
+        if changed:
+            deltas = np.array([ratings.get(column, 0) - self.ratings.get(column, 0) for column in changed],
+                              dtype=np.float64)
+            latent = self.fold_in.update(latent, np.array(changed, dtype=np.intp), deltas)
+        return LatentState(self.fold_in, self.base_ratings, ratings, latent)
+
+    def scores(self):
+        """
+        Predicted ratings for every column: one mat-vec from the latent vector.
+        """
+        return self.fold_in.reconstruct(self.latent)
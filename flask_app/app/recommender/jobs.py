@@ -0,0 +1,245 @@
+"""
+Recommendation jobs run on a local process pool instead of in the request thread.
+
+The web process writes each job to a jobs directory and hands it to a
+multiprocessing.Pool; the worker writes the result next to the job. Any web worker
+can then answer polls for any job by reading the directory, with no broker in between.
+
+Each job has a deadline. A pool worker that dies takes its job with it and never
+reports back, so a job still queued or running past its deadline is reported as failed
+(and one that reaches a worker after it is not run).
+
+The pool is forked by create_app, before the model loader or any request thread
+exists, so no lock can be held by another thread at fork time. Each pool worker then
+loads its own models in the initializer (the mapped artifacts are shared through the
+page cache).
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+from cache import ResultCache
+from metrics import registry
+from recommend import Recommend
+
+
+class JobUser(object):
+    """
+    Stands in for the logged-in user in a pool worker: Recommend only needs the id.
+    """
+    def __init__(self, id):
+        self.id = id
+
+
+## Set in each pool worker by init_worker
+worker_models = None
+worker_error = None
+worker_caches = None
+worker_timer = None
+
+
+def init_worker(load_models, metrics):
+    """
+    Load this pool worker's models. A failure is kept and reported by every job rather
+    than raised, which would make the pool restart the worker forever.
+    """
+    global worker_models, worker_error, worker_caches, worker_timer
+    try:
+        worker_models = load_models()
+    except Exception as error:
+        worker_error = '{}: {}'.format(type(error).__name__, error)
+    worker_caches = {'RANKING_CACHE': ResultCache(max_entries=512, max_bytes=64 * 1024 * 1024, ttl=600),
+                     'LATENT_CACHE': ResultCache(max_entries=4096, max_bytes=16 * 1024 * 1024, ttl=1800)}
+    ## The same choice as stage_timer in the web process
+    worker_timer = registry if metrics else None
+
+
+def write_json(path, record):
+    with open(path + '.tmp', 'w') as record_file:
+        json.dump(record, record_file)
+    os.rename(path + '.tmp', path)
+
+
+def run_job(job):
+    """
+    Run one job in a pool worker and write its record with the result or the error.
+
+    Returns:
+    record (dict): The finished job record
+    """
+    record = dict(job)
+    record['state'] = 'running'
+    record['started_at'] = time.time()
+    write_json(job['path'], record)
+    try:
+        if record['started_at'] > job['deadline']:
+            raise RuntimeError(DEADLINE_ERROR)
+        if worker_models is None:
+            raise RuntimeError('the pool worker could not load the models ({})'.format(worker_error))
+        models = worker_models
+        request = job['request']
+        recommender = Recommend(user=JobUser(job['user_id']), Read=None, Book=None, db=None,
+                                book_store=models.book_store, ipca_model=models.ipca_model,
+                                dict_vectorizer_fit=models.dict_vectorizer_fit,
+                                collab_start_point=request['collab_start_point'], fold_in=models.fold_in,
+                                column_catalog=models.column_catalog, keyword_matrix=models.keyword_matrix,
+                                feature_index=models.feature_index, item_index=models.item_index,
+                                ranking_cache=worker_caches['RANKING_CACHE'],
+                                latent_cache=worker_caches['LATENT_CACHE'], timer=worker_timer,
+                                use_ratings=job['selection_ratings'] is not None,
+                                selection_ratings=job['selection_ratings'])
+        recommended_books = recommender.recommend_books(books_selected=request['books_selected'],
+                                                        features_list=request['features_list'],
+                                                        books_returned=request['books_returned'],
+                                                        up_votes=request['up_votes'], down_votes=request['down_votes'],
+                                                        n_collab_returned=100)
+        record['result'] = {"recommendations": recommended_books, "collab_returned": recommender.collab_returned}
+        record['state'] = 'done'
+    except Exception as error:
+        record['error'] = '{}: {}'.format(type(error).__name__, error)
+        record['state'] = 'failed'
+    record['finished_at'] = time.time()
+    write_json(job['path'], record)
+    if worker_timer is not None:
+        registry.maybe_flush()
+    return record
+
+
+class JobQueue(object):
+    """
+    The pool of this web process and the directory its jobs are kept in.
+
+    Finished jobs are kept for ttl seconds, then removed by the next submit.
+    """
+    def __init__(self, directory, load_models, processes=2, ttl=600, timeout=120, metrics=True):
+        """
+        Args:
+        load_models: Callable returning the models, run once in each pool worker
+        timeout: Seconds from submission after which an unfinished job is failed
+        metrics: Whether pool workers time the stages into the metrics registry
+        """
+        self.directory = directory
+        self.load_models = load_models
+        self.processes = processes
+        self.ttl = ttl
+        self.timeout = timeout
+        self.metrics = metrics
+        self.pool = None
+        self.pid = None
+        ## job_id -> deadline of the jobs this process submitted and has not heard back from
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_purge = 0.
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self):
+        """
+        Fork the pool, once per web process. create_app calls this while the process has
+        no other thread; submit only starts it for a process forked after that (e.g. a
+        server that preloads the app), where it is the best that can be done.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pool = multiprocessing.Pool(self.processes, initializer=init_worker,
+                                             initargs=(self.load_models, self.metrics))
+            self.pid = os.getpid()
+            self.pending = {}
+
+    def path(self, job_id):
+        return os.path.join(self.directory, '{}.json'.format(job_id))
+
+    def submit(self, user_id, request, selection_ratings=None):
+        """
+        Queue a recommendation and return its job id.
+
+        Args:
+        request: The recommend_books arguments, as parsed from /recommendations/results
+        selection_ratings: web_id:rating of the selection when real ratings are used
+        (read here, since pool workers have no database session)
+        """
+        self.start()
+        self.purge()
+        job_id = uuid.uuid4().hex
+        enqueued_at = time.time()
+        job = {'job_id': job_id, 'user_id': user_id, 'request': request, 'selection_ratings': selection_ratings,
+               'state': 'queued', 'enqueued_at': enqueued_at, 'deadline': enqueued_at + self.timeout,
+               'path': self.path(job_id)}
+        write_json(job['path'], job)
+        with self.lock:
+            self.pending[job_id] = job['deadline']
+        self.pool.apply_async(run_job, (job,), callback=self.finished)
+        return job_id
+
+    def finished(self, record):
+        ## Runs on the pool's result thread of the web process
+        with self.lock:
+            self.pending.pop(record['job_id'], None)
+        if self.metrics:
+            registry.observe('recommender_job_wait_seconds', record['started_at'] - record['enqueued_at'])
+            registry.observe('recommender_job_run_seconds', record['finished_at'] - record['started_at'])
+
+    def get(self, job_id, user_id):
+        """
+        Return the record of a job of this user, or None if there is no such job.
+        """
+        try:
+            with open(self.path(job_id)) as record_file:
+                record = json.load(record_file)
+        except (IOError, ValueError):
+            return None
+        if record['user_id'] != user_id:
+            return None
+        return check_deadline(record)
+
+    def purge(self):
+        now = time.time()
+        if now - self.last_purge < self.ttl:
+            return
+        self.last_purge = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < now - self.ttl:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def stats(self):
+        ## Jobs past their deadline are lost or failed either way, so they stop counting
+        now = time.time()
+        with self.lock:
+            for job_id, deadline in self.pending.items():
+                if deadline < now:
+                    del self.pending[job_id]
+            return {'gauges': {'recommender_job_queue_depth': len(self.pending)}}
+
+
+DEADLINE_ERROR = 'the job did not finish before its deadline'
+
+
+def check_deadline(record):
+    """
+    Return the record, as failed if it is still queued or running past its deadline.
+    """
+    if record['state'] in ('queued', 'running') and time.time() > record['deadline']:
+        record = dict(record, state='failed', error=DEADLINE_ERROR)
+    return record
+
+
+def job_status(record):
+    """
+    The part of a job record sent to the client.
+    """
+    status = {'job_id': record['job_id'], 'state': record['state']}
+    if record['state'] == 'done':
+        status['result'] = record['result']
+    elif record['state'] == 'failed':
+        status['error'] = record['error']
+    if record.get('started_at'):
+        status['wait_seconds'] = round(record['started_at'] - record['enqueued_at'], 4)
+    return status
@@ -0,0 +1,196 @@
+"""
+Offline pipeline that turns raw book records (keyword:count dicts scraped from
+goodreads shelves) into engineered_book_data: keywords merged through the keyword
+conversion dict and ranked 20..1 by count.
+
+Records are streamed in bounded batches through a process pool and written out as
+they come back, so the raw and engineered data are never both held in full.
+"""
+import json
+import multiprocessing
+import pickle
+import time
+
+
+N_TOP_KEYWORDS = 20
+
+
+def make_aggregated_and_filtered_keyword_count_dict(keyword_conversion_dict, keywords):
+    '''
+    Take a keyword count dict and combine similar keywords based on keyword_conversion_dict, while filtering
+    those not included in the conversion dict.
+    '''
+    new_keyword_dict = {}
+    for keyword in keywords:
+        if keyword in keyword_conversion_dict:
+            true_label = keyword_conversion_dict[keyword]
+            new_keyword_dict[true_label] = int(new_keyword_dict.get(true_label, 0)) + int(keywords[keyword])
+    return new_keyword_dict
+
+
+def make_top_keyword_ranking_dict(keywords, keyword_conversion_dict):
+    '''
+    Make a dictionary with keywords as keys and a value of the rank of the keyword
+    based on the count number
+
+    Arguments
+    keywords: the raw keyword:count dict of one book
+    returns: a dictionary of keyword:ranking, 20 for the most counted keyword
+
+    '''
+    ## Remove uninformative keywords and sort based on count, most counted first
+    ## (ties by keyword, so every worker ranks the same way)
+    filtered_keywords = make_aggregated_and_filtered_keyword_count_dict(keyword_conversion_dict, keywords)
+    rank_list = sorted(filtered_keywords, key=lambda k: (-filtered_keywords[k], k))
+
+    ## Rank the top 20 keywords based on order
+    rank_dict = {}
+    for count, keyword in enumerate(rank_list[:N_TOP_KEYWORDS]):
+        rank_dict[keyword] = N_TOP_KEYWORDS - count
+    return rank_dict
+
+
+def engineer_book(book, keyword_conversion_dict):
+    '''
+    Return a copy of a raw book record with its keywords engineered (records without
+    keywords are returned unchanged).
+    '''
+    if 'keywords' not in book:
+        return book
+    engineered_book = dict(book)
+    engineered_book['keywords'] = make_top_keyword_ranking_dict(book['keywords'], keyword_conversion_dict)
+    return engineered_book
+
+
+## Set in each worker process by init_worker, so the conversion dict is sent once per worker
+worker_conversion_dict = None
+
+
+def init_worker(keyword_conversion_dict):
+    global worker_conversion_dict
+    worker_conversion_dict = keyword_conversion_dict
+
+
+def engineer_record(record):
+    book_id, book = record
+    return book_id, engineer_book(book, worker_conversion_dict)
+
+
+def read_records(path):
+    """
+    Yield (book_id, book) records from a .jsonl file (one {"book_id": ..., ...} object per
+    line) or from a pickled book_data dict. Records are popped from the pickled dict as
+    they are handed out, so it shrinks while the output grows.
+    """
+    if path.endswith('.jsonl'):
+        with open(path) as records_file:
+            for line in records_file:
+                if line.strip():
+                    book = json.loads(line)
+                    yield str(book.pop('book_id')), book
+    else:
+        with open(path, 'r') as picklefile:
+            book_data = pickle.load(picklefile)
+        while book_data:
+            yield book_data.popitem()
+
+
+class RecordWriter(object):
+    """
+    Write (book_id, book) records to .jsonl as they arrive, or collect them into one
+    book_data dict pickled on close.
+    """
+    def __init__(self, path):
+        self.path = path
+        if path.endswith('.jsonl'):
+            self.records_file = open(path, 'w')
+            self.book_data = None
+        else:
+            self.records_file = None
+            self.book_data = {}
+
+    def write(self, book_id, book):
+        if self.book_data is not None:
+            self.book_data[book_id] = book
+        else:
+            record = dict(book)
+            record['book_id'] = book_id
+            self.records_file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.book_data is not None:
+            with open(self.path, 'w') as picklefile:
+                pickle.dump(self.book_data, picklefile)
+        else:
+            self.records_file.close()
+
+
+def load_conversion_dict(path):
+    """
+    Load the keyword conversion dict (raw keyword -> engineered keyword) from .json or a pickle.
+    """
+    with open(path, 'r') as conversion_file:
+        if path.endswith('.json'):
+            return json.load(conversion_file)
+        return pickle.load(conversion_file)
+
+
+def batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_batch(writer, records):
+    for book_id, book in records:
+        writer.write(book_id, book)
+    return len(records)
+
+
+def engineer_keywords(input_path, output_path, keyword_conversion_dict, processes=None, batch_size=2000,
+                      report_every=10000):
+    '''
+    Engineer the keywords of every book in input_path and write them to output_path.
+
+    Arguments
+    input_path, output_path: .jsonl files or book_data pickles (see read_records and RecordWriter)
+    keyword_conversion_dict: raw keyword -> engineered keyword
+    processes: worker processes (default: one per CPU)
+    batch_size: records in flight at once; bounds the memory used by the pipeline
+    report_every: print progress every this many books
+
+    Returns
+    n_books, books_per_second
+    '''
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(keyword_conversion_dict,))
+    writer = RecordWriter(output_path)
+    n_books = 0
+    next_report = report_every
+    start = time.time()
+    ## Keep two batches in flight: the workers engineer one while the previous one is written
+    in_flight = None
+    try:
+        for batch in batches(read_records(input_path), batch_size):
+            result = pool.map_async(engineer_record, batch, chunksize=max(1, batch_size / 32))
+            if in_flight is not None:
+                n_books += write_batch(writer, in_flight.get())
+            in_flight = result
+            if n_books >= next_report:
+                print '{:,} books, {:,.0f} books/sec'.format(n_books, n_books / (time.time() - start))
+                next_report += report_every
+        if in_flight is not None:
+            n_books += write_batch(writer, in_flight.get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    writer.close()
+    books_per_second = n_books / max(time.time() - start, 1e-9)
+    return n_books, books_per_second
@@ -0,0 +1,125 @@
+import numpy as np
+from scipy import sparse
+
+
+class KeywordMatrix(object):
+    """
+    The keyword rankings of every book in the BookStore, as one CSR matrix over
+    the store's keyword vocabulary (one row per store row, one column per keyword).
+
+    Built once at startup so the similarity stage can compare candidate books to
+    the end-user's preference with sparse row slices instead of DataFrames.
+    """
+    def __init__(self, book_store):
+        ## Only books that had a keyword dict can be compared
+        self.rows = dict((book_id, row) for book_id, row in book_store.rows.items()
+                         if book_store.keywords_present[row])
+        self.vocabulary = dict((keyword, column) for column, keyword in enumerate(book_store.keyword_names))
+        shape = (len(book_store.keyword_indptr) - 1, len(self.vocabulary))
+        data = np.asarray(book_store.keyword_ranks, dtype=np.float64)
+        indices = np.array(book_store.keyword_indices, dtype=np.int32)
+        indptr = np.array(book_store.keyword_indptr, dtype=np.int32)
+        self.ranks = sparse.csr_matrix((data, indices, indptr), shape=shape)
+        ## Every listed keyword is a column, but only non-zero ranks count as the book having it
+        self.listed = sparse.csr_matrix((np.ones(len(data)), indices, indptr), shape=shape)
+        self.presence = sparse.csr_matrix(((data != 0).astype(np.float64), indices.copy(), indptr.copy()), shape=shape)
+        self.presence.eliminate_zeros()
+        self.n_present = np.diff(self.presence.indptr)
+
+    def user_vector(self, preference):
+        """
+        Place a keyword:rank dict (e.g. user_preference['user']) in the keyword space.
+
+        Returns:
+        columns: Vocabulary columns of every keyword in the preference.
+        present: The subset of columns whose rank is non-zero.
+        n_unknown: How many keywords are not in the vocabulary; no book shares them.
+        n_unknown_present: How many of those have a non-zero rank.
+        """
+        columns = []
+        present = []
+        n_unknown = 0
+        n_unknown_present = 0
+        for keyword, rank in preference.items():
+            column = self.vocabulary.get(keyword)
+            if column is None:
+                n_unknown += 1
+                n_unknown_present += rank != 0
+                continue
+            columns.append(column)
+            if rank != 0:
+                present.append(column)
+        return (np.array(columns, dtype=np.int32), np.array(present, dtype=np.int32),
+                n_unknown, n_unknown_present)
+
+    def matching_distances(self, book_ids, preference):
+        """
+        Matching (normalised Hamming) distance between the keyword set of each
+        book and the preference, over the union of their keywords. This is what
+        NearestNeighbors(metric='matching') computed on the zero-filled DataFrame
+        of the books and the preference.
+
+        Args:
+        book_ids: Ids of books present in self.rows.
+        preference: A keyword:rank dict.
+
+        Returns:
+        distances: Array with one distance per book id.
+        """
+        rows = np.array([self.rows[book_id] for book_id in book_ids], dtype=np.intp)
+        columns, present, n_unknown, n_unknown_present = self.user_vector(preference)
+
+        ## Columns of the DataFrame the books and the preference would have made
+        n_columns = len(np.union1d(self.listed[rows].indices, columns)) + n_unknown
+        if n_columns == 0:
+            return np.zeros(len(rows))
+
+        user_presence = np.zeros(self.presence.shape[1])
+        user_presence[present] = 1.0
+        shared = self.presence[rows].dot(user_presence)
+        mismatches = self.n_present[rows] + (len(present) + n_unknown_present) - 2 * shared
+        return mismatches / float(n_columns)
+
+
+class FeatureIndex(object):
+    """
+    Inverted index from keyword to the sorted dict vectorizer columns of the books
+    listing that keyword, so feature constraints can be applied to the collaborative
+    scores before ranking rather than to the ranked books afterwards.
+    """
+    def __init__(self, book_names, book_store):
+        rows = book_store.rows_for(book_names)
+        columns = np.flatnonzero(rows >= 0)
+        rows = rows[columns]
+        columns = columns[book_store.keywords_present[rows]]
+        rows = rows[book_store.keywords_present[rows]]
+        ## One (keyword, column) pair per keyword listed by each column's book
+        starts = book_store.keyword_indptr[rows]
+        lengths = book_store.keyword_indptr[rows + 1] - starts
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        pair_keywords = np.asarray(book_store.keyword_indices)[np.repeat(starts, lengths) + offsets]
+        pair_columns = np.repeat(columns, lengths).astype(np.int32)
+        ## A stable sort by keyword keeps each posting list in column order
+        order = np.argsort(pair_keywords, kind='mergesort')
+        pair_keywords, pair_columns = pair_keywords[order], pair_columns[order]
+        bounds = np.flatnonzero(np.diff(pair_keywords)) + 1
+        self.postings = {}
+        if len(pair_keywords):
+            for keyword, posting in zip(pair_keywords[np.concatenate([[0], bounds])], np.split(pair_columns, bounds)):
+                self.postings[book_store.keyword_names[keyword]] = posting
+
+    def columns_with(self, features_list):
+        """
+        Return the sorted columns of the books that have every feature in features_list,
+        or None when there are no features to apply.
+        """
+        if not features_list:
+            return None
+        empty = np.empty(0, dtype=np.int32)
+        postings = sorted((self.postings.get(feature, empty) for feature in set(features_list)), key=len)
+        columns = postings[0]
+        for posting in postings[1:]:
+            if not len(columns):
+                break
+            columns = np.intersect1d(columns, posting, assume_unique=True)
+        return columns
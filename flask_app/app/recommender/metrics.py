@@ -0,0 +1,308 @@
+"""
+Per-process histograms and counters of the recommender, exposed as Prometheus text.
+
+Each worker records into its own MetricsRegistry (a few counter increments under a
+lock per observation, nothing else until a scrape). When a snapshot directory is
+configured, workers write their totals there at most every flush_interval seconds,
+and /metrics sums the snapshots of every worker; without one, /metrics reports the
+worker that answered.
+
+Only live workers count: the snapshot of a process that has exited is removed (an
+idle worker keeps counting, however old its snapshot, so the summed counters never
+go down while it lives). Workers also remove their own snapshot when they exit.
+"""
+import atexit
+import bisect
+import errno
+import json
+import os
+import threading
+import time
+
+from timing import TimedStage
+
+
+## Upper bounds of the histogram buckets; +Inf is implied
+SECONDS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.]
+WINDOW_BUCKETS = [1, 2, 3, 5, 10, 20, 39]
+
+HISTOGRAMS = {
+    'recommender_stage_seconds': ('Seconds spent in each stage of a recommendation', SECONDS_BUCKETS),
+    'recommender_db_query_seconds': ('Seconds spent in each database query', SECONDS_BUCKETS),
+    'recommender_similarity_windows': ('Collaborative windows pulled by the similarity stage per request '
+                                       '(40 when it gave up)', WINDOW_BUCKETS),
+    'recommender_job_wait_seconds': ('Seconds recommendation jobs waited for a pool worker', SECONDS_BUCKETS),
+    'recommender_job_run_seconds': ('Seconds pool workers spent on a recommendation job', SECONDS_BUCKETS),
+}
+
+CACHE_COUNTERS = ['hits', 'misses', 'evictions', 'expirations']
+CACHE_GAUGES = ['entries', 'bytes']
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    """
+    The histograms of this process, plus collectors called at snapshot time (e.g. for
+    cache statistics).
+
+    record and stage give the registry the StageTimer interface, so it can be passed
+    to Recommend as its timer; stages go to recommender_stage_seconds.
+    """
+    def __init__(self, flush_interval=5.):
+        self.flush_interval = flush_interval
+        self.directory = None
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.histograms = {}
+        self.last_flush = 0.
+
+    def configure(self, directory=None, flush_interval=None):
+        """
+        Args:
+        directory: Where workers write their snapshots for /metrics to sum (None: this process only)
+        flush_interval: Seconds between snapshot writes
+        """
+        if directory is not None and self.directory is None:
+            atexit.register(self.remove_snapshot)
+        self.directory = directory
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def add_collector(self, collector):
+        """
+        Register a callable returning {'caches': {name: ResultCache.stats()}} and/or
+        {'gauges': {name: value}}, read at snapshot time.
+        """
+        self.collectors.append(collector)
+
+    def check_fork(self):
+        ## A forked worker starts from zero rather than from its parent's totals
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.histograms = {}
+            self.last_flush = 0.
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.check_fork()
+            key = (name, labels_key(labels))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+    def record(self, stage, seconds):
+        self.observe('recommender_stage_seconds', seconds, stage=stage)
+
+    def stage(self, name):
+        return TimedStage(self, name)
+
+    def snapshot(self):
+        """
+        Return this process's totals as a JSON-serialisable dict.
+        """
+        with self.lock:
+            self.check_fork()
+            histograms = [{'name': name, 'labels': dict(labels), 'counts': list(histogram.counts),
+                           'sum': histogram.sum, 'count': histogram.count}
+                          for (name, labels), histogram in self.histograms.items()]
+        caches = {}
+        gauges = {}
+        for collector in self.collectors:
+            collected = collector()
+            caches.update(collected.get('caches', {}))
+            gauges.update(collected.get('gauges', {}))
+        return {'pid': os.getpid(), 'time': time.time(), 'histograms': histograms, 'caches': caches,
+                'gauges': gauges}
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, '{}.json'.format(os.getpid()))
+
+    def flush(self):
+        """
+        Write this process's snapshot for the other workers' /metrics to read.
+        """
+        if self.directory is None:
+            return
+        self.last_flush = time.time()
+        path = self.snapshot_path()
+        with open(path + '.tmp', 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.rename(path + '.tmp', path)
+
+    def remove_snapshot(self):
+        ## Registered with atexit; forked workers inherit it and remove their own file
+        if self.directory is None:
+            return
+        try:
+            os.remove(self.snapshot_path())
+        except OSError:
+            pass
+
+    def maybe_flush(self):
+        if self.directory is not None and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def collect(self):
+        """
+        Return the snapshots of every worker (or just this process without a directory).
+        """
+        if self.directory is None:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (IOError, OSError, ValueError):
+                continue
+            if not process_exists(snapshot['pid']):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            snapshots.append(snapshot)
+        return snapshots
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def aggregate(snapshots):
+    """
+    Sum the histograms, cache statistics and gauges of several snapshots.
+
+    Returns:
+    histograms (dict): (name, labels_key) -> {'counts', 'sum', 'count'}
+    caches (dict): cache name -> summed stats
+    gauges (dict): gauge name -> summed value
+    """
+    histograms = {}
+    caches = {}
+    gauges = {}
+    for snapshot in snapshots:
+        for histogram in snapshot['histograms']:
+            key = (histogram['name'], labels_key(histogram['labels']))
+            total = histograms.setdefault(key, {'counts': [0] * len(histogram['counts']), 'sum': 0., 'count': 0})
+            total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+        for name, stats in snapshot['caches'].items():
+            total = caches.setdefault(name, dict((field, 0) for field in CACHE_COUNTERS + CACHE_GAUGES))
+            for field in CACHE_COUNTERS + CACHE_GAUGES:
+                total[field] += stats.get(field, 0)
+        for name, value in snapshot.get('gauges', {}).items():
+            gauges[name] = gauges.get(name, 0) + value
+    return histograms, caches, gauges
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in labels) + '}'
+
+
+def format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render(snapshots):
+    """
+    Render aggregated snapshots in the Prometheus text exposition format.
+    """
+    histograms, caches, gauges = aggregate(snapshots)
+    lines = []
+    for name in sorted(HISTOGRAMS):
+        help_text, buckets = HISTOGRAMS[name]
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (metric, labels), total in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + [float('inf')], total['counts']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', format_float(bound)),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_float(total['sum'])))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), total['count']))
+
+    for field in CACHE_COUNTERS:
+        name = 'recommender_cache_{}_total'.format(field)
+        lines.append('# TYPE {} counter'.format(name))
+        for cache, stats in sorted(caches.items()):
+            lines.append('{}{} {}'.format(name, format_labels((('cache', cache),)), stats[field]))
+    for field in CACHE_GAUGES:
+        name = 'recommender_cache_{}'.format(field)
+        lines.append('# TYPE {} gauge'.format(name))
+        for cache, stats in sorted(caches.items()):
+            lines.append('{}{} {}'.format(name, format_labels((('cache', cache),)), stats[field]))
+    lines.append('# HELP recommender_cache_hit_ratio Hits over lookups since the workers started')
+    lines.append('# TYPE recommender_cache_hit_ratio gauge')
+    for cache, stats in sorted(caches.items()):
+        lookups = stats['hits'] + stats['misses']
+        lines.append('recommender_cache_hit_ratio{} {}'.format(format_labels((('cache', cache),)),
+                                                                format_float(stats['hits'] / float(lookups) if lookups else 0.)))
+    for name, value in sorted(gauges.items()):
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, value))
+    lines.append('# TYPE recommender_metrics_workers gauge')
+    lines.append('recommender_metrics_workers {}'.format(len(snapshots)))
+    return '\n'.join(lines) + '\n'
+
+
+query_timing_installed = []
+
+
+def install_query_timing(registry):
+    """
+    Time every database query into recommender_db_query_seconds (once per process).
+    """
+    if query_timing_installed:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start'] = time.time()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        registry.observe('recommender_db_query_seconds', time.time() - conn.info.pop('query_start', time.time()))
+
+    query_timing_installed.append(True)
+
+
+## This process's registry
+registry = MetricsRegistry()
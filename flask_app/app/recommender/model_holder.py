@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import traceback
+
+
+class ModelsNotReady(Exception):
+    """
+    Raised by ModelHolder.get while the models are still loading (or failed to load).
+    """
+    pass
+
+
+class ModelHolder(object):
+    """
+    Loads the recommender models in a background thread and hands them out once ready,
+    so the app can serve requests that do not need them while they load.
+
+    The loading thread belongs to the process that started it; when a worker is forked
+    from a process that already started loading, start() loads again in the worker.
+
+    A failed load is retried after retry_delay seconds, doubling up to max_retry_delay,
+    so a worker recovers from e.g. a failed download without a restart. Between
+    attempts the state is 'failed' and status() says when the next attempt is.
+    """
+    def __init__(self, load, steps=(), retry_delay=5., max_retry_delay=300.):
+        """
+        Args:
+        load: Callable taking a progress callback and returning the loaded models
+        steps: Names of the steps load reports through the progress callback, in order
+        retry_delay: Seconds before the first retry of a failed load (None: never retry)
+        max_retry_delay: Longest wait between retries
+        """
+        self.load = load
+        self.steps = list(steps)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        self.models = None
+        self.state = 'pending'
+        self.step = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.attempts = 0
+        self.retry_at = None
+        self.ready.clear()
+
+    def start(self):
+        """
+        Start loading in a daemon thread, unless this process already did.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.reset()
+            self.state = 'loading'
+            self.started_at = time.time()
+        thread = threading.Thread(target=self.run, name='recommender-model-loader')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            self.attempts += 1
+            delay = None
+            try:
+                models = self.load(self.report_step)
+            except Exception:
+                self.error = traceback.format_exc()
+                print self.error
+                if self.retry_delay is not None:
+                    delay = min(self.retry_delay * 2 ** (self.attempts - 1), self.max_retry_delay)
+                    self.retry_at = time.time() + delay
+                self.state = 'failed'
+            else:
+                self.models = models
+                self.error = None
+                self.retry_at = None
+                self.state = 'ready'
+            self.finished_at = time.time()
+            ## Wake up waiters either way; wait() callers get ModelsNotReady on a failure
+            self.ready.set()
+            if self.state == 'ready' or delay is None:
+                return
+            time.sleep(delay)
+            self.ready.clear()
+            self.step = None
+            self.started_at = time.time()
+            self.finished_at = None
+            self.state = 'loading'
+
+    def report_step(self, step):
+        self.step = step
+
+    def wait(self, timeout=None):
+        """
+        Start loading if needed and block until the models are ready.
+        """
+        self.start()
+        self.ready.wait(timeout)
+        return self.get()
+
+    def get(self):
+        """
+        Return the models, or raise ModelsNotReady if they are not loaded yet.
+        """
+        if self.pid != os.getpid():
+            self.start()
+        if self.state != 'ready':
+            raise ModelsNotReady(self.state)
+        return self.models
+
+    def status(self):
+        """
+        Loading progress, as reported by /healthz/ready.
+        """
+        status = {'state': self.state, 'ready': self.state == 'ready', 'step': self.step,
+                  'steps_done': 0, 'steps_total': len(self.steps)}
+        if self.state == 'ready':
+            status['steps_done'] = len(self.steps)
+        elif self.step in self.steps:
+            status['steps_done'] = self.steps.index(self.step)
+        if self.started_at is not None:
+            status['seconds'] = round((self.finished_at or time.time()) - self.started_at, 3)
+        if self.error is not None:
+            status['error'] = self.error.strip().splitlines()[-1]
+        if self.attempts:
+            status['attempts'] = self.attempts
+        if self.state == 'failed':
+            if self.retry_at is None:
+                status['permanent'] = True
+            else:
+                status['retry_in'] = round(max(self.retry_at - time.time(), 0.), 1)
+        return status
@@ -0,0 +1,144 @@
+import numpy as np
+
+
+def top_k_columns(scores, stop):
+    """
+    Return the column indices of the `stop` highest scores, highest first.
+
+    Uses a partial selection instead of sorting every column. Ties are broken by
+    column order, which matches sorted(zip(book_names, scores), reverse=True).
+
+    Args:
+    scores: 1-d array of predicted ratings, one per column.
+    stop: How many of the top columns to return.
+
+    Returns:
+    columns: Array of up to `stop` column indices.
+    """
+    n_columns = len(scores)
+    if stop <= 0:
+        return np.empty(0, dtype=np.intp)
+    if stop >= n_columns:
+        candidates = np.arange(n_columns)
+    else:
+        ## Value of the stop-th largest score; keep everything at or above it so ties are complete
+        threshold = np.partition(scores, n_columns - stop)[n_columns - stop]
+        candidates = np.flatnonzero(scores >= threshold)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order][:stop]
+
+
+class ColumnCatalog(object):
+    """
+    Book metadata laid out in the column order of the dict vectorizer, so
+    collaborative results can be filtered with array operations.
+
+    author_ids holds the BookStore author code of each column, or -1 when
+    the book is not in the store or has no author.
+    """
+    def __init__(self, book_names, book_store):
+        self.book_names = np.empty(len(book_names), dtype=object)
+        self.book_names[:] = book_names
+        self.author_codes = book_store.author_codes
+        rows = book_store.rows_for(book_names)
+        self.author_ids = np.where(rows >= 0, np.asarray(book_store.author_ids)[rows], -1).astype(np.int32)
+
+    def encode_authors(self, authors):
+        """
+        Return the author codes for a list of author names, skipping unknown authors.
+        """
+        return np.array([self.author_codes[author] for author in authors if author in self.author_codes],
+                        dtype=np.int32)
+
+    def keep_mask(self, columns, read_authors_list):
+        """
+        Boolean mask over `columns`: True for books in the store whose author
+        is not one of the end-user's authors.
+        """
+        author_ids = self.author_ids[columns]
+        keep = author_ids >= 0
+        excluded = self.encode_authors(read_authors_list)
+        if len(excluded):
+            keep &= ~np.in1d(author_ids, excluded)
+        return keep
+
+    def filter_columns(self, columns, read_authors_list):
+        """
+        Return the book ids of `columns` that survive keep_mask, in order.
+        """
+        return self.book_names[columns[self.keep_mask(columns, read_authors_list)]].tolist()
+
+
+class RankedColumns(object):
+    """
+    The collaborative ranking of one end-user, sorted lazily: the scores are
+    kept, and the ranked prefix is extended (at least doubled) only when someone
+    asks for positions past it. Shared by every cursor over the same request,
+    so it can be cached between pages.
+
+    When columns is given (e.g. the books matching the end-user's features), only
+    those columns are ranked and positions count within them.
+    """
+    def __init__(self, scores, columns=None):
+        if columns is not None:
+            scores = scores[columns]
+        self.scores = scores
+        self.columns = columns
+        self.ranked = np.empty(0, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.scores)
+
+    @property
+    def nbytes(self):
+        """
+        Upper bound on the memory held, counting the ranking as fully extended.
+        """
+        nbytes = self.scores.nbytes + len(self.scores) * np.dtype(np.intp).itemsize
+        if self.columns is not None:
+            nbytes += self.columns.nbytes
+        return nbytes
+
+    def prefix(self, stop):
+        """
+        Return the first `stop` ranked columns.
+        """
+        if stop > len(self.ranked) and len(self.ranked) < len(self.scores):
+            ranked = top_k_columns(self.scores, max(stop, 2 * len(self.ranked)))
+            if self.columns is not None:
+                ranked = self.columns[ranked]
+            self.ranked = ranked
+        return self.ranked[:stop]
+
+
+class CandidateStream(object):
+    """
+    Cursor over the collaborative ranking of one end-user.
+
+    take() hands out the next window of ranked books. position is the number of
+    ranked columns consumed, which is what the client sends back as
+    collab_returned to page forward.
+    """
+    def __init__(self, ranking, column_catalog, read_authors_list, start=0):
+        self.ranking = ranking
+        self.column_catalog = column_catalog
+        self.read_authors_list = read_authors_list
+        self.position = start
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.ranking)
+
+    def take(self, n):
+        """
+        Return the book ids in the next `n` ranked positions that pass the
+        catalog filter, and advance the cursor past them.
+        """
+        window = self.ranking.prefix(self.position + n)[self.position:]
+        self.position += len(window)
+        return self.column_catalog.filter_columns(window, self.read_authors_list)
+
+    def __iter__(self):
+        while not self.exhausted:
+            for book_id in self.take(100):
+                yield book_id
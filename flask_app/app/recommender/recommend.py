@@ -1,15 +1,22 @@
 import copy
+import multiprocessing
 
-import pandas as pd
 import numpy as np
-from collections import Counter
+from collections import Counter, OrderedDict
+from scipy import sparse
 
-from sklearn.neighbors import NearestNeighbors
 from sklearn.decomposition import IncrementalPCA
 
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.ensemble import RandomForestClassifier
 
+from ann import ExactIndex, set_query
+from fold_in import FoldIn, LatentState
+from keywords import FeatureIndex, KeywordMatrix
+from cache import ranking_key
+from ranking import CandidateStream, ColumnCatalog, RankedColumns, top_k_columns
+import timing
+
 
 
 def format_keywords_for_d3(keyword_counts):
@@ -26,14 +33,26 @@ def format_keywords_for_d3(keyword_counts):
     return keywords
 
 
-def get_book_info(book_id, book_data):
+def apply_votes(ratings_dict, up_votes, down_votes):
+    """
+    Function to add the end-user's up-votes (rated 5) and down-votes (rated -1)
+    to a dict of book_id:rating.
+    """
+    if up_votes:
+        for upvote in up_votes:
+            ratings_dict[upvote] = 5
+    if down_votes:
+        for downvote in down_votes:
+            ratings_dict[downvote] = -1
+    return ratings_dict
+
+
+def get_book_info(book_id, book_store):
     """
     Function to return the title, author, description for a given book. 
     """
-    title = book_data[book_id]['title']
-    author = book_data[book_id]['author']
-    description = book_data[book_id]['description']
-    book_info = [title, author, description]
+    book = book_store[book_id]
+    book_info = [book.title, book.author, book.description]
     return book_info
 
 
@@ -41,41 +60,160 @@ def get_book_info(book_id, book_data):
 
 
 class Recommend(object):
-    def __init__(self, user, Read, Book, book_data, db, ipca_model, dict_vectorizer_fit, collab_start_point, return_distances=False):
+    def __init__(self, user, Read, Book, book_store, db, ipca_model, dict_vectorizer_fit, collab_start_point, return_distances=False,
+                 fold_in=None, column_catalog=None, keyword_matrix=None, feature_index=None, item_index=None,
+                 ranking_cache=None, latent_cache=None, timer=None, use_ratings=False, selection_ratings=None):
         self.user = user
         self.Read = Read
         self.Book = Book
-        self.book_data = book_data
+        self.book_store = book_store
         self.db = db
         self.ipca_model = ipca_model
         self.dict_vectorizer_fit = dict_vectorizer_fit
         self.return_distances= return_distances
         self.collab_start_point = collab_start_point
         self.collab_returned = 0
+        ## The fold-in engine precomputes the mean projection, so share one across requests when possible
+        if fold_in is None:
+            fold_in = FoldIn.from_model(ipca_model)
+        self.fold_in = fold_in
+        if column_catalog is None:
+            column_catalog = ColumnCatalog(dict_vectorizer_fit.feature_names_, book_store)
+        self.column_catalog = column_catalog
+        if keyword_matrix is None:
+            keyword_matrix = KeywordMatrix(book_store)
+        self.keyword_matrix = keyword_matrix
+        if feature_index is None:
+            feature_index = FeatureIndex(dict_vectorizer_fit.feature_names_, book_store)
+        self.feature_index = feature_index
+        self.item_index = item_index
+        self.ranking_cache = ranking_cache
+        self.latent_cache = latent_cache
+        self.timer = timer
+        self.use_ratings = use_ratings
+        ## web_id:rating of the selection read beforehand (e.g. for a pool worker without a database)
+        self.selection_ratings = selection_ratings
+        self.collab_filter_results = None
+        self.similarity_windows = 0
 
     def recommend_books(self, books_selected, features_list, books_returned, up_votes, down_votes, n_collab_returned):
         """
         Function to run collaborative filtering and book-keyword similarity and return recommendations
         """
-        ##" Run collaborative filtering
-        collab_filter_results = self.collaborative_filtering_predict(books_selected=books_selected, up_votes=up_votes, 
-                                                                    down_votes=down_votes, n_collab_returned=n_collab_returned)
-        """for book in collab_filter_results:
-            if book_data[book].has_key('title'):
-                print ' '.join(book_data[book]['title'].split())"""
+        for stage, books in self.recommend_stages(books_selected=books_selected, features_list=features_list,
+                                                  books_returned=books_returned, up_votes=up_votes,
+                                                  down_votes=down_votes, n_collab_returned=n_collab_returned):
+            pass
+        return books
+
+    def recommend_stages(self, books_selected, features_list, books_returned, up_votes, down_votes, n_collab_returned):
+        """
+        Run recommend_books one stage at a time, so a caller can show the collaborative
+        candidates while the similarity stage refines them.
+
+        Yields:
+        ('candidates', collab_filter_results): The first collaborative window, best first
+        ('recommendations', recommended_books): What recommend_books returns
+        """
+        ## Run collaborative filtering once; the similarity stage pulls further windows from the stream
+        candidate_stream = self.collaborative_filtering_stream(books_selected=books_selected, up_votes=up_votes, 
+                                                               down_votes=down_votes, features_list=features_list)
+        with self.stage(timing.TOP_N):
+            collab_filter_results = candidate_stream.take(n_collab_returned)
+        self.collab_returned = candidate_stream.position
+        self.collab_filter_results = collab_filter_results
+        yield 'candidates', collab_filter_results
         ## Run book similarity
-        recommended_books = self.apply_book_similarity_filtering(books_selected=books_selected, collab_filter_results=collab_filter_results, 
-                                                                features_list=features_list, n_collab_returned=n_collab_returned, 
-                                                                books_returned=books_returned, up_votes=up_votes, 
-                                                                down_votes=down_votes)
-        return recommended_books
+        with self.stage(timing.SIMILARITY_FILTERING):
+            recommended_books = self.apply_book_similarity_filtering(books_selected=books_selected, collab_filter_results=collab_filter_results, 
+                                                                    features_list=features_list, n_collab_returned=n_collab_returned, 
+                                                                    books_returned=books_returned, up_votes=up_votes, 
+                                                                    down_votes=down_votes, candidate_stream=candidate_stream)
+        yield 'recommendations', recommended_books
+
+    def stage(self, name):
+        """
+        Context manager timing one stage of the pipeline with self.timer (a no-op without one).
+        """
+        if self.timer is None:
+            return timing.null_stage
+        return self.timer.stage(name)
+
+    def recommend_batch(self, selections, n_collab_returned, batch_size=256):
+        """
+        Function to run collaborative filtering for many end-users in one matrix pass, 
+        e.g. for email digests or for pre-warming caches. Ratings are not read from the 
+        database: selected books are rated 5.0, as in prepare_ratings_for_dv.
+
+        Args:
+        selections (list of dicts): One dict per end-user with 'books_selected' and, optionally,
+        'up_votes' and 'down_votes'.
+        n_collab_returned: The number of top books to return per end-user
+        batch_size: How many end-users are projected together. Bounds the dense block of 
+        predicted ratings at batch_size x n_books.
+
+        Returns:
+        batch_results (list of lists): The collaborative filtering results of each end-user, in input order.
+        """
+        batch_results = []
+        for batch_start in range(0, len(selections), batch_size):
+            batch = selections[batch_start:batch_start + batch_size]
+            ratings_list = [apply_votes(dict.fromkeys(selection['books_selected'], 5.0),
+                                        selection.get('up_votes'), selection.get('down_votes'))
+                            for selection in batch]
+            enduser_matrix = self.ratings_to_matrix(ratings_list)
+
+            ## One sparse-dense product projects the whole batch, one dense product rebuilds its ratings
+            filled_ratings_matrix = self.fold_in.fold_in_batch(enduser_matrix)
+            for selection, filled_enduser_ratings in zip(batch, filled_ratings_matrix):
+                user_authors_list = self.create_user_authors_list(selection['books_selected'])
+                collab_filter_results = self.return_top_n_books(filled_enduser_ratings=filled_enduser_ratings,
+                                                                book_names=self.dict_vectorizer_fit.feature_names_,
+                                                                read_authors_list=user_authors_list,
+                                                                n_collab_returned=n_collab_returned)
+                batch_results.append(collab_filter_results)
+        return batch_results
+
+    def books_near(self, book_ids, n=6, books_returned=()):
+        """
+        Function to return the books whose latent (IPCA component) vectors are closest 
+        to those of book_ids, e.g. the end-user's up-voted books, without re-running
+        the collaborative filtering. Uses the item index of the models: approximate when
+        one has been built, otherwise an exact search over all books.
+
+        Args:
+        book_ids: A list of book ids to find neighbours of (treated as one set)
+        n: The number of books to return
+        books_returned: Book ids never to return, e.g. those already shown or read
+
+        Returns:
+        similar_books (list): Up to n book ids from the book store, most similar first
+        """
+        vocabulary = self.dict_vectorizer_fit.vocabulary_
+        columns = [vocabulary[book_id] for book_id in book_ids if book_id in vocabulary]
+        if not columns:
+            return []
+
+        ## Only a Recommend built without load_models has no index
+        if self.item_index is None:
+            self.item_index = ExactIndex.from_components(self.fold_in.components)
+
+        ## Excluded in the search, so that they do not take the places of other neighbours
+        excluded = columns + [vocabulary[book_id] for book_id in books_returned if book_id in vocabulary]
+
+        ## Ask for extra neighbours, as books outside the book store are dropped afterwards
+        query = set_query(self.item_index.vectors_for(columns))
+        similar_columns, similarities = self.item_index.search(query, n * 2, exclude=excluded)
+        similar_books = self.column_catalog.filter_columns(similar_columns, [])
+        return similar_books[:n]
 
     #------------------------------Collaborative Filtering--------------------------#
 
     def prepare_ratings_for_dv(self, books_selected, up_votes, down_votes):
         """
-        Function to query the database for the ratings the user attributed to the books
-        submitted. Then place ratings and book ids into format for the dict vectorizer.
+        Function to rate the books submitted and place ratings and book ids into format 
+        for the dict vectorizer. Selected books are rated 5.0; with self.use_ratings the 
+        ratings the user gave them are read from the database (one query, see user_ratings).
 
         Args:
         books_selected (list of ints): A list containing the ids of the books the end-user has selected.
@@ -86,22 +224,47 @@ class Recommend(object):
         """
         ratings_list = []
         ratings_dict= {}
+        if self.use_ratings:
+            ratings = self.user_ratings(books_selected)
         for book_id in books_selected:
-            book = self.db.session.query(self.Book).filter_by(web_id=int(book_id)).first()
-            book_read = self.db.session.query(self.Read).filter_by(user_id=self.user.id, book_id=book.id).first()
-            rating = book_read.rating
-            #ratings_dict[web_id] = rating  
             rating = 5.0
+            ## Unrated (None or 0) reads count as liked, like every selected book without use_ratings
+            if self.use_ratings and ratings.get(str(book_id)):
+                rating = float(ratings[str(book_id)])
             ratings_dict[book_id] = rating
-        if up_votes:
-            for upvote in up_votes:
-                ratings_dict[upvote] = 5
-        if down_votes:
-            for downvote in down_votes:
-                ratings_dict[downvote] = -1   
+        apply_votes(ratings_dict, up_votes, down_votes)
         ratings_list.append(ratings_dict)
         return ratings_list
 
+    def user_ratings(self, books_selected):
+        """
+        Return the end-user's rating of each selected book in one query.
+
+        Returns:
+        ratings (dict): web_id (as a string):rating for the selected books the user has read
+        """
+        if self.selection_ratings is not None:
+            return self.selection_ratings
+        if not books_selected:
+            return {}
+        rows = (self.db.session.query(self.Book.web_id, self.Read.rating)
+                .join(self.Read, self.Read.book_id == self.Book.id)
+                .filter(self.Read.user_id == self.user.id, self.Book.web_id.in_([int(book_id) for book_id in books_selected]))
+                .all())
+        return dict((str(web_id), rating) for web_id, rating in rows)
+
+    def ratings_key(self, books_selected):
+        """
+        The selection's ratings as part of a cache key: empty unless self.use_ratings.
+        They are read once per Recommend and kept in selection_ratings, so
+        prepare_ratings_for_dv does not read them again.
+        """
+        if not self.use_ratings:
+            return ()
+        if self.selection_ratings is None:
+            self.selection_ratings = self.user_ratings(books_selected)
+        return tuple(sorted(self.selection_ratings.items()))
+
     def dv_transform_enduser_vector(self, ratings_list):
         """
         Use Dict Vecotrizer object fit on full users data to transform the end-user's ratings
@@ -122,15 +285,61 @@ class Recommend(object):
         book_names = self.dict_vectorizer_fit.feature_names_
         return book_names, enduser_vector
 
+    def ratings_to_matrix(self, ratings_list):
+        """
+        Stack a list of book_id:rating dicts into one sparse matrix with the columns 
+        of the dict vectorizer (one row per dict). Books unknown to the vectorizer are dropped.
+        """
+        vocabulary = self.dict_vectorizer_fit.vocabulary_
+        rows, columns, values = [], [], []
+        for row, ratings_dict in enumerate(ratings_list):
+            for book_id, rating in ratings_dict.items():
+                column = vocabulary.get(book_id)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+                    values.append(rating)
+        shape = (len(ratings_list), len(self.dict_vectorizer_fit.feature_names_))
+        return sparse.csr_matrix((np.array(values, dtype=np.float64), (rows, columns)), shape=shape)
+
+    def enduser_latent_state(self, books_selected, up_votes, down_votes):
+        """
+        Return the end-user's projected latent state for the books selected plus votes.
+
+        The state for the same user and selection is kept in self.latent_cache, so 
+        the ratings are only projected the first time; after that each added, removed 
+        or flipped vote is a rank-one update of the latent vector (see LatentState).
+        With self.use_ratings the selection's ratings are part of the key, so they are 
+        read on every call (one query) and re-rating a selected book, through any 
+        worker, gives a new state.
+        """
+        vocabulary = self.dict_vectorizer_fit.vocabulary_
+        state_key = (self.user.id, tuple(sorted(books_selected)), self.ratings_key(books_selected))
+        state = self.latent_cache.get(state_key)
+        if state is None:
+            ratings_list = self.prepare_ratings_for_dv(books_selected=books_selected, up_votes=None, down_votes=None)
+            state = LatentState.from_ratings(self.fold_in, vocabulary, ratings_list[0])
+
+        ## Votes override the selected books' ratings, as in prepare_ratings_for_dv
+        ratings = dict(state.base_ratings)
+        for book_id, rating in apply_votes({}, up_votes, down_votes).items():
+            if book_id in vocabulary:
+                ratings[vocabulary[book_id]] = rating
+        state = state.with_ratings(ratings)
+        self.latent_cache.set(state_key, state, state.nbytes)
+        return state
+
     def ipca_tranform_enduser_vector(self, enduser_vector):
         """
         Use IPCA model fit on full user data transform 
         the user vector, to predict what he/she would have filled in for missing 
         values.
+
+        Only the columns of the books the user rated take part in the projection
+        (see FoldIn), which gives the same result as ipca_model.transform followed by
+        inverse_transform without densifying the 50k column vector.
         """
-        ipca_result = self.ipca_model.transform(enduser_vector)
-        ## Transform back to vector with results
-        filled_enduser_ratings = self.ipca_model.inverse_transform(ipca_result)[0]
+        filled_enduser_ratings = self.fold_in.fold_in(enduser_vector)
         return filled_enduser_ratings
 
     def create_user_authors_list(self, books_selected):
@@ -138,13 +347,13 @@ class Recommend(object):
         Creates a list of the authors of the books input by the user.
         Args:
         books_selected: List of the book ids from end-user input 
-        self.book_data: Full book data
+        self.book_store: Full book data
         """
         user_authors_list = []
         for book_id in books_selected:
-            if self.book_data.has_key(book_id) and self.book_data.has_key('author'):
-                author = self.book_data[book_id]['author']
-                user_authors_list.append(author)
+            book = self.book_store.get(book_id)
+            if book is not None and book.author is not None:
+                user_authors_list.append(book.author)
         return user_authors_list
 
     def return_top_n_books(self, filled_enduser_ratings, book_names, read_authors_list, n_collab_returned, count=1):
@@ -154,137 +363,118 @@ class Recommend(object):
         Args:
         filled_ratings: The end-user vector with all book ratings predicted
         n_results: The number of results to return (most strong predictions delivered first)
-        book_names: The names of the books, in order of vector columns.
-        self.book_data: Full book data
+        book_names: The names of the books, in order of vector columns (the same order as self.column_catalog).
+        self.column_catalog: Book ids and author codes in column order
 
 
         Returns:
         collab_filter_results: A list of the ids of the top book suggestions    
         """
-        ## Attach book names to the results
-        results = sorted(zip(book_names, filled_enduser_ratings), key = lambda x: x[1], reverse=True)
-        collab_filter_results = []
-
-        for item in results[self.collab_start_point+ (n_collab_returned-(n_collab_returned/count)):(self.collab_start_point + n_collab_returned)]:
-            self.collab_returned = (self.collab_start_point + n_collab_returned)
-            book_id = item[0]
-            if self.book_data.has_key(book_id):
-                if self.book_data[book_id].has_key('author'):
-                    if self.book_data[book_id]['author'] not in read_authors_list:
-                        collab_filter_results.append(book_id)
+        ## Rank only as far as the end of the requested window, then drop books outside
+        ## the book store and books by the end-user's authors
+        window_start = self.collab_start_point + (n_collab_returned-(n_collab_returned/count))
+        window_stop = self.collab_start_point + n_collab_returned
+        window = top_k_columns(filled_enduser_ratings, window_stop)[window_start:]
+        if len(window):
+            self.collab_returned = window_stop
+        collab_filter_results = self.column_catalog.filter_columns(window, read_authors_list)
         return collab_filter_results
 
 
 
-    def collaborative_filtering_predict(self, books_selected, n_collab_returned, up_votes, down_votes, count=1):
+    def collaborative_filtering_ranking(self, books_selected, up_votes, down_votes, features_list=None):
         """
         With enduser input of books and ratings, predict ratings for unread books and
-        return highest predicted books.
+        rank them, highest predicted first.
 
         Args:
         books_selected: A list of the books the end-user submitted
-        self.book_data: Full book library data
+        features_list: Keywords a book must all have to be ranked at all (see FeatureIndex)
+        self.book_store: Full book library data
         db: database with users, books, and ratings
-        n_collab_returned: The number of books to be returned
 
         Returns:
-        collab_filter_results: The top n books the end-user is predicted to rate highest. 
+        ranking: A (lazily sorted) RankedColumns of the dict vectorizer columns. 
         """
 
-        ## Format end-user ratings into a list of dicts for the dict vectorizer
-        ratings_list = self.prepare_ratings_for_dv(books_selected=books_selected, up_votes=up_votes, down_votes=down_votes)
-
-
-        ## Transform end-user ratings into vector fit on full user matrix 
-        ## and store the book names for later
-        book_names, enduser_vector = self.dv_transform_enduser_vector(ratings_list=ratings_list)
-        #print np.unique(enduser_vector)
-        
-        ## Transform user vector and predict ratings
-        filled_enduser_ratings = self.ipca_tranform_enduser_vector(enduser_vector)
+        if self.latent_cache is not None:
+            ## Votes move the end-user's stored latent vector instead of re-projecting every rating
+            with self.stage(timing.LATENT_STATE):
+                filled_enduser_ratings = self.enduser_latent_state(books_selected=books_selected, up_votes=up_votes, 
+                                                                   down_votes=down_votes).scores()
+        else:
+            ## Format end-user ratings into a list of dicts for the dict vectorizer
+            with self.stage(timing.PREPARE_RATINGS):
+                ratings_list = self.prepare_ratings_for_dv(books_selected=books_selected, up_votes=up_votes, down_votes=down_votes)
+
+
+            ## Transform end-user ratings into vector fit on full user matrix 
+            ## and store the book names for later
+            with self.stage(timing.DV_TRANSFORM):
+                book_names, enduser_vector = self.dv_transform_enduser_vector(ratings_list=ratings_list)
+            #print np.unique(enduser_vector)
+            
+            ## Transform user vector and predict ratings
+            with self.stage(timing.IPCA):
+                filled_enduser_ratings = self.ipca_tranform_enduser_vector(enduser_vector)
         
-        ## Make a list of the authors of the books the end-user submitted 
-        user_authors_list = self.create_user_authors_list(books_selected)
-        
-        ## Return the books the end-user is most likely to rate highest
-        collab_filter_results = self.return_top_n_books(filled_enduser_ratings=filled_enduser_ratings, book_names=book_names, 
-                                                        read_authors_list=user_authors_list, n_collab_returned=n_collab_returned, count=count)
-        return collab_filter_results
+        ## Only rank the books that have every requested feature
+        feature_columns = self.feature_index.columns_with(features_list)
 
-    
-    #---------------engineer keywords-----------------------------------#
-
-
-    def make_aggregated_and_filtered_keyword_count_dict(keyword_conversion_dict, keywords):
-        '''
-        Take a keyword count dict and combine similar keywords based on keyword_conversion_dict, while filtering 
-        those not included in the conversion dict. 
-        '''
-        new_keyword_dict = {}
-        for keyword in keywords:
-            if keyword in keyword_conversion_dict:
-                true_label = keyword_conversion_dict[keyword]
-                new_keyword_dict[true_label] = int(new_keyword_dict.get(true_label, 0)) + int(keywords[keyword])
-        return new_keyword_dict
-
-
-    def make_top_keyword_ranking_dict(book_id, book_data, keyword_conversion_dict):
-        '''
-        Make a dictionary with keywords as keys and a value of the rank of the keyword
-        based on the count number
-
-        Arguments
-        book_id: the book id number (string)
-        returns: a dictionary of keyword:ranking 
-
-        '''
-        ## Remove uninformative keywords and sort based on count
-
-        filtered_keywords = self.make_aggregated_and_filtered_keyword_count_dict(keyword_conversion_dict, book_data[book_id]['keywords'])
+        ranking = RankedColumns(scores=filled_enduser_ratings, columns=feature_columns)
+        return ranking
 
+    def collaborative_filtering_stream(self, books_selected, up_votes, down_votes, features_list=None):
+        """
+        Return a cursor over the collaborative ranking, starting at self.collab_start_point.
+        The ranking is reused from self.ranking_cache when the same user sent the same 
+        books, votes and features before (e.g. when paging with "get more"), and gave 
+        the books the same ratings when those are used.
 
-        rank_list = sorted(filtered_keywords, key=lambda k: filtered_keywords[k]) 
+        Returns:
+        candidate_stream: A CandidateStream over the collaborative ranking. 
+        """
+        ranking = None
+        if self.ranking_cache is not None:
+            cache_key = ranking_key(self.user.id, books_selected, up_votes, down_votes, features_list,
+                                    ratings=self.ratings_key(books_selected))
+            ranking = self.ranking_cache.get(cache_key)
+        if ranking is None:
+            ranking = self.collaborative_filtering_ranking(books_selected=books_selected, up_votes=up_votes, 
+                                                           down_votes=down_votes, features_list=features_list)
+            if self.ranking_cache is not None:
+                self.ranking_cache.set(cache_key, ranking, ranking.nbytes)
 
+        ## Make a list of the authors of the books the end-user submitted 
+        user_authors_list = self.create_user_authors_list(books_selected)
 
+        candidate_stream = CandidateStream(ranking=ranking, column_catalog=self.column_catalog,
+                                           read_authors_list=user_authors_list, start=self.collab_start_point)
+        return candidate_stream
 
-        ## Pull top 40 keywords
-        if len(rank_list) < 20:
-            top_keywords = rank_list
-        else: 
-            top_keywords = rank_list[:20]
+    def collaborative_filtering_predict(self, books_selected, n_collab_returned, up_votes, down_votes):
+        """
+        With enduser input of books and ratings, predict ratings for unread books and
+        return highest predicted books.
 
-        ## Rank keywords based on order
-        rank_dict = {}
-        count = 0
-        for keyword in top_keywords:
-            rank_dict[keyword] = 20- count
-            count += 1
-        return rank_dict
+        Args:
+        books_selected: A list of the books the end-user submitted
+        n_collab_returned: The number of books to be returned
 
+        Returns:
+        collab_filter_results: The top n books the end-user is predicted to rate highest. 
+        """
+        candidate_stream = self.collaborative_filtering_stream(books_selected=books_selected, up_votes=up_votes, 
+                                                               down_votes=down_votes)
+        collab_filter_results = candidate_stream.take(n_collab_returned)
+        self.collab_returned = candidate_stream.position
+        return collab_filter_results
 
+    
+    #---------------engineer keywords-----------------------------------#
 
-    def check_if_ints(string):
-        '''
-        Check if a string is comprised of intergers
-        '''
-        try: 
-            int(string)
-            return True
-        except:
-            return False
+    ## Keyword engineering runs offline: see keyword_pipeline and `manage.py engineer_keywords`
 
-    def engineer_keywords(book_data, keyword_conversion_dict):
-        '''
-        Replace keywords in book_data with aggregated/engineered keywords that are ranked by how often
-        goodreads users associated book with them
-        '''
-        book_data_1 = copy.deepcopy(book_data)
-        for book_id in book_data_1:
-            if book_data_1[book_id].has_key('keywords') == True:
-                new_keywords = make_top_keyword_ranking_dict(book_id, book_data, keyword_conversion_dict)
-                book_data[book_id]['keywords'] = new_keywords
-        return book_data
-    
     #--------------------create "ideal" book profile----------------------------------#
 
 
@@ -303,9 +493,11 @@ class Recommend(object):
         '''
         book_keyword_ranking_dict = {}
         for book_id in collab_filter_results:
-            if self.book_data.has_key(book_id):
-                keyword_rankings = self.book_data[book_id]['keywords']
-                book_keyword_ranking_dict[book_id] = keyword_rankings
+            book = self.book_store.get(book_id)
+            if book is not None:
+                keyword_rankings = book.keywords
+                if keyword_rankings is not None:
+                    book_keyword_ranking_dict[book_id] = keyword_rankings
         return book_keyword_ranking_dict
 
 
@@ -363,12 +555,13 @@ class Recommend(object):
         Turns list of top book_ids returned from ipca and creates a dictionary where:
         {book:{keyword:rank}}
         '''
-        top_books_keyword_dict = {}
+        top_books_keyword_dict = OrderedDict()
   
         for book_id in collab_filter_results+leftover_collab_results:
-            if self.book_data[book_id].has_key('keywords') and book_id not in books_returned:
-                keywords = self.book_data[book_id]['keywords']
-                top_books_keyword_dict[book_id] = keywords
+            if book_id not in books_returned:
+                keywords = self.book_store[book_id].keywords
+                if keywords is not None:
+                    top_books_keyword_dict[book_id] = keywords
         return top_books_keyword_dict
 
     def remove_non_shared_keywords(self, top_books_keyword_dict, user_preference):
@@ -396,7 +589,7 @@ class Recommend(object):
         '''
         Only keep books if they share a keyword with the keywords in the features_list
         '''
-        revised_top_books_keyword_dict = {}
+        revised_top_books_keyword_dict = OrderedDict()
         for book_id in top_books_keyword_dict:
             #for keyword in top_books_keyword_dict[book_id]:
                 #if keyword in features_list:
@@ -408,42 +601,39 @@ class Recommend(object):
 
     def make_book_sample_and_test_point(self, collab_filter_results, user_preference):
         """
-        Turn the data of books and their keyword rankings and turn them into a sample, while 
-        turning the user's preference into a point. 
+        Measure how far each candidate book's keywords are from the user's preference,
+        using the keyword matrix built at startup. 
         
         Arguments
-        book_keyword_ranking_dict: dictionary of books as keys and keyword:rank as value
+        collab_filter_results: dictionary of books as keys and keyword:rank as value
         user_preference: custom user preference based on user inmput
         
         Returns:
-        sample: df with the books as rows and keywords as columns and counts as values
-        point: series with keywords as columns and rank as values
+        book_ids: list of the candidate book ids, in the order of collab_filter_results
+        distances: array of the matching distance of each book from the user's preference
         
         """
-        
-        df = pd.DataFrame.from_dict(collab_filter_results, orient='index')
-        ## Make a dataframe of the custom book dict, to be appended to the user dataframe 
-        df_to_append = pd.DataFrame.from_dict(user_preference, orient='index') 
-
-        ## Combine the two dataframes. 
-        df1 = df.append(df_to_append)
-        df2 = df1.fillna(0)
-        books_df = df2.ix[:-1, :]
-        enduser_series = df2.ix[-1:, :]
-        return books_df, enduser_series
+        book_ids = list(collab_filter_results)
+        distances = self.keyword_matrix.matching_distances(book_ids, user_preference['user'])
+        return book_ids, distances
 
 
     def apply_book_similarity_filtering(self, books_selected, collab_filter_results, 
-                                        features_list, n_collab_returned, books_returned, up_votes, down_votes, leftover_collab_results=[], count=1):
+                                        features_list, n_collab_returned, books_returned, up_votes, down_votes, candidate_stream=None):
         """
         Function to take end-user submitted books, find the keywords that are shared
         most among them, and are highest ranked, to determine end-user's preference.
         composition. Then, find out which books are most similar in keyword ranking composition 
         to end-user's preference.
 
+        When fewer than 7 books survive, the next n_collab_returned ranked books are pulled from 
+        candidate_stream (up to 38 more windows) instead of re-running the collaborative filtering.
+
         Args:
         books_selected (list of ints): A list of book ids
-        self.book_data: A dictionary of full book data
+        collab_filter_results: The first window of collaborative filtering results
+        candidate_stream: The CandidateStream that produced collab_filter_results
+        self.book_store: Full book data
 
         Returns:
         recommended_books (list of ints): List of book ids of the recommended books
@@ -464,58 +654,45 @@ class Recommend(object):
 
         ## Make a dict of keywords for top books and n times keyword mentioned
         top_books_keyword_dict = self.make_top_books_keyword_dict(collab_filter_results=collab_filter_results, 
-                                                                  leftover_collab_results=leftover_collab_results, 
                                                                   books_returned=books_returned)
         
 
         
         ## Only keep those books sharing a keyword with end-users keywords
+        ## (the candidate stream already ranks only those books; this guards results passed in directly)
         if len(features_list) >= 1:
             top_books_keyword_dict = self.keep_only_if_in_feature_list(top_books_keyword_dict, features_list)
         
-        if len(top_books_keyword_dict) < 7: 
+        if candidate_stream is None:
+            candidate_stream = self.collaborative_filtering_stream(books_selected=books_selected, up_votes=up_votes, 
+                                                                   down_votes=down_votes, features_list=features_list)
+            candidate_stream.take(n_collab_returned)
+            self.collab_returned = candidate_stream.position
+
+        ## Widen the window until enough books survive
+        count = 1
+        while len(top_books_keyword_dict) < 7: 
             count += 1
             if count == 40:
+                self.similarity_windows = count
                 return None
-            collab_filter_results = self.collaborative_filtering_predict(books_selected=books_selected, n_collab_returned=n_collab_returned+(n_collab_returned/(count-1)), 
-                                                                            up_votes=up_votes, down_votes=down_votes, count=count)
-            ## Run book similarity
-            #print 'len top_keywords: {}'.format(len(top_books_keyword_dict))
-            if len(top_books_keyword_dict) != 0:
-                leftover_collab_results = top_books_keyword_dict.keys()
-            else: 
-                leftover_collab_results = []
-
-            recommended_books = self.apply_book_similarity_filtering(books_selected=books_selected, 
-                                                                    collab_filter_results=collab_filter_results, 
-                                                                    features_list=features_list, n_collab_returned=n_collab_returned+(n_collab_returned/(count-1)), 
-                                                                    leftover_collab_results=leftover_collab_results,
-                                                                    up_votes=up_votes,
-                                                                    down_votes=down_votes,
-                                                                    books_returned=books_returned,
-                                                                    count =count)
-
-            return recommended_books
-
-        ## Create dataframe of all books and their keyword rankings as columns
-        ## Create a series of end-user's "ideal" book keyword rankings  
-        books_df, enduser_series = self.make_book_sample_and_test_point(top_books_keyword_dict, user_preference)
-        sample_size = len(books_df)
-
-        ## Define clasifier
-        book_neigh = NearestNeighbors(n_neighbors=sample_size, algorithm='brute', metric='matching')
-        
-        ## Fit on full book df
-        book_neigh.fit(books_df) 
+            more_collab_results = candidate_stream.take(n_collab_returned)
+            self.collab_returned = candidate_stream.position
+            more_books_keyword_dict = self.make_top_books_keyword_dict(collab_filter_results=more_collab_results, 
+                                                                       books_returned=books_returned)
+            if len(features_list) >= 1:
+                more_books_keyword_dict = self.keep_only_if_in_feature_list(more_books_keyword_dict, features_list)
+            top_books_keyword_dict.update(more_books_keyword_dict)
+        self.similarity_windows = count
 
-        ## Determine distance from neighbors
-        book_nearest_neighbors = book_neigh.kneighbors(enduser_series)
-        
-        ## Put neighbors in list
-        neighbors = np.ndarray.tolist(book_nearest_neighbors[1])[0]
+        ## Find the keyword distance of every book from end-user's "ideal" book keyword rankings  
+        book_ids, distances = self.make_book_sample_and_test_point(top_books_keyword_dict, user_preference)
+
+        ## Put neighbors in list, nearest first (ties keep collaborative order)
+        neighbors = np.argsort(distances, kind='mergesort')
 
         ## Find the sum of all neighbor distances (good for benchmarking)
-        sum_distances = sum(np.ndarray.tolist(book_nearest_neighbors[0])[0])
+        sum_distances = distances.sum()
         #print 'total sum distances: {} '.format(sum_distances)
         if self.return_distances==True:
             return sum_distances
@@ -523,56 +700,119 @@ class Recommend(object):
             print 'total sum distances: {} '.format(sum_distances)
         
         ## Return the id's for the books and place in a list
-        recommended_books = [books_df.iloc[neighbor].name for neighbor in neighbors if books_df.iloc[neighbor].name not in books_returned+books_selected]
+        recommended_books = [book_ids[neighbor] for neighbor in neighbors if book_ids[neighbor] not in books_returned+books_selected]
 
 
         return recommended_books[:6]
 
         #-------------------Tune collaborative filtering-----------------------------------#
         
-    def tune_n_components(self, component_range, n_books_cross_validate):
+    def tune_n_components(self, component_range, n_books_cross_validate, n_collab_returned=100, processes=None,
+                          random_state=0):
         """
-        Function to take an ipca model and sweep through a range of components,
-        validating on the kneighbors distance from books input. 
+        Function to sweep through a range of n_components of the ipca model, validating
+        on the keyword distance of the recommendations from the books input. 
+
+        Truncated components are nested, so each sample is projected once at the top of 
+        the range and every smaller model's predicted ratings are its prefix sums (one 
+        component added per step). Samples are spread over a process pool.
         
         Arguments:
-        component_range (list): 2 integers representing the beginning and end of range
-        of components through which to sweep
-        n_books_cross_validate: Number of books to get the distances for. 
+        component_range (list): 2 integers, the smallest and largest n_components to try (inclusive)
+        n_books_cross_validate: Number of books to get the distances for (each one an end-user
+        selecting just that book). 
+        n_collab_returned: Window size of the collaborative results, as in recommend_books
+        processes: Worker processes (default: one per CPU; 1 runs in this process)
         
         Returns:
-        n_components_ranked: A ranking of different n_components based on the distances 
-        of the results their models yielded. Lower rank means smaller distance.
-        distances_ranked: The distances of the n_components ranked. Lower numbers mean closer distances. 
-
+        ranking_table (list of dicts): One row per n_components, lowest total distance first, with
+        rank, n_components, total_distance, mean_distance and evaluated (samples that produced
+        recommendations).
         """
-        
-        self.return_distances=True
-        
-        ## Dict with n_components and the total distance of the results form the input
-        distance_dict = {}
+        global sweep_recommender
+        n_values = range(component_range[0], component_range[1] + 1)
+        if n_values[0] < 1 or n_values[-1] > self.fold_in.n_components:
+            raise ValueError('component_range must be within 1..{}'.format(self.fold_in.n_components))
+
+        ## Sample books the model has a column for, so every sample can be projected
+        vocabulary = self.dict_vectorizer_fit.vocabulary_
+        sample_books = sorted(book_id for book_id in self.book_store if book_id in vocabulary)
+        rng = np.random.RandomState(random_state)
+        sample_books = [sample_books[i] for i in rng.permutation(len(sample_books))[:n_books_cross_validate]]
+        tasks = [([book_id], n_values, n_collab_returned) for book_id in sample_books]
+
+        if processes == 1:
+            sample_distances = [self.component_sweep_distances(*task) for task in tasks]
+        else:
+            ## Workers are forked after this is set, so they share the models instead of pickling them
+            sweep_recommender = self
+            processes = processes or multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(processes)
+            try:
+                sample_distances = pool.map(sweep_sample, tasks, chunksize=max(1, len(tasks) / (8 * processes)))
+            finally:
+                pool.close()
+                pool.join()
+                sweep_recommender = None
+
+        ## Samples left without 7 candidates (nan) do not count towards any n_components
+        sample_distances = np.array(sample_distances, dtype=np.float64).reshape(len(tasks), len(n_values))
+        evaluated = (~np.isnan(sample_distances)).sum(axis=0)
+        total_distances = np.nansum(sample_distances, axis=0)
+
+        ranking_table = []
+        for rank, i in enumerate(np.argsort(total_distances, kind='mergesort')):
+            ranking_table.append({'rank': rank + 1, 'n_components': n_values[i],
+                                  'total_distance': float(total_distances[i]),
+                                  'mean_distance': float(total_distances[i] / max(evaluated[i], 1)),
+                                  'evaluated': int(evaluated[i])})
+        return ranking_table
+
+    def component_sweep_distances(self, books_selected, n_values, n_collab_returned):
+        """
+        Sum of recommendation distances for one end-user selection under each n_components
+        in n_values (ascending), or nan where no recommendations could be made.
+        """
+        vocabulary = self.dict_vectorizer_fit.vocabulary_
+        columns = np.array([vocabulary[book_id] for book_id in books_selected if book_id in vocabulary], dtype=np.intp)
+        ## Selected books are rated 5.0, as in prepare_ratings_for_dv
+        latent = self.fold_in.project(columns, np.repeat(5.0, len(columns)))
+        if self.fold_in.scale is not None:
+            latent = latent * self.fold_in.scale
+        components = self.fold_in.components
+        user_authors_list = self.create_user_authors_list(books_selected)
 
-        ## Copy the model so components can be adjusted in sweep
-        ipca_model_copy = copy.deepcopy(ipca_model)
-        
-        random_book_keys = self.book_data.keys()
-        random.shuffle(random_book_keys)
-        
-        ## Sweep through n_component range determine the total distance for n_books
-        for n_components in range(component_range[1], component_range[0], -1):
-            self.ipca_model.components_ = ipca_model_copy.components_[:n_components]
-            total_distances = 0
-            for book in random_book_keys[:n_books_cross_validate]:
-                sum_distances = self.recommend_books(books_selected=['331690'], features_list=[])
-                total_distances += sum_distances
-            distance_dict[n_components] = distance_dict.get(n_components, 0) + total_distances
-
-        ## Make a list ranking the n_components number, lower ranking posessing lower distance
-        n_components_ranked = sorted(distance_dict, key=lambda x: distance_dict[x])
-
-        ## Make a list ranking the distances, lowest first
-        distances_ranked = [distance_dict[n_component] for n_component in n_components_ranked]
-        return n_components_ranked, distances_ranked
+        return_distances = self.return_distances
+        self.return_distances = True
+        try:
+            distances = []
+            scores = np.array(self.fold_in.mean, dtype=np.float64)
+            n_added = 0
+            for n_components in n_values:
+                ## Add the components between the previous model and this one
+                scores += np.dot(latent[n_added:n_components], components[n_added:n_components])
+                n_added = n_components
+                candidate_stream = CandidateStream(ranking=RankedColumns(scores.copy()), column_catalog=self.column_catalog,
+                                                   read_authors_list=user_authors_list)
+                collab_filter_results = candidate_stream.take(n_collab_returned)
+                sum_distances = self.apply_book_similarity_filtering(books_selected=books_selected, 
+                                                                     collab_filter_results=collab_filter_results,
+                                                                     features_list=[], n_collab_returned=n_collab_returned,
+                                                                     books_returned=[], up_votes=[], down_votes=[],
+                                                                     candidate_stream=candidate_stream)
+                distances.append(np.nan if sum_distances is None else sum_distances)
+        finally:
+            self.return_distances = return_distances
+        return distances
+
+
+## Set in the parent before the tune_n_components pool forks
+sweep_recommender = None
+
+
+def sweep_sample(task):
+    books_selected, n_values, n_collab_returned = task
+    return sweep_recommender.component_sweep_distances(books_selected, n_values, n_collab_returned)
 
 
 
@@ -2,9 +2,16 @@
 import pickle
 
 import os, sys
-import boto3 
 
 from flask_app.config import Config
+from flask_app.app.recommender.fold_in import FoldIn
+from flask_app.app.recommender.ranking import ColumnCatalog
+from flask_app.app.recommender.keywords import FeatureIndex, KeywordMatrix
+from flask_app.app.recommender.ann import ExactIndex, ItemIndex
+from flask_app.app.recommender.book_store import BookStore
+from flask_app.app.recommender.d3_payloads import D3Payloads
+from flask_app.app.recommender.recommender_data.artifacts import current_version_dir, load_artifacts
+from flask_app.app.recommender.recommender_data.fetch import ArtifactFetcher, S3Backend
  
 
 scriptdir = os.path.dirname(os.path.abspath(__file__))
@@ -22,25 +29,146 @@ DV_fit_path = os.path.join(scriptdir, "dict_vectorizer_fit_160k_top_50k_books_du
 #ipca_model_path = os.path.join(scriptdir, "ipca_fillmean_37k_nc100_bs500.pkl")
 ipca_model_path = os.path.join(scriptdir, "ipca_160k_nc162_bs8000_col_mean_then_resid_fill.pkl")
 
+## Built from the IPCA model with `manage.py build_item_index`
+item_index_path = os.path.join(scriptdir, "item_index_160k_nc162.npz")
 
+## Memory-mapped export of the pickles below, written with `manage.py export_artifacts`
+artifacts_path = os.path.join(scriptdir, "artifacts")
 
-if Config.LOCAL == False:
-	s3 = boto3.client('s3')
-
-	s3.download_file("brstatic", "static/recommender_data/dict_vectorizer_fit_160k_top_50k_books_duplicates_removed_user_data.pkl", DV_fit_path)
-	s3.download_file("brstatic", "static/recommender_data/engineered_book_data.pkl", book_data_path)
-	s3.download_file("brstatic", "static/recommender_data/ipca_160k_nc162_bs8000_col_mean_then_resid_fill.pkl", ipca_model_path)
-
+## Where recommender_data is mirrored when Config.LOCAL is False
+s3_bucket = "brstatic"
+s3_prefix = "static/recommender_data"
 
 
 
 features_list = []
 
-with open(book_data_path, 'r') as picklefile:
-    book_data = pickle.load(picklefile)
-
-with open(DV_fit_path, 'r') as picklefile:
-    dict_vectorizer_fit = pickle.load(picklefile)
 
-with open(ipca_model_path, 'r') as picklefile:
-    ipca_model = pickle.load(picklefile)
\ No newline at end of file
+def data_file_paths():
+    """
+    Paths, relative to recommender_data, of the local data files the app can load:
+    the pickles, the current artifacts version and the item index.
+    """
+    paths = [os.path.basename(path) for path in [DV_fit_path, book_data_path, ipca_model_path, item_index_path]
+             if os.path.exists(path)]
+    version_dir = current_version_dir(artifacts_path)
+    if version_dir is not None:
+        for name in sorted(os.listdir(version_dir)):
+            if not name.endswith('.sha256'):
+                paths.append(os.path.relpath(os.path.join(version_dir, name), scriptdir))
+        paths.append(os.path.relpath(os.path.join(artifacts_path, 'CURRENT'), scriptdir))
+    return paths
+
+
+def fetch_data_files():
+    """
+    Bring recommender_data up to date with the S3 mirror: files listed in its manifest
+    (see `manage.py write_data_manifest`) are downloaded in parallel unless the local
+    copy already matches.
+    """
+    fetcher = ArtifactFetcher(S3Backend(s3_bucket, s3_prefix), scriptdir)
+    report = fetcher.fetch(fallback_paths=[os.path.basename(path) for path in [DV_fit_path, book_data_path, ipca_model_path]])
+    for row in report:
+        print '{status} {path} ({size:,} bytes, {seconds:.1f}s)'.format(**row)
+    return report
+
+
+class RecommenderModels(object):
+    """
+    Everything the recommender needs from recommender_data, loaded by load_models.
+    """
+    def __init__(self, book_store, dict_vectorizer_fit, ipca_model, fold_in, column_catalog,
+                 keyword_matrix, feature_index, item_index, d3_payloads):
+        self.book_store = book_store
+        self.dict_vectorizer_fit = dict_vectorizer_fit
+        self.ipca_model = ipca_model
+        self.fold_in = fold_in
+        self.column_catalog = column_catalog
+        self.keyword_matrix = keyword_matrix
+        self.feature_index = feature_index
+        self.item_index = item_index
+        self.d3_payloads = d3_payloads
+
+
+## Steps reported by load_models, in order
+load_steps = ['fetch', 'models', 'keyword_matrix', 'fold_in', 'column_catalog', 'feature_index', 'item_index']
+
+
+def load_models(progress=None, artifacts_dir=None):
+    """
+    Load the models and build the per-process engines around them.
+
+    Args:
+    progress: Optional callable, called with the name of each step in load_steps as it starts
+    artifacts_dir: Load this exported artifacts directory instead of recommender_data
+    (nothing is fetched and the pickles are not used)
+
+    Returns:
+    models (RecommenderModels)
+    """
+    if progress is None:
+        progress = lambda step: None
+
+    if Config.LOCAL == False and artifacts_dir is None:
+        progress('fetch')
+        fetch_data_files()
+
+    progress('models')
+    if artifacts_dir is not None:
+        artifacts = load_artifacts(artifacts_dir)
+        if artifacts is None:
+            raise IOError('no artifacts version in {}'.format(artifacts_dir))
+    else:
+        artifacts = load_artifacts(artifacts_path)
+    if artifacts is not None:
+        ## Arrays are mapped read-only, so every worker shares one page cache copy
+        ipca_model = artifacts.load_ipca_model()
+        dict_vectorizer_fit = artifacts.load_dict_vectorizer()
+        book_store = artifacts.load_book_store()
+        d3_payloads = artifacts.load_d3_payloads(book_store)
+    else:
+        with open(book_data_path, 'r') as picklefile:
+            book_data = pickle.load(picklefile)
+        ## Keep the columnar copy only, so workers do not each dirty 50k dicts
+        book_store = BookStore.from_book_data(book_data)
+        del book_data
+        ## Serialised per book on first request; exported artifacts carry them all
+        d3_payloads = D3Payloads(book_store)
+
+        with open(DV_fit_path, 'r') as picklefile:
+            dict_vectorizer_fit = pickle.load(picklefile)
+
+        with open(ipca_model_path, 'r') as picklefile:
+            ipca_model = pickle.load(picklefile)
+
+    ## Keyword rankings of every book as one sparse matrix, used by the similarity stage
+    progress('keyword_matrix')
+    keyword_matrix = KeywordMatrix(book_store)
+
+    ## Precompute the fold-in engine once per process rather than once per request
+    progress('fold_in')
+    fold_in = FoldIn.from_model(ipca_model)
+
+    ## Author codes in dict vectorizer column order, used to filter the collaborative ranking
+    progress('column_catalog')
+    column_catalog = ColumnCatalog(dict_vectorizer_fit.feature_names_, book_store)
+
+    ## Keyword -> dict vectorizer columns, to rank only the books having the requested features
+    progress('feature_index')
+    feature_index = FeatureIndex(dict_vectorizer_fit.feature_names_, book_store)
+
+    ## Approximate nearest-neighbour index over the book vectors if it has been built for
+    ## this model, otherwise the item vectors for an exact search
+    progress('item_index')
+    item_index = None
+    if os.path.exists(item_index_path):
+        item_index = ItemIndex.load(item_index_path)
+        if not item_index.matches(fold_in.components):
+            print 'ignoring {}: built from another model, rebuild it with `manage.py build_item_index`'.format(item_index_path)
+            item_index = None
+    if item_index is None:
+        item_index = ExactIndex.from_components(fold_in.components)
+
+    return RecommenderModels(book_store=book_store, dict_vectorizer_fit=dict_vectorizer_fit, ipca_model=ipca_model,
+                             fold_in=fold_in, column_catalog=column_catalog, keyword_matrix=keyword_matrix,
+                             feature_index=feature_index, item_index=item_index, d3_payloads=d3_payloads)
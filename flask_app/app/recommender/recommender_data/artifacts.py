@@ -0,0 +1,157 @@
+"""
+Versioned, memory-mappable model artifacts.
+
+export_artifacts writes the IPCA components, mean, dict vectorizer columns, the
+BookStore and the serialised D3 payload of every book as flat .npy files into
+<directory>/<version>/ and points <directory>/CURRENT at it. load_artifacts maps
+those files with np.load(mmap_mode='r'), so startup does not unpickle anything and
+every worker process shares the same page cache copy.
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from sklearn.feature_extraction import DictVectorizer
+
+from flask_app.app.recommender.book_store import BookStore, StringTable
+from flask_app.app.recommender.d3_payloads import D3Payloads
+
+
+FORMAT_VERSION = 2
+
+
+def export_artifacts(directory, book_store, dict_vectorizer_fit, ipca_model, version=None):
+    """
+    Write the models into a new version directory and make it the current one.
+
+    Args:
+    directory: The artifacts root, e.g. recommender_data/artifacts
+    book_store: The BookStore (title, author, description and keyword rankings per book)
+    dict_vectorizer_fit: The dict vectorizer fit on all user ratings
+    ipca_model: The IPCA model fit on the full rating matrix
+    version: Name of the version directory (default: a timestamp)
+
+    Returns:
+    version_dir: The path of the written version.
+    """
+    if version is None:
+        version = time.strftime('%Y%m%d%H%M%S')
+    version_dir = os.path.join(directory, version)
+    ## Write next to the final location, then rename, so readers never see half a version
+    tmp_dir = version_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    np.save(os.path.join(tmp_dir, 'components.npy'), np.ascontiguousarray(ipca_model.components_))
+    np.save(os.path.join(tmp_dir, 'mean.npy'), ipca_model.mean_)
+    np.save(os.path.join(tmp_dir, 'explained_variance.npy'), ipca_model.explained_variance_)
+    StringTable.from_strings(dict_vectorizer_fit.feature_names_).save(tmp_dir, 'columns')
+    book_store.save(tmp_dir)
+    d3_payloads, d3_etags = D3Payloads.build_tables(book_store)
+    d3_payloads.save(tmp_dir, 'd3_payloads')
+    d3_etags.save(tmp_dir, 'd3_etags')
+
+    manifest = {'format_version': FORMAT_VERSION,
+                'version': version,
+                'n_components': int(ipca_model.components_.shape[0]),
+                'n_columns': int(ipca_model.components_.shape[1]),
+                'n_books': len(book_store),
+                'whiten': bool(getattr(ipca_model, 'whiten', False)),
+                'dict_vectorizer': {'sparse': bool(dict_vectorizer_fit.sparse),
+                                    'separator': dict_vectorizer_fit.separator}}
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    if os.path.exists(version_dir):
+        shutil.rmtree(version_dir)
+    os.rename(tmp_dir, version_dir)
+    with open(os.path.join(directory, 'CURRENT.tmp'), 'w') as current_file:
+        current_file.write(version)
+    os.rename(os.path.join(directory, 'CURRENT.tmp'), os.path.join(directory, 'CURRENT'))
+    return version_dir
+
+
+def current_version_dir(directory):
+    """
+    Return the directory of the current artifacts version, or None if nothing was exported.
+    """
+    current_path = os.path.join(directory, 'CURRENT')
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path) as current_file:
+        return os.path.join(directory, current_file.read().strip())
+
+
+class ModelArtifacts(object):
+    """
+    The models loaded from an artifacts version, in the shapes the recommender expects.
+    """
+    def __init__(self, version_dir, mmap_mode='r'):
+        with open(os.path.join(version_dir, 'manifest.json')) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest['format_version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported artifacts format {} in {}; re-run manage.py export_artifacts'.format(self.manifest['format_version'], version_dir))
+        self.version_dir = version_dir
+        self.mmap_mode = mmap_mode
+
+        self.components = self.array('components')
+        self.mean = self.array('mean')
+        self.explained_variance = self.array('explained_variance')
+        self.columns = self.string_table('columns')
+
+    def load_ipca_model(self):
+        """
+        Return an IncrementalPCA whose fitted arrays are the mapped files.
+        """
+        ipca_model = IncrementalPCA(n_components=self.manifest['n_components'], whiten=self.manifest['whiten'])
+        ipca_model.components_ = self.components
+        ipca_model.mean_ = self.mean
+        ipca_model.explained_variance_ = self.explained_variance
+        ipca_model.n_components_ = self.manifest['n_components']
+        return ipca_model
+
+    def load_dict_vectorizer(self):
+        """
+        Return a DictVectorizer with the exported columns.
+        """
+        settings = self.manifest['dict_vectorizer']
+        dict_vectorizer_fit = DictVectorizer(separator=str(settings['separator']), sparse=settings['sparse'])
+        dict_vectorizer_fit.feature_names_ = [str(book_id) for book_id in self.columns]
+        dict_vectorizer_fit.vocabulary_ = dict((book_id, column) for column, book_id
+                                               in enumerate(dict_vectorizer_fit.feature_names_))
+        return dict_vectorizer_fit
+
+    def array(self, name):
+        return np.load(os.path.join(self.version_dir, name + '.npy'), mmap_mode=self.mmap_mode)
+
+    def string_table(self, name):
+        return StringTable.load(self.version_dir, name, self.mmap_mode)
+
+    def load_book_store(self):
+        """
+        Return the BookStore over the mapped book tables.
+        """
+        return BookStore.load(self.version_dir, self.mmap_mode)
+
+    def load_d3_payloads(self, book_store):
+        """
+        Return the D3Payloads over the mapped payload tables, or one that builds payloads
+        on demand if this version was exported without them.
+        """
+        if not os.path.exists(os.path.join(self.version_dir, 'd3_payloads.npy')):
+            return D3Payloads(book_store)
+        return D3Payloads(book_store, payloads=self.string_table('d3_payloads'), etags=self.string_table('d3_etags'))
+
+
+def load_artifacts(directory, mmap_mode='r'):
+    """
+    Load the current artifacts version under directory, or return None if there is none.
+    """
+    version_dir = current_version_dir(directory)
+    if version_dir is None:
+        return None
+    return ModelArtifacts(version_dir, mmap_mode=mmap_mode)
@@ -0,0 +1,259 @@
+"""
+Concurrent, checksummed download of the recommender data files.
+
+A manifest (manifest.json next to the files) lists each file's path, size and sha256.
+ArtifactFetcher reads it from a backend, skips every file whose local copy already
+matches, and downloads the rest as ranged parts in parallel, verifying each file
+before moving it into place.
+
+Workers starting together take turns through a lock file in the directory, so only
+the first downloads; the others find valid copies once they get the lock. Each
+download also goes to its own temporary file, so even processes that do not share
+the lock never write to each other's parts.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = '.fetch.lock'
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(chunk_size), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def build_manifest(directory, paths):
+    """
+    Describe local files for the fetcher.
+
+    Args:
+    directory: The directory the paths are relative to
+    paths: Relative paths of the files to list
+
+    Returns:
+    manifest (dict): {'files': [{'path', 'size', 'sha256'}, ...]}
+    """
+    files = []
+    for path in paths:
+        local_path = os.path.join(directory, path)
+        files.append({'path': path, 'size': os.path.getsize(local_path), 'sha256': file_sha256(local_path)})
+    return {'files': files}
+
+
+class LocalDirectoryBackend(object):
+    """
+    Serve files from a local directory; a stand-in for S3Backend.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.root, path))
+
+    def size(self, path):
+        return os.path.getsize(os.path.join(self.root, path))
+
+    def read_range(self, path, start, stop):
+        with open(os.path.join(self.root, path), 'rb') as data_file:
+            data_file.seek(start)
+            return data_file.read(stop - start)
+
+
+class S3Backend(object):
+    """
+    Serve files from an S3 bucket under a key prefix, reading byte ranges with GetObject.
+    """
+    def __init__(self, bucket, prefix, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.client = client
+
+    def key(self, path):
+        return '{}/{}'.format(self.prefix, path)
+
+    def exists(self, path):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+        except ClientError:
+            return False
+        return True
+
+    def size(self, path):
+        return self.client.head_object(Bucket=self.bucket, Key=self.key(path))['ContentLength']
+
+    def read_range(self, path, start, stop):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key(path),
+                                          Range='bytes={}-{}'.format(start, stop - 1))
+        return response['Body'].read()
+
+
+class ArtifactFetcher(object):
+    """
+    Bring a local directory up to date with the files listed in the backend's manifest.
+
+    Local copies are checked by size and sha256. The result of hashing a file is kept
+    in a <file>.sha256 note with its size and mtime, so unchanged files are not hashed
+    again on the next start.
+    """
+    def __init__(self, backend, directory, max_workers=8, part_size=16 * 1024 * 1024, retries=3):
+        self.backend = backend
+        self.directory = directory
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.retries = retries
+
+    def load_manifest(self, fallback_paths=()):
+        """
+        Read the manifest from the backend. If there is none, list fallback_paths with
+        their remote sizes and no hash, so those files are only checked by size.
+        """
+        if self.backend.exists(MANIFEST_NAME):
+            return json.loads(self.backend.read_range(MANIFEST_NAME, 0, self.backend.size(MANIFEST_NAME)))
+        print 'no {} in the backend, checking {} files by size only'.format(MANIFEST_NAME, len(fallback_paths))
+        return {'files': [{'path': path, 'size': self.backend.size(path), 'sha256': None} for path in fallback_paths]}
+
+    def local_path(self, path):
+        return os.path.join(self.directory, path)
+
+    def is_valid(self, entry):
+        """
+        Return True if the local copy of a manifest entry has the right size and hash.
+        """
+        path = self.local_path(entry['path'])
+        if not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+            return False
+        if entry['sha256'] is None:
+            return True
+        return self.local_sha256(path) == entry['sha256']
+
+    def local_sha256(self, path):
+        stat = os.stat(path)
+        note_path = path + '.sha256'
+        if os.path.exists(note_path):
+            with open(note_path) as note_file:
+                note = json.load(note_file)
+            if note['size'] == stat.st_size and note['mtime'] == stat.st_mtime:
+                return note['sha256']
+        sha256 = file_sha256(path)
+        self.write_note(path, sha256)
+        return sha256
+
+    def write_note(self, path, sha256):
+        stat = os.stat(path)
+        with open(path + '.sha256', 'w') as note_file:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256}, note_file)
+
+    def fetch(self, fallback_paths=()):
+        """
+        Download every file of the manifest whose local copy is missing or invalid.
+
+        Args:
+        fallback_paths: Files to fetch (size-checked only) when the backend has no manifest
+
+        Returns:
+        report (list of dicts): For each file, its path, size, whether it was 'skipped' or
+        'downloaded', and the seconds spent on it.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, LOCK_NAME), 'w') as lock_file:
+            ## Held until every file is in place; whoever waited then finds them valid
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return self.fetch_locked(fallback_paths)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fetch_locked(self, fallback_paths):
+        manifest = self.load_manifest(fallback_paths)
+        report = []
+        pending = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for entry in manifest['files']:
+                    start = time.time()
+                    if self.is_valid(entry):
+                        report.append({'path': entry['path'], 'size': entry['size'], 'status': 'skipped',
+                                       'seconds': time.time() - start})
+                        continue
+                    part_path, futures = self.start_download(executor, entry)
+                    pending.append((entry, start, part_path, futures))
+                ## Parts of every file are queued together; finish the files in manifest order
+                for entry, start, part_path, futures in pending:
+                    for future in futures:
+                        future.result()
+                    self.finish_download(entry, part_path)
+                    report.append({'path': entry['path'], 'size': entry['size'], 'status': 'downloaded',
+                                   'seconds': time.time() - start})
+        finally:
+            for entry, start, part_path, futures in pending:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+        return report
+
+    def start_download(self, executor, entry):
+        """
+        Preallocate a temporary part file next to the file and queue one ranged read per
+        part_size bytes.
+
+        Returns:
+        part_path: The part file, named for this download only
+        futures: The queued reads
+        """
+        path = self.local_path(entry['path'])
+        part_dir = os.path.dirname(path)
+        if not os.path.isdir(part_dir):
+            os.makedirs(part_dir)
+        part_fd, part_path = tempfile.mkstemp(dir=part_dir, prefix=os.path.basename(path) + '.', suffix='.part')
+        with os.fdopen(part_fd, 'wb') as part_file:
+            part_file.truncate(entry['size'])
+        lock = threading.Lock()
+        return part_path, [executor.submit(self.download_part, entry['path'], part_path, lock, start,
+                                min(start + self.part_size, entry['size']))
+                for start in range(0, entry['size'], self.part_size)]
+
+    def download_part(self, path, part_path, lock, start, stop):
+        for attempt in range(self.retries):
+            try:
+                data = self.backend.read_range(path, start, stop)
+                if len(data) != stop - start:
+                    raise IOError('short read of {} bytes {}-{}'.format(path, start, stop))
+                break
+            except Exception:
+                if attempt == self.retries - 1:
+                    raise
+        with lock:
+            with open(part_path, 'r+b') as part_file:
+                part_file.seek(start)
+                part_file.write(data)
+
+    def finish_download(self, entry, part_path):
+        """
+        Verify the downloaded part file and move it into place.
+        """
+        path = self.local_path(entry['path'])
+        if entry['sha256'] is not None:
+            sha256 = file_sha256(part_path)
+            if sha256 != entry['sha256']:
+                os.remove(part_path)
+                raise IOError('checksum mismatch for {}: expected {}, got {}'.format(entry['path'], entry['sha256'], sha256))
+        ## mkstemp creates the file readable by its owner only
+        os.chmod(part_path, 0o644)
+        os.rename(part_path, path)
+        if entry['sha256'] is not None:
+            self.write_note(path, entry['sha256'])
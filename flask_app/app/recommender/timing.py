@@ -0,0 +1,58 @@
+"""
+Wall-clock timing of the stages of a recommendation.
+
+Recommend wraps each stage in self.stage(name); without a timer that is a shared
+no-op context manager, so requests that nobody is measuring pay one attribute check.
+"""
+import time
+
+
+## Stage names, in pipeline order
+PREPARE_RATINGS = 'prepare_ratings_for_dv'
+DV_TRANSFORM = 'dv_transform'
+IPCA = 'ipca'
+LATENT_STATE = 'latent_state'
+TOP_N = 'top_n'
+SIMILARITY_FILTERING = 'similarity_filtering'
+JSON_SERIALIZATION = 'json_serialization'
+
+stages = [PREPARE_RATINGS, DV_TRANSFORM, IPCA, LATENT_STATE, TOP_N, SIMILARITY_FILTERING, JSON_SERIALIZATION]
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_stage = NullStage()
+
+
+class TimedStage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.name, time.time() - self.start)
+        return False
+
+
+class StageTimer(object):
+    """
+    Keep every duration recorded for each stage, in seconds.
+    """
+    def __init__(self):
+        self.seconds = {}
+
+    def stage(self, name):
+        return TimedStage(self, name)
+
+    def record(self, name, seconds):
+        self.seconds.setdefault(name, []).append(seconds)
@@ -0,0 +1,270 @@
+"""
+Out-of-core IPCA training on the user x book rating matrix.
+
+Ratings are streamed user by user from the reads table (or an exported CSR
+directory), turned into dense batches with the column-mean-then-residual fill,
+and fed to IncrementalPCA.partial_fit. A producer thread builds the next batch
+while the current one is being fitted, and at most `prefetch` batches wait in
+between, so memory is bounded by the batch size rather than the user count.
+"""
+import os
+import threading
+import time
+from Queue import Queue
+
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from sklearn.feature_extraction import DictVectorizer
+
+from book_store import StringTable
+
+
+class ColumnStats(object):
+    """
+    The books kept as columns (web ids as strings, sorted like DictVectorizer
+    feature names) with the mean rating of each.
+    """
+    def __init__(self, book_ids, means):
+        order = np.argsort(book_ids, kind='mergesort')
+        self.book_ids = [book_ids[i] for i in order]
+        self.means = np.asarray(means, dtype=np.float64)[order]
+        self.vocabulary = dict((book_id, column) for column, book_id in enumerate(self.book_ids))
+
+    @classmethod
+    def top_books(cls, book_counts_means, max_books=None, min_ratings=1):
+        """
+        Keep the max_books most rated books with at least min_ratings ratings.
+
+        Args:
+        book_counts_means: (book_id, n_ratings, mean_rating) tuples
+        """
+        kept = sorted((row for row in book_counts_means if row[1] >= min_ratings), key=lambda row: -row[1])
+        if max_books is not None:
+            kept = kept[:max_books]
+        return cls([str(book_id) for book_id, _, _ in kept], [mean for _, _, mean in kept])
+
+    def dict_vectorizer(self):
+        """
+        Return a DictVectorizer over these columns, as the recommender uses to place end-users.
+        """
+        dict_vectorizer_fit = DictVectorizer(sparse=False)
+        dict_vectorizer_fit.feature_names_ = list(self.book_ids)
+        dict_vectorizer_fit.vocabulary_ = dict(self.vocabulary)
+        return dict_vectorizer_fit
+
+
+def fill_batch(users, column_stats):
+    """
+    Build the dense rating matrix of a batch of users with the column-mean-then-residual
+    fill: an unrated book gets its column mean plus the user's mean residual (how far
+    the user's ratings sit above or below the column means of the books they rated).
+
+    Args:
+    users: List of book_id:rating dicts
+    column_stats: ColumnStats of the columns to fill
+
+    Returns:
+    batch: (len(users), n_columns) array
+    """
+    batch = np.tile(column_stats.means, (len(users), 1))
+    vocabulary = column_stats.vocabulary
+    for row, ratings in enumerate(users):
+        columns = []
+        values = []
+        for book_id, rating in ratings.items():
+            column = vocabulary.get(book_id)
+            if column is not None:
+                columns.append(column)
+                values.append(rating)
+        if not columns:
+            continue
+        values = np.asarray(values, dtype=np.float64)
+        residual = (values - column_stats.means[columns]).mean()
+        batch[row] += residual
+        batch[row, columns] = values
+    return batch
+
+
+class ReadTableSource(object):
+    """
+    Ratings from the reads table, keyed by book web id.
+
+    iter_users runs on the producer thread, so it pushes its own app context.
+    """
+    def __init__(self, db, Read, Book, app, rows_per_fetch=10000):
+        self.db = db
+        self.Read = Read
+        self.Book = Book
+        self.app = app
+        self.rows_per_fetch = rows_per_fetch
+
+    def book_counts_means(self):
+        Read, Book = self.Read, self.Book
+        return (self.db.session.query(Book.web_id, self.db.func.count(Read.rating), self.db.func.avg(Read.rating))
+                .join(Read, Read.book_id == Book.id)
+                .filter(Read.rating.isnot(None))
+                .group_by(Book.web_id)
+                .all())
+
+    def n_users(self):
+        return self.db.session.query(self.db.func.count(self.db.distinct(self.Read.user_id))).scalar()
+
+    def iter_users(self):
+        """
+        Yield one book_id:rating dict per user, streaming the rows ordered by user.
+        """
+        with self.app.app_context():
+            for ratings in self.iter_users_in_context():
+                yield ratings
+
+    def iter_users_in_context(self):
+        Read, Book = self.Read, self.Book
+        rows = (self.db.session.query(Read.user_id, Book.web_id, Read.rating)
+                .join(Book, Book.id == Read.book_id)
+                .filter(Read.rating.isnot(None))
+                .order_by(Read.user_id)
+                .execution_options(stream_results=True)
+                .yield_per(self.rows_per_fetch))
+        user_id = None
+        ratings = {}
+        for row_user_id, web_id, rating in rows:
+            if row_user_id != user_id:
+                if ratings:
+                    yield ratings
+                user_id = row_user_id
+                ratings = {}
+            ratings[str(web_id)] = float(rating)
+        if ratings:
+            yield ratings
+
+
+class CsrSource(object):
+    """
+    Ratings from an exported CSR directory: indptr.npy, indices.npy and ratings.npy
+    (one row per user) and a `columns` string table of the book id of each index.
+    The arrays are memory-mapped, so only the rows being batched are read.
+    """
+    def __init__(self, directory):
+        self.indptr = np.load(os.path.join(directory, 'indptr.npy'), mmap_mode='r')
+        self.indices = np.load(os.path.join(directory, 'indices.npy'), mmap_mode='r')
+        self.ratings = np.load(os.path.join(directory, 'ratings.npy'), mmap_mode='r')
+        self.columns = [str(book_id) for book_id in StringTable.load(directory, 'columns')]
+
+    @staticmethod
+    def export(directory, users, columns):
+        """
+        Write users (book_id:rating dicts) in the format read by CsrSource.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        vocabulary = dict((book_id, column) for column, book_id in enumerate(columns))
+        indptr = [0]
+        indices = []
+        ratings = []
+        for user in users:
+            for book_id, rating in user.items():
+                if book_id in vocabulary:
+                    indices.append(vocabulary[book_id])
+                    ratings.append(rating)
+            indptr.append(len(indices))
+        np.save(os.path.join(directory, 'indptr.npy'), np.array(indptr, dtype=np.int64))
+        np.save(os.path.join(directory, 'indices.npy'), np.array(indices, dtype=np.int32))
+        np.save(os.path.join(directory, 'ratings.npy'), np.array(ratings, dtype=np.float32))
+        StringTable.from_strings(columns).save(directory, 'columns')
+
+    def book_counts_means(self):
+        counts = np.bincount(self.indices, minlength=len(self.columns))
+        sums = np.bincount(self.indices, weights=self.ratings, minlength=len(self.columns))
+        rated = np.flatnonzero(counts)
+        return [(self.columns[column], counts[column], sums[column] / counts[column]) for column in rated]
+
+    def n_users(self):
+        return len(self.indptr) - 1
+
+    def iter_users(self):
+        for row in range(len(self.indptr) - 1):
+            start, stop = self.indptr[row], self.indptr[row + 1]
+            yield dict((self.columns[index], float(rating)) for index, rating
+                       in zip(self.indices[start:stop], self.ratings[start:stop]))
+
+
+## Sent through the batch queue once the producer has no more users
+END = None
+
+
+def produce_batches(source, column_stats, batch_size, queue, errors):
+    try:
+        users = []
+        for ratings in source.iter_users():
+            users.append(ratings)
+            if len(users) == batch_size:
+                queue.put(fill_batch(users, column_stats))
+                users = []
+        if users:
+            queue.put(fill_batch(users, column_stats))
+    except Exception as error:
+        errors.append(error)
+    finally:
+        queue.put(END)
+
+
+def train_ipca(source, n_components, batch_size=2000, max_books=50000, min_ratings=1, prefetch=1,
+               report=None):
+    """
+    Fit an IncrementalPCA on every user of source, one filled batch at a time.
+
+    Args:
+    source: ReadTableSource or CsrSource
+    n_components: Number of IPCA components
+    batch_size: Users per partial_fit; the dense batch is batch_size x max_books floats
+    max_books: Keep only the most rated books as columns
+    min_ratings: Drop books with fewer ratings
+    prefetch: Filled batches allowed to wait for the fitter
+    report: Optional callable, called with a progress dict after each batch
+
+    Returns:
+    ipca_model, dict_vectorizer_fit, summary (dict of users, batches, skipped users and seconds)
+    """
+    column_stats = ColumnStats.top_books(source.book_counts_means(), max_books=max_books, min_ratings=min_ratings)
+    if n_components > len(column_stats.book_ids):
+        raise ValueError('n_components={} is more than the {} columns kept'.format(n_components, len(column_stats.book_ids)))
+    n_users = source.n_users()
+
+    ipca_model = IncrementalPCA(n_components=n_components, batch_size=batch_size)
+    queue = Queue(maxsize=prefetch)
+    errors = []
+    producer = threading.Thread(target=produce_batches, args=(source, column_stats, batch_size, queue, errors),
+                                name='ipca-batch-producer')
+    producer.daemon = True
+    producer.start()
+
+    start = time.time()
+    users_fitted = 0
+    users_skipped = 0
+    batches = 0
+    while True:
+        batch = queue.get()
+        if batch is END:
+            break
+        ## partial_fit needs at least n_components samples; only a short last batch can fall below
+        if len(batch) < n_components:
+            users_skipped += len(batch)
+            continue
+        ipca_model.partial_fit(batch)
+        batches += 1
+        users_fitted += len(batch)
+        if report is not None:
+            elapsed = time.time() - start
+            users_per_second = users_fitted / max(elapsed, 1e-9)
+            report({'batches': batches, 'users': users_fitted, 'n_users': n_users, 'seconds': elapsed,
+                    'users_per_second': users_per_second,
+                    'eta_seconds': max(n_users - users_fitted, 0) / max(users_per_second, 1e-9)})
+    producer.join()
+    if errors:
+        raise errors[0]
+    if batches == 0:
+        raise ValueError('no batch of at least {} users to fit'.format(n_components))
+
+    summary = {'users': users_fitted, 'skipped_users': users_skipped, 'batches': batches,
+               'columns': len(column_stats.book_ids), 'seconds': time.time() - start}
+    return ipca_model, column_stats.dict_vectorizer(), summary
@@ -1,14 +1,22 @@
-from flask import render_template, session, redirect, url_for, g, request, jsonify
-from . import recommender
+from flask import render_template, session, redirect, url_for, g, request, jsonify, current_app, Response, stream_with_context
+from functools import wraps
+from . import recommender, model_holder
 from .. import db
 from ..models import User, Book, Read
+from ..reads import user_reads
 from flask_app.config import Config, config
 from flask.ext.login import login_required, current_user
 from flask_wtf.csrf import CsrfProtect
-from recommend import Recommend, format_keywords_for_d3, get_book_info
-import recommender_data
-from recommender_data import book_data, dict_vectorizer_fit, ipca_model
+from recommend import Recommend
+from cache import ResultCache
+from model_holder import ModelsNotReady
+from jobs import JobQueue, job_status
+from metrics import registry, render
+import timing
+import json
 import os
+import tempfile
+import time
 
 
 
@@ -18,19 +26,117 @@ def before_request():
     g.user = current_user
 
 
+default_jobs_dir = os.path.join(tempfile.gettempdir(), 'recommender_jobs')
+
+
+## Per worker process caches: collaborative rankings kept between pages,
+## and each user's latent vector kept between votes
+caches = {}
+cache_defaults = {'RANKING_CACHE': (512, 64 * 1024 * 1024, 600),
+                  'LATENT_CACHE': (4096, 16 * 1024 * 1024, 1800)}
+
+
+def get_cache(name):
+    """
+    Return this process's cache called name, creating it on first use from the
+    app config (<name>_ENTRIES, <name>_BYTES, <name>_TTL) or cache_defaults.
+    """
+    if name not in caches:
+        max_entries, max_bytes, ttl = cache_defaults[name]
+        caches[name] = ResultCache(max_entries=current_app.config.get(name + '_ENTRIES', max_entries),
+                                   max_bytes=current_app.config.get(name + '_BYTES', max_bytes),
+                                   ttl=current_app.config.get(name + '_TTL', ttl))
+    return caches[name]
+
+
+def cache_stats():
+    return {'caches': dict((name, cache.stats()) for name, cache in caches.items())}
+
+registry.add_collector(cache_stats)
+
+
+@recommender.after_app_request
+def flush_metrics(response):
+    registry.maybe_flush()
+    return response
+
+
+def stage_timer():
+    """
+    The timer Recommend records its stages with: this process's metrics registry, unless
+    RECOMMENDER_METRICS is off.
+    """
+    if current_app.config.get('RECOMMENDER_METRICS', True):
+        return registry
+    return None
+
+
+def models_required(view):
+    """
+    Put the recommender models in g.models, or answer 503 straight away while they load.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            g.models = model_holder.get()
+        except ModelsNotReady:
+            status = model_holder.status()
+            if status['state'] == 'failed':
+                error = "recommender models failed to load" + (" (not retrying)" if status.get('permanent') else "")
+            else:
+                error = "recommender models are loading"
+            response = jsonify({"error": error, "status": status})
+            response.status_code = 503
+            if not status.get('permanent'):
+                response.headers['Retry-After'] = str(int(max(status.get('retry_in', 5), 1)))
+            return response
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def make_recommender(collab_start_point=0):
+    """
+    Build a Recommend for the current user around the models in g.models.
+    """
+    models = g.models
+    return Recommend(user=g.user, db=db, Read=Read, Book=Book,
+                     book_store=models.book_store, ipca_model=models.ipca_model, 
+                     dict_vectorizer_fit=models.dict_vectorizer_fit,
+                     collab_start_point=collab_start_point,
+                     fold_in=models.fold_in, column_catalog=models.column_catalog,
+                     keyword_matrix=models.keyword_matrix, feature_index=models.feature_index,
+                     item_index=models.item_index, ranking_cache=get_cache('RANKING_CACHE'),
+                     latent_cache=get_cache('LATENT_CACHE'), timer=stage_timer(),
+                     use_ratings=current_app.config.get('RECOMMENDER_USE_RATINGS', False))
+
+
+# Model loading progress; 200 once recommendations can be served, 503 until then
+@recommender.route('/healthz/ready', methods=['GET'])
+def ready():
+    status = model_holder.status()
+    response = jsonify(status)
+    if not status['ready']:
+        response.status_code = 503
+    return response
+
+
+# Stage, query and cache metrics of every worker, in the Prometheus text format
+@recommender.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render(registry.collect()), mimetype='text/plain; version=0.0.4')
+
+
 @recommender.route('/recommendations', methods=['GET', 'POST']) 
 @login_required
 def recommendations():
-    books_read = []
-    for book_read in current_user.books_read:
-        book = db.session.query(Book).filter_by(id=book_read.book_id).first()
-        web_id = book.web_id
-        books_read.append(web_id)
-    return render_template('recommendations.html', current_user=g.user, db=db, Book=Book, books_read=books_read)
+    reads = user_reads(current_user.id)
+    books_read = [read.web_id for read in reads]
+    return render_template('recommendations.html', current_user=g.user, reads=reads, books_read=books_read)
 
-@recommender.route('/recommendations/results', methods=['GET', 'POST']) 
-@login_required
-def results():    
+def parse_recommendation_data():
+    """
+    Read the end-user's selection, votes and paging from the recommendation_data request into g.
+    """
     g.data = request.json
     g.data = g.data['recommendation_data'][0]
     g.books_selected = g.data['books_selected']
@@ -49,10 +155,15 @@ def results():
         g.books_returned.append(str(book))
 
 
-    g.Recommend = Recommend(user=g.user, db=db, Read=Read, Book=Book,
-                            book_data=book_data, ipca_model=ipca_model, 
-                            dict_vectorizer_fit=dict_vectorizer_fit,
-                            collab_start_point=g.collab_start_point)
+@recommender.route('/recommendations/results', methods=['GET', 'POST']) 
+@login_required
+@models_required
+def results():    
+    parse_recommendation_data()
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return stream_results()
+
+    g.Recommend = make_recommender(collab_start_point=g.collab_start_point)
     g.recommended_books = g.Recommend.recommend_books(books_selected=g.books_selected, 
                                                       features_list=g.features_list, 
                                                       books_returned=g.books_returned,
@@ -60,18 +171,167 @@ def results():
                                                       down_votes=g.down_voted,
                                                       n_collab_returned=100)
     rec_data = {"recommendations": g.recommended_books, "collab_returned":g.Recommend.collab_returned}
-    return jsonify(rec_data)
+    if g.Recommend.timer is not None:
+        registry.observe('recommender_similarity_windows', g.Recommend.similarity_windows)
+    with g.Recommend.stage(timing.JSON_SERIALIZATION):
+        response = jsonify(rec_data)
+    return response
+
+## This process's job queue, created by create_app when RECOMMENDER_JOBS is on
+job_queues = []
+
+
+def get_job_queue():
+    if not job_queues:
+        metrics = current_app.config.get('RECOMMENDER_METRICS', True)
+        job_queue = JobQueue(directory=current_app.config.get('RECOMMENDER_JOBS_DIR', default_jobs_dir),
+                             load_models=model_holder.load,
+                             processes=current_app.config.get('RECOMMENDER_JOB_WORKERS', 2),
+                             ttl=current_app.config.get('RECOMMENDER_JOB_TTL', 600),
+                             timeout=current_app.config.get('RECOMMENDER_JOB_TIMEOUT', 120),
+                             metrics=metrics)
+        if metrics:
+            registry.add_collector(job_queue.stats)
+        job_queues.append(job_queue)
+    return job_queues[0]
+
+
+def jobs_required(view):
+    """
+    Answer 404 unless job mode is on (RECOMMENDER_JOBS).
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_app.config.get('RECOMMENDER_JOBS', False):
+            response = jsonify({"error": "recommendation jobs are off"})
+            response.status_code = 404
+            return response
+        return view(*args, **kwargs)
+    return wrapper
+
+
+# Queue the same request as /recommendations/results on the worker pool and return its job id
+@recommender.route('/recommendations/jobs', methods=['POST'])
+@login_required
+@jobs_required
+@models_required
+def submit_job():
+    parse_recommendation_data()
+    selection_ratings = None
+    if current_app.config.get('RECOMMENDER_USE_RATINGS', False):
+        selection_ratings = make_recommender().user_ratings(g.books_selected)
+    job_request = {'books_selected': g.books_selected, 'features_list': g.features_list,
+                   'books_returned': g.books_returned, 'up_votes': g.up_voted, 'down_votes': g.down_voted,
+                   'collab_start_point': g.collab_start_point}
+    job_id = get_job_queue().submit(g.user.id, job_request, selection_ratings=selection_ratings)
+    response = jsonify({"job_id": job_id, "state": "queued",
+                        "status_url": url_for('recommender.job', job_id=job_id)})
+    response.status_code = 202
+    return response
+
+
+def find_job(job_id):
+    if not job_id.isalnum():
+        return None
+    return get_job_queue().get(job_id, g.user.id)
+
+
+# Poll a job: its state, and the recommendations once done. With ?wait=<seconds> the
+# request waits for the job to finish, for at most RECOMMENDER_JOB_MAX_WAIT seconds, so
+# that a sync worker is never held for long; an unfinished job is answered with a
+# Retry-After telling the client when to poll again.
+@recommender.route('/recommendations/jobs/<job_id>', methods=['GET'])
+@login_required
+@jobs_required
+def job(job_id):
+    wait = min(max(request.args.get('wait', 0, type=float), 0),
+               current_app.config.get('RECOMMENDER_JOB_MAX_WAIT', 10))
+    deadline = time.time() + wait
+    record = find_job(job_id)
+    while record is not None and record['state'] not in ('done', 'failed') and time.time() < deadline:
+        time.sleep(0.05)
+        record = find_job(job_id)
+    if record is None:
+        response = jsonify({"error": "no such job"})
+        response.status_code = 404
+        return response
+    status = job_status(record)
+    response = jsonify(status)
+    if status['state'] not in ('done', 'failed'):
+        response.headers['Retry-After'] = str(current_app.config.get('RECOMMENDER_JOB_POLL_INTERVAL', 1))
+    return response
+
+
+def stream_results():
+    """
+    Answer /recommendations/results as JSON lines: the best collaborative candidates
+    as soon as the collaborative stage is done, then the refined recommendations.
+    """
+    g.Recommend = make_recommender(collab_start_point=g.collab_start_point)
+    n_candidates = current_app.config.get('RECOMMENDER_STREAM_CANDIDATES', 6)
+    excluded = set(g.books_returned + g.books_selected)
+
+    def lines():
+        stages = g.Recommend.recommend_stages(books_selected=g.books_selected, features_list=g.features_list,
+                                              books_returned=g.books_returned, up_votes=g.up_voted,
+                                              down_votes=g.down_voted, n_collab_returned=100)
+        for stage, books in stages:
+            if stage == 'candidates':
+                books = [book_id for book_id in books if book_id not in excluded][:n_candidates]
+            elif g.Recommend.timer is not None:
+                registry.observe('recommender_similarity_windows', g.Recommend.similarity_windows)
+            with g.Recommend.stage(timing.JSON_SERIALIZATION):
+                line = json.dumps({"stage": stage, stage: books, "collab_returned": g.Recommend.collab_returned})
+            yield line + '\n'
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Books closest to the up-voted books in the latent space, without re-running the full recommendation
+@recommender.route('/recommendations/similar', methods=['POST'])
+@login_required
+@models_required
+def similar():
+    g.data = request.json
+    g.up_voted = g.data['up_voted']
+    ## As in /recommendations/results, books already returned or read are never suggested
+    g.books_returned = [str(book) for book in g.data.get('books_returned', []) + g.data.get('books_read', [])]
+    g.similar_books = make_recommender().books_near(g.up_voted, n=g.data.get('n', 6), books_returned=g.books_returned)
+    return jsonify({"recommendations": g.similar_books})
+
+def d3_response(book_id):
+    """
+    Answer with the book's pre-serialised D3 payload, or a 304 when the client already
+    holds it. Nothing is parsed or built: the body is the stored bytes.
+    """
+    entry = g.models.d3_payloads.get(book_id)
+    if entry is None:
+        response = jsonify({"error": "unknown book"})
+        response.status_code = 404
+        return response
+    etag, body = entry
+    headers = {'ETag': etag,
+               'Cache-Control': 'public, max-age={}'.format(current_app.config.get('RECOMMENDER_D3_MAX_AGE', 86400))}
+    if request.if_none_match.contains_weak(etag[1:-1]):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+# A book's keywords and info for the d3 visualization. The payload is the same for every
+# user, so it is served without a login and cached by browsers and proxies.
+@recommender.route("/recommendations/books/<book_id>/d3", methods=["GET"])
+@models_required
+def book_d3(book_id):
+    return d3_response(book_id)
 
-# Get user books and features input and return recommendations 
+# Same payload for clients still posting the book id
 @recommender.route("/recommendations/results/visualize", methods=["POST"])
 @login_required
+@models_required
 def keywords_to_d3():
     g.data = request.json
     g.book_id = g.data["book_id"][0]
-    g.book_keywords = book_data[g.book_id]['keywords']
-    g.d3_keywords = format_keywords_for_d3(g.book_keywords)
-    g.book_info = get_book_info(g.book_id, book_data)
-    g.results = {"book_info":g.book_info, "d3_info": {'name': 'flare', "children": [{'name': 'cluster', 'children': g.d3_keywords}]}}
-    return jsonify(g.results)
+    return d3_response(g.book_id)
 
          
@@ -0,0 +1,339 @@
+"""
+In-process title/author index for search-as-you-type.
+
+Every word of a book's title and author goes into a sorted vocabulary, so the books
+whose words start with a typed prefix are found with two bisects; word trigrams catch
+misspellings when the prefixes match too few books. The index is built once per
+process from the books table, at startup alongside the model warm-up, and kept up to
+date as books are committed.
+
+Each process only sees the commits it makes itself, so books added, changed or deleted
+through another worker are picked up by rebuilding the index from the database every
+rebuild_interval seconds (TYPEAHEAD_REBUILD_INTERVAL); that interval bounds how stale
+a worker's suggestions can be.
+"""
+import bisect
+import heapq
+import os
+import re
+import threading
+import time
+import traceback
+import unicodedata
+from array import array
+
+from . import db
+from .models import Book
+from .recommender.cache import ResultCache
+
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+## Match weights: title words count more than author words, whole words more than prefixes
+TITLE_WORD, TITLE_PREFIX, AUTHOR_WORD, AUTHOR_PREFIX = 3., 2., 2., 1.5
+## Share of the query's trigrams a book must have to be returned as a fuzzy match
+MIN_TRIGRAM_SHARE = 0.65
+
+
+def normalize(text):
+    """
+    Lowercase, strip accents and split into words.
+    """
+    if not text:
+        return []
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join(char for char in text if not unicodedata.combining(char))
+    return WORD.findall(text)
+
+
+def word_trigrams(word):
+    padded = u'  ' + word + u' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class TypeaheadIndex(object):
+    """
+    Books are numbered in the order they were added (their doc number). For each word
+    of the vocabulary, title_postings and author_postings hold the docs having it, as
+    int arrays; trigram_postings does the same for word trigrams.
+    """
+    def __init__(self):
+        self.book_ids = array('i')
+        self.web_ids = array('i')
+        self.titles = []
+        self.authors = []
+        self.title_lengths = array('i')
+        self.docs = {}
+        self.deleted = set()
+        self.vocabulary = []
+        self.title_postings = {}
+        self.author_postings = {}
+        self.trigram_postings = {}
+        self.lock = threading.Lock()
+        self.results = ResultCache(max_entries=4096, max_bytes=16 * 1024 * 1024, ttl=3600)
+
+    def __len__(self):
+        return len(self.docs)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build the index from (book_id, web_id, title, author) rows.
+        """
+        index = cls()
+        for book_id, web_id, title, author in rows:
+            index.add(book_id, web_id, title, author, sort=False)
+        index.vocabulary.sort()
+        return index
+
+    @classmethod
+    def from_database(cls):
+        rows = db.session.query(Book.id, Book.web_id, Book.title, Book.author).yield_per(10000)
+        return cls.from_rows(rows)
+
+    def add(self, book_id, web_id, title, author, sort=True):
+        """
+        Add a book, or replace it if book_id is already indexed.
+        """
+        with self.lock:
+            if book_id in self.docs:
+                self.deleted.add(self.docs[book_id])
+            doc = len(self.book_ids)
+            self.docs[book_id] = doc
+            self.book_ids.append(book_id)
+            self.web_ids.append(web_id or 0)
+            self.titles.append(title or u'')
+            self.authors.append(author or u'')
+            title_words = normalize(title)
+            self.title_lengths.append(len(title_words))
+            for words, postings in ((title_words, self.title_postings), (normalize(author), self.author_postings)):
+                for word in set(words):
+                    if word not in self.title_postings and word not in self.author_postings:
+                        if sort:
+                            bisect.insort(self.vocabulary, word)
+                        else:
+                            self.vocabulary.append(word)
+                    postings.setdefault(word, array('i')).append(doc)
+            trigrams = set()
+            for word in title_words + normalize(author):
+                trigrams.update(word_trigrams(word))
+            for trigram in trigrams:
+                self.trigram_postings.setdefault(trigram, array('i')).append(doc)
+            self.clear_results()
+
+    def remove(self, book_id):
+        """
+        Stop returning a book. Its postings stay until the next rebuild, skipped as deleted.
+        """
+        with self.lock:
+            doc = self.docs.pop(book_id, None)
+            if doc is not None:
+                self.deleted.add(doc)
+                self.clear_results()
+
+    def clear_results(self):
+        if len(self.results):
+            self.results = ResultCache(max_entries=4096, max_bytes=16 * 1024 * 1024, ttl=3600)
+
+    def prefix_scores(self, prefix):
+        """
+        Return doc:score for the docs having a word that starts with prefix.
+        """
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        stop = bisect.bisect_left(self.vocabulary, prefix + u'\uffff', start)
+        scores = {}
+        for word in self.vocabulary[start:stop]:
+            exact = word == prefix
+            for postings, weight in ((self.author_postings.get(word), AUTHOR_WORD if exact else AUTHOR_PREFIX),
+                                     (self.title_postings.get(word), TITLE_WORD if exact else TITLE_PREFIX)):
+                if postings is None:
+                    continue
+                for doc in postings:
+                    if scores.get(doc, 0.) < weight:
+                        scores[doc] = weight
+        return scores
+
+    def prefix_matches(self, words):
+        """
+        Return doc:score for the docs matching every word as a prefix.
+        """
+        scores = None
+        ## Start from the longest word, whose prefix range is usually the smallest
+        for word in sorted(words, key=len, reverse=True):
+            word_scores = self.prefix_scores(word)
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = dict((doc, score + word_scores[doc]) for doc, score in scores.items() if doc in word_scores)
+            if not scores:
+                break
+        return scores or {}
+
+    def trigram_matches(self, words):
+        """
+        Return doc:share of the query trigrams for docs having at least MIN_TRIGRAM_SHARE of them.
+        """
+        trigrams = set()
+        for word in words:
+            trigrams.update(word_trigrams(word))
+        counts = {}
+        for trigram in trigrams:
+            for doc in self.trigram_postings.get(trigram, ()):
+                counts[doc] = counts.get(doc, 0) + 1
+        needed = MIN_TRIGRAM_SHARE * len(trigrams)
+        return dict((doc, count / float(len(trigrams))) for doc, count in counts.items() if count >= needed)
+
+    def search(self, query, n=10, cache=True):
+        """
+        Rank the books matching query: books where every query word starts a title or
+        author word first (whole words and title words scoring higher, shorter titles
+        first on ties), then, if fewer than n, books sharing most of its trigrams.
+
+        Results are cached until the next add or remove, since short prefixes such as "th" match
+        a large share of the books and are typed by everyone.
+
+        Returns:
+        results (list of dicts): book_id, web_id, title and author of the top n books
+        """
+        words = normalize(query)
+        if not words:
+            return []
+        if not cache:
+            return self.rank(words, n)
+        key = (tuple(words), n)
+        results = self.results.get(key)
+        if results is None:
+            results = self.rank(words, n)
+            self.results.set(key, results, 200 * len(results))
+        return results
+
+    def rank(self, words, n):
+        scores = self.prefix_matches(words)
+        ranked = heapq.nsmallest(n, (doc for doc in scores if doc not in self.deleted),
+                                 key=lambda doc: (-scores[doc], self.title_lengths[doc], doc))
+        if len(ranked) < n:
+            found = set(ranked)
+            fuzzy = self.trigram_matches(words)
+            ranked += heapq.nsmallest(n - len(ranked),
+                                      (doc for doc in fuzzy if doc not in found and doc not in self.deleted),
+                                      key=lambda doc: (-fuzzy[doc], self.title_lengths[doc], doc))
+        return [{'book_id': self.book_ids[doc], 'web_id': self.web_ids[doc], 'title': self.titles[doc],
+                 'author': self.authors[doc]} for doc in ranked]
+
+
+def compare_with_whoosh(index, queries, n=10, whoosh_limit=1000):
+    """
+    Cross-check the index against Flask-WhooshAlchemy and time both.
+
+    Whoosh ranks the many books sharing a word in its own order, so its top n is not
+    the reference; instead, recall is the share of the index's top n that Whoosh also
+    matches, out of at most n (queries Whoosh matches nothing for are skipped).
+
+    Returns:
+    report (dict): queries compared, mean recall, and queries/sec of the index and of
+    whoosh_search for n results (which, as in search_results, materialises the rows)
+    """
+    start = time.time()
+    results = [index.search(query, n, cache=False) for query in queries]
+    index_seconds = time.time() - start
+    start = time.time()
+    for query in queries:
+        Book.query.whoosh_search(query, n).all()
+    whoosh_seconds = time.time() - start
+    recalls = []
+    for query, found in zip(queries, results):
+        expected = set(book_id for book_id, in Book.query.whoosh_search(query, whoosh_limit).with_entities(Book.id))
+        if expected:
+            recalls.append(len(expected.intersection(result['book_id'] for result in found)) /
+                           float(min(n, len(expected))))
+    return {'queries': len(queries), 'compared': len(recalls),
+            'recall': sum(recalls) / max(len(recalls), 1),
+            'index_qps': len(queries) / max(index_seconds, 1e-9),
+            'whoosh_qps': len(queries) / max(whoosh_seconds, 1e-9)}
+
+
+class TypeaheadHolder(object):
+    """
+    Holds this process's index and applies the books this process commits to it.
+
+    create_app starts building the index in a background thread next to the model
+    warm-up, so the first /typeahead request does not pay for reading every book; a
+    request arriving during the build waits for it. The same thread then rebuilds the
+    index every rebuild_interval seconds and swaps it in, for the other workers' commits.
+    Without the warm-up (manage.py, tests) the index is built on first use and never
+    rebuilt.
+    """
+    def __init__(self):
+        self.index = None
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.app = None
+        self.pid = None
+        self.rebuild_interval = None
+
+    def start(self, app, rebuild_interval=None):
+        """
+        Build the index in a daemon thread, unless this process already started it.
+
+        Args:
+        rebuild_interval: Seconds between rebuilds from the database (None: never rebuild)
+        """
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            ## A lock copied from a parent that was mid-build would never be released here
+            self.lock = threading.Lock()
+            self.app = app
+            self.pid = os.getpid()
+            self.rebuild_interval = rebuild_interval
+        thread = threading.Thread(target=self.run, name='typeahead-index-builder')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        try:
+            with self.app.app_context():
+                self.build()
+        except Exception:
+            ## get() builds it on first use instead
+            print traceback.format_exc()
+        while self.rebuild_interval:
+            time.sleep(self.rebuild_interval)
+            try:
+                with self.app.app_context():
+                    ## Requests keep searching the current index until the new one is swapped in
+                    self.index = TypeaheadIndex.from_database()
+            except Exception:
+                print traceback.format_exc()
+
+    def build(self):
+        with self.lock:
+            if self.index is None:
+                self.index = TypeaheadIndex.from_database()
+
+    def get(self):
+        if self.app is not None and self.pid != os.getpid():
+            self.start(self.app, self.rebuild_interval)
+        if self.index is None:
+            self.build()
+        return self.index
+
+    def books_committed(self, sender, changes):
+        """
+        models_committed receiver: index inserted and updated books, and drop deleted
+        ones, once the index exists.
+        """
+        if self.index is None:
+            return
+        for model, operation in changes:
+            if not isinstance(model, Book):
+                continue
+            if operation in ('insert', 'update'):
+                self.index.add(model.id, model.web_id, model.title, model.author)
+            elif operation == 'delete':
+                self.index.remove(model.id)
+
+
+typeahead = TypeaheadHolder()
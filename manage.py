@@ -9,16 +9,276 @@ from flask.ext.migrate import Migrate, MigrateCommand
 import flask.ext.whooshalchemy
 #from flask_alembic.cli.script import manager as alembic_manager
 
-app = create_app(os.getenv('FLASK_CONFIG') or 'default') 
+## No background model load or job pool on import: commands that need the models wait
+## for them (model_holder.wait) or load them once themselves, and `db upgrade` needs none
+app = create_app(os.getenv('FLASK_CONFIG') or 'default', RECOMMENDER_WARM_UP=False, RECOMMENDER_JOBS=False)
 manager = Manager(app)
 migrate = Migrate(app, db)
-application = create_app(os.getenv('FLASK_CONFIG') or 'default') 
+application = create_app(os.getenv('FLASK_CONFIG') or 'default', RECOMMENDER_WARM_UP=False, RECOMMENDER_JOBS=False)
 
 
 def make_shell_context():
 	return dict(app=app, db=db, User=User, Book=Book, Read=Read, 
 				Keyword=Keyword, Book_Keyword=Book_keyword)
 	
+@manager.option('-l', '--n-lists', dest='n_lists', type=int, default=None, help='Number of clusters (default sqrt(n_books))')
+@manager.option('-p', '--n-probe', dest='n_probe', type=int, default=8, help='Clusters scanned per query')
+def build_item_index(n_lists=None, n_probe=8):
+	"""Build the nearest-neighbour index over the IPCA book vectors and report its recall"""
+	from flask_app.app.recommender import recommender_data, model_holder
+	from flask_app.app.recommender.ann import ItemIndex, benchmark_recall, item_vectors_from_components
+	models = model_holder.wait()
+	item_vectors = item_vectors_from_components(models.ipca_model.components_)
+	item_index = ItemIndex.build(item_vectors, n_lists=n_lists, n_probe=n_probe)
+	item_index.save(recommender_data.item_index_path)
+	print 'saved {} lists to {}'.format(len(item_index.centroids), recommender_data.item_index_path)
+	for row in benchmark_recall(item_index, item_vectors):
+		print 'n_probe={n_probe} recall@10={recall:.3f} {ms_per_query:.3f} ms/query'.format(**row)
+
+@manager.option('-v', '--version', dest='version', default=None, help='Name of the artifacts version (default: a timestamp)')
+def export_artifacts(version=None):
+	"""Export the recommender pickles as a memory-mapped artifacts version and make it current"""
+	from flask_app.app.recommender import recommender_data, model_holder
+	from flask_app.app.recommender.recommender_data.artifacts import export_artifacts as export
+	models = model_holder.wait()
+	version_dir = export(recommender_data.artifacts_path, models.book_store,
+						 models.dict_vectorizer_fit, models.ipca_model, version=version)
+	print 'exported artifacts to {}'.format(version_dir)
+
+@manager.command
+def book_store_report():
+	"""Compare the memory held by the BookStore with the book_data pickle it replaces"""
+	import pickle
+	from flask_app.app.recommender import recommender_data, model_holder
+	from flask_app.app.recommender.book_store import memory_report
+	models = model_holder.wait()
+	book_data = None
+	if os.path.exists(recommender_data.book_data_path):
+		with open(recommender_data.book_data_path, 'r') as picklefile:
+			book_data = pickle.load(picklefile)
+	for key, value in sorted(memory_report(models.book_store, book_data).items()):
+		print '{}: {:,}'.format(key, value)
+
+@manager.command
+def write_data_manifest():
+	"""Hash the local recommender data files into the manifest read by the S3 fetcher"""
+	import json
+	from flask_app.app.recommender import recommender_data
+	from flask_app.app.recommender.recommender_data.fetch import MANIFEST_NAME, build_manifest
+	manifest = build_manifest(recommender_data.scriptdir, recommender_data.data_file_paths())
+	with open(os.path.join(recommender_data.scriptdir, MANIFEST_NAME), 'w') as manifest_file:
+		json.dump(manifest, manifest_file, indent=2)
+	for entry in manifest['files']:
+		print '{sha256} {size:>12,} {path}'.format(**entry)
+	print 'upload {} with the files to s3://{}/{}/'.format(MANIFEST_NAME, recommender_data.s3_bucket, recommender_data.s3_prefix)
+
+@manager.option('-i', '--input', dest='input_path', required=True, help='Raw books: .jsonl records or a book_data pickle')
+@manager.option('-o', '--output', dest='output_path', required=True, help='Engineered books: .jsonl or a book_data pickle')
+@manager.option('-c', '--conversion-dict', dest='conversion_path', required=True, help='Keyword conversion dict (.json or pickle)')
+@manager.option('-p', '--processes', dest='processes', type=int, default=None, help='Worker processes (default: one per CPU)')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=2000, help='Books per batch sent to the workers')
+def engineer_keywords(input_path, output_path, conversion_path, processes=None, batch_size=2000):
+	"""Merge and rank the keywords of raw book records into engineered book data"""
+	from flask_app.app.recommender import keyword_pipeline
+	keyword_conversion_dict = keyword_pipeline.load_conversion_dict(conversion_path)
+	n_books, books_per_second = keyword_pipeline.engineer_keywords(input_path, output_path, keyword_conversion_dict,
+																	 processes=processes, batch_size=batch_size)
+	print 'engineered {:,} books to {} ({:,.0f} books/sec)'.format(n_books, output_path, books_per_second)
+
+@manager.option('-n', '--n-components', dest='n_components', type=int, default=162, help='Number of IPCA components')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=2000, help='Users per partial_fit batch')
+@manager.option('-m', '--max-books', dest='max_books', type=int, default=50000, help='Keep the most rated books as columns')
+@manager.option('-r', '--min-ratings', dest='min_ratings', type=int, default=1, help='Drop books with fewer ratings')
+@manager.option('-c', '--csr', dest='csr_path', default=None, help='Train from an exported ratings directory instead of the reads table')
+@manager.option('-o', '--output-dir', dest='output_dir', default=None, help='Where to write the pickles (default: recommender_data)')
+@manager.option('-e', '--export', dest='export', action='store_true', default=False, help='Also export an artifacts version with the new model')
+def train(n_components=162, batch_size=2000, max_books=50000, min_ratings=1, csr_path=None, output_dir=None, export=False):
+	"""Fit the IPCA model on the user ratings, streaming batches of users"""
+	import pickle
+	from flask_app.app.recommender import recommender_data
+	from flask_app.app.recommender.training import CsrSource, ReadTableSource, train_ipca
+	if csr_path is not None:
+		source = CsrSource(csr_path)
+	else:
+		source = ReadTableSource(db, Read, Book, app)
+	def report(progress):
+		print 'batch {batches}: {users:,}/{n_users:,} users, {users_per_second:,.0f} users/sec, eta {eta_seconds:.0f}s'.format(**progress)
+	ipca_model, dict_vectorizer_fit, summary = train_ipca(source, n_components, batch_size=batch_size, max_books=max_books,
+														   min_ratings=min_ratings, report=report)
+	print 'fitted {users:,} users ({skipped_users:,} skipped) on {columns:,} books in {batches} batches, {seconds:.0f}s'.format(**summary)
+
+	output_dir = output_dir or recommender_data.scriptdir
+	name = '{}k_nc{}_bs{}_col_mean_then_resid_fill'.format(summary['users'] / 1000, n_components, batch_size)
+	ipca_model_path = os.path.join(output_dir, 'ipca_{}.pkl'.format(name))
+	DV_fit_path = os.path.join(output_dir, 'dict_vectorizer_fit_{}.pkl'.format(name))
+	for path, model in [(ipca_model_path, ipca_model), (DV_fit_path, dict_vectorizer_fit)]:
+		with open(path, 'w') as picklefile:
+			pickle.dump(model, picklefile)
+		print 'saved {}'.format(path)
+
+	if export:
+		from flask_app.app.recommender import model_holder
+		from flask_app.app.recommender.recommender_data.artifacts import export_artifacts as export_version
+		models = model_holder.wait()
+		print 'exported artifacts to {}'.format(export_version(recommender_data.artifacts_path, models.book_store,
+															   dict_vectorizer_fit, ipca_model))
+
+@manager.option('-o', '--output', dest='output_path', required=True, help='Directory to write the ratings to')
+@manager.option('-m', '--max-books', dest='max_books', type=int, default=50000, help='Keep the most rated books as columns')
+def export_ratings(output_path, max_books=50000):
+	"""Export the reads table as a CSR ratings directory for `train --csr`"""
+	from flask_app.app.recommender.training import ColumnStats, CsrSource, ReadTableSource
+	source = ReadTableSource(db, Read, Book, app)
+	column_stats = ColumnStats.top_books(source.book_counts_means(), max_books=max_books)
+	CsrSource.export(output_path, source.iter_users(), column_stats.book_ids)
+	print 'exported {:,} users to {}'.format(CsrSource(output_path).n_users(), output_path)
+
+@manager.option('-f', '--first', dest='first', type=int, default=50, help='Smallest n_components to try')
+@manager.option('-l', '--last', dest='last', type=int, default=None, help='Largest n_components to try (default: all components)')
+@manager.option('-s', '--samples', dest='n_samples', type=int, default=500, help='Number of sample books')
+@manager.option('-p', '--processes', dest='processes', type=int, default=None, help='Worker processes (default: one per CPU)')
+def tune_n_components(first=50, last=None, n_samples=500, processes=None):
+	"""Rank IPCA n_components by the keyword distance of the recommendations they give"""
+	from flask_app.app.recommender import model_holder
+	from flask_app.app.recommender.recommend import Recommend
+	models = model_holder.wait()
+	recommender = Recommend(user=None, Read=Read, Book=Book, book_store=models.book_store, db=db,
+							ipca_model=models.ipca_model, dict_vectorizer_fit=models.dict_vectorizer_fit,
+							collab_start_point=0, return_distances=True, fold_in=models.fold_in,
+							column_catalog=models.column_catalog, keyword_matrix=models.keyword_matrix,
+							feature_index=models.feature_index)
+	last = last or models.fold_in.n_components
+	print 'rank  n_components  total_distance  mean_distance  evaluated'
+	for row in recommender.tune_n_components([first, last], n_samples, processes=processes):
+		print '{rank:>4}  {n_components:>12}  {total_distance:>14.3f}  {mean_distance:>13.4f}  {evaluated:>9}'.format(**row)
+
+@manager.option('-o', '--output', dest='output_path', required=True, help='Where to write the JSON report')
+@manager.option('-c', '--compare', dest='baseline_path', default=None, help='Compare with an earlier report; exit 1 on a regression')
+@manager.option('-a', '--artifacts', dest='artifacts_dir', default=None, help='Artifacts directory to load (default: recommender_data/artifacts)')
+@manager.option('-d', '--database', dest='database_uri', default=None, help='Database to read users from, e.g. sqlite:////tmp/books.db')
+@manager.option('-u', '--users', dest='n_users', type=int, default=200, help='Number of sample users')
+@manager.option('-k', '--n-collab', dest='n_collab_returned', type=int, default=100, help='Size of the collaborative window')
+@manager.option('-s', '--seed', dest='seed', type=int, default=0, help='Seed of the user sample and of the held-out splits')
+@manager.option('-t', '--tolerance', dest='latency_tolerance', type=float, default=0.1, help='Allowed growth of a latency percentile')
+def benchmark(output_path, baseline_path=None, artifacts_dir=None, database_uri=None, n_users=200, n_collab_returned=100,
+			  seed=0, latency_tolerance=0.1):
+	"""Measure recall on held-out reads and per-stage latency of the recommender"""
+	from flask_app.app.recommender import recommender_data
+	from flask_app.app.recommender import benchmark as bench
+	if database_uri is not None:
+		app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+	artifacts_dir = artifacts_dir or recommender_data.artifacts_path
+	## The only copy loaded: the manage.py apps start no background load to time against
+	models = recommender_data.load_models(artifacts_dir=artifacts_dir)
+	held_out_users = bench.sample_users(db, User, Read, Book, models.book_store,
+										models.dict_vectorizer_fit.vocabulary_, n_users, seed=seed)
+	quality, timer = bench.evaluate(held_out_users, models, db, Read, Book, n_collab_returned=n_collab_returned)
+	settings = {'users': n_users, 'seed': seed, 'n_collab_returned': n_collab_returned,
+				'artifacts': os.path.abspath(artifacts_dir), 'database': app.config['SQLALCHEMY_DATABASE_URI']}
+	report = bench.build_report(quality, timer, settings)
+	bench.write_report(report, output_path)
+	for metric in sorted(quality):
+		print '{:<24} {}'.format(metric, quality[metric])
+	for stage, latency in sorted(report['latency_ms'].items()):
+		print '{:<24} p50 {p50:8.2f}  p95 {p95:8.2f}  p99 {p99:8.2f} ms  ({count} runs)'.format(stage, **latency)
+	print 'wrote {}'.format(output_path)
+	if baseline_path is None:
+		return
+	baseline = bench.load_report(baseline_path)
+	for name in bench.settings_differences(baseline, report):
+		print 'warning: {} differs from the baseline'.format(name)
+	rows = bench.compare_reports(baseline, report, latency_tolerance=latency_tolerance)
+	for row in rows:
+		print '{flag} {metric:<34} {baseline:10.4f} -> {current:10.4f} ({change:+.3f})'.format(
+			flag='!' if row['regressed'] else ' ', **row)
+	if any(row['regressed'] for row in rows):
+		return 1
+
+@manager.option('-q', '--queries', dest='n_queries', type=int, default=1000, help='Number of sample queries')
+@manager.option('-n', '--results', dest='n', type=int, default=10, help='Results per query')
+@manager.option('-s', '--seed', dest='seed', type=int, default=0, help='Seed of the sample queries')
+def typeahead_benchmark(n_queries=1000, n=10, seed=0):
+	"""Cross-check the typeahead index with Whoosh and compare their queries/sec"""
+	import random
+	import time
+	import numpy as np
+	from flask_app.app.typeahead import TypeaheadIndex, compare_with_whoosh, normalize
+	start = time.time()
+	index = TypeaheadIndex.from_database()
+	print 'indexed {:,} books in {:.2f}s'.format(len(index), time.time() - start)
+	rng = random.Random(seed)
+	words = [normalize(rng.choice(index.titles) + u' ' + rng.choice(index.authors)) for _ in range(n_queries)]
+	word_queries = [rng.choice(book_words) for book_words in words if book_words]
+	report = compare_with_whoosh(index, word_queries, n=n)
+	print 'whole words: {recall:.3f} of the top {} also matched by whoosh, over {compared} queries'.format(n, **report)
+	print 'index {index_qps:,.0f} queries/sec, whoosh {whoosh_qps:,.0f} queries/sec'.format(**report)
+	prefixes = [word[:rng.randint(2, max(2, len(word)))] for word in word_queries]
+	seconds = []
+	for prefix in prefixes:
+		start = time.time()
+		index.search(prefix, n, cache=False)
+		seconds.append(time.time() - start)
+	p50, p99 = np.percentile(np.array(seconds) * 1e6, [50, 99])
+	print 'uncached prefixes: p50 {:.0f}us p99 {:.0f}us, {:,.0f} queries/sec'.format(p50, p99, len(seconds) / max(sum(seconds), 1e-9))
+
+@manager.option('-d', '--database', dest='database_uri', default=None, help='Scratch database to create the tables in (default: a temporary SQLite file)')
+@manager.option('-n', '--ratings', dest='n_ratings', type=int, default=2000, help='Number of ratings per pass')
+@manager.option('-b', '--batch', dest='batch_size', type=int, default=200, help='Ratings per /ratings request')
+def rating_benchmark(database_uri=None, n_ratings=2000, batch_size=200):
+	"""Compare ratings/sec of one insert and commit per click with batch upserts"""
+	import random
+	import tempfile
+	import time
+	from flask_app.app.ratings import upsert_ratings, write_ratings
+	if database_uri is None:
+		database_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'ratings.db')
+	app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+	with app.app_context():
+		db.create_all()
+		## Core inserts, so the search index is not touched
+		first_book = (db.session.query(db.func.max(Book.id)).scalar() or 0) + 1
+		first_user = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+		db.session.execute(Book.__table__.insert(), [{'id': first_book + i, 'web_id': 900000000 + first_book + i,
+													  'title': 'benchmark book {}'.format(i)} for i in range(n_ratings)])
+		db.session.execute(User.__table__.insert(), [{'id': first_user + i, 'email': 'rating-benchmark-{}@example.com'.format(first_user + i)}
+													 for i in range(4)])
+		db.session.commit()
+		rng = random.Random(0)
+		web_ids = [900000000 + first_book + i for i in range(n_ratings)]
+		ratings = [(web_id, rng.randint(1, 5)) for web_id in web_ids]
+
+		def report(name, seconds):
+			print '{:<38} {:>8.3f}s {:>10,.0f} ratings/sec'.format(name, seconds, n_ratings / max(seconds, 1e-9))
+
+		## What /rating did before: two selects, an insert and a commit per click
+		user = db.session.query(User).get(first_user)
+		start = time.time()
+		for web_id, rating in ratings:
+			book = db.session.query(Book).filter(Book.web_id==web_id).first()
+			db.session.query(Read).filter_by(book=book, user=user).first()
+			db.session.add(Read(user=user, book=book, rating=rating))
+			db.session.commit()
+		report('insert + commit per click', time.time() - start)
+
+		## /rating now: one select and one upsert per click
+		start = time.time()
+		for web_id, rating in ratings:
+			book = db.session.query(Book.id, Book.title).filter(Book.web_id==web_id).first()
+			upsert_ratings(db.session, [(first_user + 1, book.id, rating)])
+			db.session.commit()
+		report('upsert + commit per click', time.time() - start)
+
+		## /ratings: one select, one upsert and one commit per batch
+		for name, user_id in [('batched upserts (new reads)', first_user + 2), ('batched upserts (same again)', first_user + 2)]:
+			start = time.time()
+			for offset in range(0, n_ratings, batch_size):
+				write_ratings(db.session, user_id, ratings[offset:offset + batch_size])
+			report(name, time.time() - start)
+		counts = dict(db.session.query(Read.user_id, db.func.count()).filter(Read.user_id >= first_user)
+					  .group_by(Read.user_id).all())
+		print 'reads per user: {} (expected {} each)'.format(', '.join(str(counts.get(first_user + i, 0)) for i in range(3)), n_ratings)
+	print 'database: {}'.format(database_uri)
+
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 #manager.add_command('db', alembic_manager)
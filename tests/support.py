@@ -0,0 +1,65 @@
+"""
+Shared set-up for the tests: puts the repository on the path, stands in for the
+deployment's config.py when it is absent, and builds test apps and logged-in clients.
+"""
+import os
+import sys
+import tempfile
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import flask_app
+
+try:
+    import flask_app.config
+except ImportError:
+    ## config.py holds the deployment's keys and is not in the repository; stand in for it
+    class Config(object):
+        LOCAL = True
+        SECRET_KEY = 'test'
+        FB_CONSUMER_KEY = FB_CONSUMER_SECRET = 'test'
+        TWITTER_CONSUMER_KEY = TWITTER_CONSUMER_SECRET = 'test'
+        GOOGLE_CLIENT_ID = GOOGLE_CLIENT_SECRET = 'test'
+        FLASKS3_BUCKET_NAME = 'test'
+        MAX_SEARCH_RESULTS = 50
+
+        @staticmethod
+        def init_app(app):
+            pass
+
+    config_module = types.ModuleType('flask_app.config')
+    config_module.Config = Config
+    config_module.config = {'default': Config, 'testing': Config}
+    sys.modules['flask_app.config'] = flask_app.config = config_module
+
+CONFIG_NAME = 'testing' if 'testing' in flask_app.config.config else 'default'
+
+from flask.ext import login as flask_login
+from flask_app.app import create_app
+
+WHOOSH_BASE = tempfile.mkdtemp()
+
+
+def create_test_app(**settings):
+    """
+    An app on an in-memory SQLite database, without the model warm-up, metrics or CSRF.
+    """
+    options = dict(TESTING=True, WTF_CSRF_ENABLED=False, FLASKS3_ACTIVE=False,
+                   SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_TRACK_MODIFICATIONS=True,
+                   WHOOSH_BASE=WHOOSH_BASE, RECOMMENDER_WARM_UP=False, RECOMMENDER_METRICS=False)
+    options.update(settings)
+    return create_app(CONFIG_NAME, **options)
+
+
+def logged_in_client(app, user_id):
+    """
+    A test client whose session is logged in as user_id.
+    """
+    client = app.test_client()
+    with app.test_request_context():
+        identifier = flask_login._create_identifier()
+    with client.session_transaction() as session:
+        session['user_id'] = str(user_id)
+        session['_fresh'] = True
+        session['_id'] = identifier
+    return client
@@ -0,0 +1,85 @@
+"""
+ArtifactFetcher against a local directory standing in for S3: valid copies are kept,
+corrupted ones replaced, bad downloads refused, and multi-part files put back together.
+
+Run with: python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import support  ## the repository on sys.path, and config.py if it is missing
+from flask_app.app.recommender.recommender_data.fetch import (ArtifactFetcher, LocalDirectoryBackend,
+                                                               MANIFEST_NAME, build_manifest)
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.remote = tempfile.mkdtemp()
+        self.local = tempfile.mkdtemp()
+        self.contents = {'model.pkl': os.urandom(1000), 'artifacts/v1/vectors.npy': os.urandom(2500)}
+        for path, data in self.contents.items():
+            self.write(self.remote, path, data)
+        self.write_manifest()
+        self.fetcher = ArtifactFetcher(LocalDirectoryBackend(self.remote), self.local, max_workers=4, part_size=256)
+
+    def tearDown(self):
+        shutil.rmtree(self.remote)
+        shutil.rmtree(self.local)
+
+    def write(self, directory, path, data):
+        full_path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'wb') as data_file:
+            data_file.write(data)
+
+    def read(self, path):
+        with open(os.path.join(self.local, path), 'rb') as data_file:
+            return data_file.read()
+
+    def write_manifest(self):
+        self.write(self.remote, MANIFEST_NAME, json.dumps(build_manifest(self.remote, sorted(self.contents))))
+
+    def statuses(self, report):
+        return dict((row['path'], row['status']) for row in report)
+
+    def part_files(self):
+        return [name for _, _, names in os.walk(self.local) for name in names if name.endswith('.part')]
+
+    def test_multi_part_download_is_byte_identical(self):
+        report = self.fetcher.fetch()
+        self.assertEqual(self.statuses(report), {'model.pkl': 'downloaded', 'artifacts/v1/vectors.npy': 'downloaded'})
+        for path, data in self.contents.items():
+            self.assertEqual(self.read(path), data)
+        self.assertEqual(self.part_files(), [])
+
+    def test_valid_local_copy_is_skipped(self):
+        self.fetcher.fetch()
+        report = self.fetcher.fetch()
+        self.assertEqual(self.statuses(report), {'model.pkl': 'skipped', 'artifacts/v1/vectors.npy': 'skipped'})
+
+    def test_corrupted_local_copy_is_downloaded_again(self):
+        self.fetcher.fetch()
+        path = os.path.join(self.local, 'model.pkl')
+        stat = os.stat(path)
+        ## Same size, different bytes and mtime: only the hash can tell
+        self.write(self.local, 'model.pkl', 'x' * len(self.contents['model.pkl']))
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        report = self.fetcher.fetch()
+        self.assertEqual(self.statuses(report), {'model.pkl': 'downloaded', 'artifacts/v1/vectors.npy': 'skipped'})
+        self.assertEqual(self.read('model.pkl'), self.contents['model.pkl'])
+
+    def test_checksum_mismatch_raises_and_leaves_no_part_file(self):
+        ## The remote file changes after its manifest was written
+        self.write(self.remote, 'model.pkl', os.urandom(1000))
+        with self.assertRaises(IOError):
+            self.fetcher.fetch()
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'model.pkl')))
+        self.assertEqual(self.part_files(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
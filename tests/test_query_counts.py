@@ -0,0 +1,80 @@
+"""
+The library, recommendations and search pages run a fixed number of queries, however
+many books the user has read.
+
+Run with: python -m unittest discover tests
+"""
+import unittest
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from support import create_test_app, logged_in_client
+from flask_app.app import db
+from flask_app.app.models import User, Book, Read
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+class QueryCountTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_test_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.counter = QueryCounter()
+        event.listen(Engine, 'before_cursor_execute', self.counter)
+
+    def tearDown(self):
+        event.remove(Engine, 'before_cursor_execute', self.counter)
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def client_with_reads(self, n_reads):
+        """
+        A logged-in client whose user has read n_reads of 2 * n_reads "Dune" books.
+        """
+        db.session.add(User(id=1, email='reader@example.com', name='Reader'))
+        for i in range(2 * n_reads):
+            db.session.add(Book(id=i + 1, web_id=100000 + i, title='Dune {}'.format(i), author='Frank Herbert'))
+        db.session.commit()
+        for i in range(n_reads):
+            db.session.add(Read(user_id=1, book_id=2 * i + 1, rating=i % 5 + 1))
+        db.session.commit()
+        db.session.remove()
+        return logged_in_client(self.app, 1)
+
+    def count_queries(self, client, url):
+        del self.counter.statements[:]
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(self.counter.statements)
+
+    def page_queries(self, n_reads, url):
+        client = self.client_with_reads(n_reads)
+        try:
+            return self.count_queries(client, url)
+        finally:
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+
+    def test_library_queries_do_not_grow_with_reads(self):
+        self.assertEqual(self.page_queries(3, '/library'), self.page_queries(40, '/library'))
+
+    def test_recommendations_queries_do_not_grow_with_reads(self):
+        self.assertEqual(self.page_queries(3, '/recommendations'), self.page_queries(40, '/recommendations'))
+
+    def test_search_results_queries_do_not_grow_with_results(self):
+        self.assertEqual(self.page_queries(3, '/search_results/Dune'), self.page_queries(20, '/search_results/Dune'))
+
+
+if __name__ == '__main__':
+    unittest.main()
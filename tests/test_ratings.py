@@ -0,0 +1,61 @@
+"""
+Rating writes are idempotent upserts: posting a batch again, repeating a book in a
+batch, or rating a book again leaves one read per (user, book) with the last rating.
+
+Run with: python -m unittest discover tests
+"""
+import json
+import unittest
+
+from support import create_test_app, logged_in_client
+from flask_app.app import db
+from flask_app.app.models import User, Book, Read
+
+
+class RatingsTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_test_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        db.session.add(User(id=1, email='reader@example.com', name='Reader'))
+        for i in range(5):
+            db.session.add(Book(id=i + 1, web_id=100000 + i, title='Book {}'.format(i), author='Author'))
+        db.session.commit()
+        db.session.remove()
+        self.client = logged_in_client(self.app, 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def post(self, url, payload):
+        response = self.client.post(url, data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def reads(self):
+        db.session.remove()
+        return sorted((read.user_id, read.book_id, read.rating) for read in Read.query.all())
+
+    def test_posting_a_batch_twice_leaves_one_read_per_book(self):
+        batch = {'ratings': [[100000, 4], [100001, 2], [100002, 5]]}
+        self.assertEqual(self.post('/ratings', batch), {'received': 3, 'written': 3})
+        self.assertEqual(self.post('/ratings', batch), {'received': 3, 'written': 3})
+        self.assertEqual(self.reads(), [(1, 1, 4), (1, 2, 2), (1, 3, 5)])
+
+    def test_last_rating_of_a_repeated_book_wins(self):
+        self.post('/ratings', {'ratings': [[100000, 1], [100001, 3]]})
+        response = self.post('/ratings', {'ratings': [[100000, 2], [100003, 4], [100000, 5]]})
+        self.assertEqual(response, {'received': 3, 'written': 2})
+        self.assertEqual(self.reads(), [(1, 1, 5), (1, 2, 3), (1, 4, 4)])
+
+    def test_rating_a_rated_book_updates_its_read(self):
+        self.post('/rating', {'rating': [100002, 3]})
+        self.post('/rating', {'rating': [100002, 1]})
+        self.assertEqual(self.reads(), [(1, 3, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()